@@ -0,0 +1,187 @@
+"""
+Per-request state shared by the actions of one `RuleSet.apply_rules`
+call.
+"""
+
+from deliverance.selector import ElementIndex
+
+__all__ = ['ApplyState']
+
+class ApplyState(object):
+    """
+    Information the actions share while they are applied to one
+    content document and one theme document.
+
+    ``theme_slots`` is the `deliverance.themeslots.ThemeSlotIndex`
+    for the theme document (if any).  It can only be used as long as
+    the theme has not been reshaped: theme elements may be removed
+    and content inserted, but once an action changes attributes or
+    tags of theme elements, flattens theme elements, or inserts
+    content as if it were part of the theme (``collapse-sources``),
+    theme selectors have to be evaluated again.
+
+    ``preapplied`` are the actions that were already applied to the
+    cached theme the document was copied from, and are skipped.
+
+    Simple selectors are looked up in an
+    `deliverance.selector.ElementIndex` of each document, which is
+    kept for the whole request for content documents (which only
+    lose elements and attributes), but only until the first change
+    to the theme document.
+
+    Content elements moved or copied into the theme are remembered
+    here (`mark_content`), so that theme selectors don't select them
+    (`is_content`).
+
+    ``content_batch`` is a `deliverance.selector.SelectorBatch` of the
+    content selectors of the rules, evaluated in advance; it is used
+    until an action changes the content document other than by
+    removing elements from it.
+
+    The result of each selector is also remembered for each document
+    (`get_selection`), so actions sharing a ``content`` or
+    ``if-content`` selector only evaluate it once, until an action
+    changes the document.
+    """
+
+    def __init__(self, theme_doc=None, theme_slots=None, preapplied=(),
+                 content_batch=None):
+        self.theme_doc = theme_doc
+        self.content_batch = content_batch
+        self.theme_slots = theme_slots
+        self.preapplied = preapplied
+        self.theme_reshaped = False
+        self.theme_changed = False
+        self.indexes = {}
+        # doc -> {selector key: (type, elements, attributes)}
+        self.selections = {}
+        # The roots of the content inserted into the theme, and the
+        # elements of the theme from before that; both hold on to the
+        # lxml proxies, so the elements keep their identity
+        self.content_roots = set()
+        self.original_theme = None
+        if theme_slots is not None:
+            # The slots refer to elements by their position in the
+            # unmodified document:
+            self.theme_elements = list(theme_doc.iter())
+        else:
+            self.theme_elements = None
+
+    def is_preapplied(self, action):
+        """True if the action was applied to the theme in advance"""
+        return action in self.preapplied
+
+    def select_theme(self, selector, doc):
+        """
+        Returns the precomputed ``(type, elements, attributes)``
+        selection of the theme `selector` from `doc`, or None if it has
+        to be evaluated normally.
+        """
+        if (self.theme_slots is None or self.theme_reshaped
+            or doc is not self.theme_doc):
+            return None
+        return self.theme_slots.select(selector, doc, self.theme_elements)
+
+    def mark_content(self, els):
+        """
+        Remembers that the elements `els` (and everything inside them)
+        come from the content.  Called before they are inserted into
+        the theme.
+        """
+        if self.original_theme is None:
+            if self.theme_elements is not None:
+                self.original_theme = set(self.theme_elements)
+            elif self.theme_doc is not None:
+                self.original_theme = set(self.theme_doc.iter())
+            else:
+                self.original_theme = set()
+        self.content_roots.update(els)
+
+    def is_content(self, el):
+        """
+        Tests if the element came from the content (which includes if
+        any of its ancestors did).
+        """
+        content_roots = self.content_roots
+        if not content_roots:
+            return False
+        original_theme = self.original_theme
+        # Theme elements are never inside content, so this stops at
+        # the first one
+        while el is not None:
+            if el in original_theme:
+                return False
+            if el in content_roots:
+                return True
+            el = el.getparent()
+        return False
+
+    def batch_for(self, doc):
+        """
+        Returns the `SelectorBatch` for `doc`, or None if there is none
+        (or it can't be used anymore).
+        """
+        batch = self.content_batch
+        if batch is not None and batch.doc is doc:
+            return batch
+        return None
+
+    def get_selection(self, selector, doc):
+        """
+        Returns the ``(type, elements, attributes)`` result of
+        `selector` in `doc` remembered by `set_selection`, or None if
+        the document was changed since.
+        """
+        selections = self.selections.get(doc)
+        if selections is None:
+            return None
+        result = selections.get(selector.key)
+        if result is None:
+            return None
+        type, elements, attributes = result
+        return type, list(elements), attributes
+
+    def set_selection(self, selector, doc, result):
+        """Remembers the result of `selector` in `doc`"""
+        type, elements, attributes = result
+        self.selections.setdefault(doc, {})[selector.key] = (
+            type, list(elements), attributes)
+
+    def content_modified(self, doc, content_type):
+        """
+        Called after an action changed the content document `doc`,
+        where `content_type` is the selection type used.  Only
+        ``elements`` and ``children`` selections just remove elements.
+        """
+        self.selections.pop(doc, None)
+        if content_type in ('attributes', 'tag'):
+            self.content_batch = None
+
+    def element_index(self, doc):
+        """
+        Returns the `ElementIndex` for `doc`, or None if it can't be
+        used.
+        """
+        if doc is self.theme_doc and self.theme_changed:
+            return None
+        index = self.indexes.get(doc)
+        if index is None:
+            if not ElementIndex.can_index(doc):
+                return None
+            index = self.indexes[doc] = ElementIndex(doc)
+        return index
+
+    def theme_modified(self, theme_type, content_type=None,
+                       collapse_sources=False):
+        """
+        Called after an action modified the theme, where `theme_type`
+        (and `content_type`, for actions that move content) are the
+        selection types used.
+        """
+        self.theme_changed = True
+        self.indexes.pop(self.theme_doc, None)
+        self.selections.pop(self.theme_doc, None)
+        if (theme_type in ('attributes', 'tag')
+            or content_type in ('attributes', 'tag')
+            or collapse_sources):
+            self.theme_reshaped = True
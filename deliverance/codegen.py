@@ -0,0 +1,432 @@
+"""
+The ``compiled`` engine: the actions of the rules that apply to a
+page are turned into the source of one Python function, with the
+selector types, the ``nocontent``/``notheme``/``manytheme`` handling
+and ``move`` worked out in advance, so that each request only runs
+the lxml operations the actions come down to.
+
+The generated code does exactly what the actions' own ``apply``
+methods do (and logs the same messages); actions it has no special
+case for (``href``, selectors mixing types) are still applied by
+calling ``action.apply``.
+"""
+
+import linecache
+from copy import deepcopy
+from deliverance.exceptions import AbortTheme
+from deliverance.rules import Drop, Replace, TransformAction
+from deliverance.rules import add_text, add_tail, move_tail_upwards
+
+__all__ = ['CompiledTransform']
+
+def _describe(action):
+    """The action as a one-line comment"""
+    text = unicode(action)
+    for entity, char in [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+                         ('&#39;', "'"), ('&amp;', '&')]:
+        text = text.replace(entity, char)
+    return u' '.join(text.split())
+
+def _single_type(selector):
+    """The type of everything `selector` selects, or None if mixed"""
+    types = selector.selector_types()
+    if len(types) == 1:
+        return list(types)[0]
+    return None
+
+def _log_method(error):
+    """The log method for the ``nocontent``/``notheme`` `error`"""
+    if error == 'ignore':
+        return 'log.debug'
+    return 'log.warn'
+
+
+class _Source(object):
+    """Lines of Python source, with indentation"""
+
+    def __init__(self):
+        self.lines = []
+        self.indent = 0
+
+    def __call__(self, line, *args):
+        if args:
+            line = line % args
+        self.lines.append(u'    ' * self.indent + line)
+
+    def text(self):
+        return u'\n'.join(self.lines) + u'\n'
+
+
+class CompiledTransform(object):
+    """
+    The actions of `rules` (in order, as they apply to a request)
+    compiled into one Python function; `preapplied` are the actions
+    already applied to the cached theme.  ``source`` is the generated
+    code, and ``name`` identifies it (in the debugging console, and
+    in tracebacks).
+
+    Call `apply` with the documents, like ``Rule.apply``.
+    """
+
+    def __init__(self, rules, preapplied=(), name='transform'):
+        self.rules = tuple(rules)
+        self.name = name
+        self.namespace = {
+            'AbortTheme': AbortTheme, 'deepcopy': deepcopy,
+            'add_text': add_text, 'add_tail': add_tail,
+            'move_tail_upwards': move_tail_upwards}
+        self.actions = 0
+        self.interpreted = 0
+        out = _Source()
+        out(u'# Generated by deliverance.codegen for %i rules', len(self.rules))
+        functions = []
+        for rule in self.rules:
+            for action in rule._actions:
+                var = 'a%i' % self.actions
+                self.namespace[var] = action
+                function = 'action_%i' % self.actions
+                self.actions += 1
+                out(u'')
+                out(u'def %s(content_doc, theme_doc, resource_fetcher, log, state):',
+                    function)
+                out.indent += 1
+                out(u'# %s', _describe(action))
+                if isinstance(action, Drop) and action in preapplied:
+                    out(u"log.debug(%s, 'Theme elements were already dropped "
+                        u"from the cached theme')", var)
+                elif isinstance(action, Drop) and self.can_compile_drop(action):
+                    self.compile_drop(action, var, out)
+                elif (isinstance(action, TransformAction)
+                      and self.can_compile_transform(action)):
+                    self.compile_transform(action, var, out)
+                else:
+                    self.interpreted += 1
+                    out(u'# (applied by the action itself)')
+                    out(u'%s.apply(content_doc, theme_doc, resource_fetcher, '
+                        u'log, state)', var)
+                out.indent -= 1
+                functions.append(function)
+        out(u'')
+        out(u'def transform(content_doc, theme_doc, resource_fetcher, log, state):')
+        out.indent += 1
+        for function in functions:
+            out(u'%s(content_doc, theme_doc, resource_fetcher, log, state)',
+                function)
+        if not functions:
+            out(u'pass')
+        self.source = out.text()
+        filename = '<deliverance %s>' % name
+        exec compile(self.source, filename, 'exec') in self.namespace
+        # So tracebacks show the generated lines:
+        linecache.cache[filename] = (len(self.source), None,
+                                     self.source.splitlines(True), filename)
+        self._transform = self.namespace['transform']
+
+    def __repr__(self):
+        return '<%s %s %i actions (%i interpreted)>' % (
+            self.__class__.__name__, self.name, self.actions,
+            self.interpreted)
+
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state):
+        """
+        Applies the rules to `theme_doc`.  `state` is the
+        `deliverance.applystate.ApplyState` of the request.  May raise
+        AbortTheme.
+        """
+        self._transform(content_doc, theme_doc, resource_fetcher, log, state)
+        return theme_doc
+
+    def can_compile_transform(self, action):
+        if action.content_href or action.theme is None:
+            return False
+        return (_single_type(action.content) is not None
+                and _single_type(action.theme) is not None)
+
+    def can_compile_drop(self, action):
+        for selector in (action.theme, action.content):
+            if selector is not None and _single_type(selector) is None:
+                return False
+        return True
+
+    def compile_if_content(self, action, var, out):
+        if action.if_content is not None:
+            out(u'if not %s.if_content_matches(content_doc, log, state):', var)
+            out(u'    return')
+
+    def compile_transform(self, action, var, out):
+        """Generates the body of `action` (see ``TransformAction.apply``)"""
+        content_type = _single_type(action.content)
+        theme_type = _single_type(action.theme)
+        self.compile_if_content(action, var, out)
+        out(u'content_type, content_els, content_attributes = '
+            u'%s.select_elements(', var)
+        out(u'    %s.content, content_doc, False, state)', var)
+        out(u'if not content_els:')
+        if action.nocontent == 'abort':
+            out(u"    log.debug(%s, 'aborting theming because no content "
+                u"matches rule content=\"%%s\"', %s.content)", var, var)
+            out(u"    raise AbortTheme('No content matches content=\"%%s\"' "
+                u"%% %s.content)", var)
+        else:
+            out(u"    %s(%s, 'skipping rule because no content matches rule "
+                u"content=\"%%s\"', %s.content)",
+                _log_method(action.nocontent), var, var)
+            out(u'    return')
+        out(u'theme_type, theme_els, theme_attributes = %s.select_elements(', var)
+        out(u'    %s.theme, theme_doc, True, state)', var)
+        out(u'if not theme_els:')
+        if action.notheme == 'abort':
+            out(u"    log.debug(%s, 'aborting theming because no theme elements "
+                u"match rule theme=\"%%s\"', %s.theme)", var, var)
+            out(u"    raise AbortTheme('No theme element matches theme=\"%%s\"' "
+                u"%% %s.theme)", var)
+        else:
+            out(u"    %s(%s, 'skipping rule because no theme element matches "
+                u"rule theme=\"%%s\"', %s.theme)",
+                _log_method(action.notheme), var, var)
+            out(u'    return')
+        handler, position = action.manytheme
+        out(u'if len(theme_els) > 1:')
+        if handler == 'abort':
+            out(u"    log.debug(%s, 'aborting theming because %%i elements (%%s) "
+                u"match theme=\"%%s\"', len(theme_els), "
+                u"%s.format_tags(theme_els, include_name=False), %s.theme)",
+                var, var, var)
+            out(u"    raise AbortTheme('Many elements match theme=\"%%s\"' "
+                u"%% %s.theme)", var)
+        else:
+            if handler == 'warn':
+                log_method = 'log.warn'
+            else:
+                log_method = 'log.debug'
+            out(u"    %s(%s, '%%s elements match theme=\"%%s\", using the %%s "
+                u"match', len(theme_els), %s.theme, %r)",
+                log_method, var, var, str(position))
+        if handler != 'abort' and position == 'last':
+            out(u'theme_el = theme_els[-1]')
+        else:
+            out(u'theme_el = theme_els[0]')
+        if not action.move and theme_type in ('children', 'elements'):
+            out(u'content_els = deepcopy(content_els)')
+        if not action.collapse_sources:
+            out(u'state.mark_content(content_els)')
+        if theme_type in ('children', 'elements'):
+            if isinstance(action, Replace):
+                self.compile_replace(action, var, content_type, theme_type, out)
+            else:
+                self.compile_append(action, var, content_type, theme_type, out)
+        else:
+            out(u'%s.apply_transformation(', var)
+            out(u'    content_type, content_els,')
+            out(u'    %s.join_attributes(content_attributes, theme_attributes),',
+                var)
+            out(u'    theme_type, theme_el, log)')
+        out(u'state.theme_modified(%r, %r, %r)', str(theme_type),
+            str(content_type), bool(action.collapse_sources))
+        if action.move:
+            out(u'state.content_modified(content_doc, %r)', str(content_type))
+
+    def compile_content_tails(self, action, out):
+        """The tails of moved content elements stay in the content"""
+        if action.move:
+            out(u'for el in reversed(content_els):')
+            out(u'    move_tail_upwards(el)')
+        else:
+            out(u'for el in content_els:')
+            out(u'    el.tail = None')
+
+    def compile_replace(self, action, var, content_type, theme_type, out):
+        """See ``Replace.apply_transformation``"""
+        if theme_type == 'children':
+            out(u'if len(theme_el):')
+            out(u"    log_text = 'and removed the chilren and text of the "
+                u"theme element'")
+            out(u'elif theme_el.text:')
+            out(u"    log_text = 'and removed the text content of the theme "
+                u"element'")
+            out(u'else:')
+            out(u"    log_text = '(the theme was already empty)'")
+            out(u'theme_el[:] = []')
+            out(u"theme_el.text = ''")
+            if content_type == 'elements':
+                self.compile_content_tails(action, out)
+                out(u'theme_el.extend(content_els)')
+                out(u"log.debug(%s, '%%s %%s from content into theme element "
+                    u"%%s %%s', %r, %s.format_tags(content_els), "
+                    u"%s.format_tag(theme_el), log_text)",
+                    var, action.move and 'Moving' or 'Copying', var, var)
+            else:
+                out(u'text, els = %s.prepare_content_children(content_els)', var)
+                out(u'add_text(theme_el, text)')
+                out(u'theme_el.extend(els)')
+                if action.move:
+                    out(u'for el in content_els:')
+                    out(u'    el.getparent().remove(el)')
+                    out(u"log.debug(%s, 'Moving children of content %%s into "
+                        u"theme element %%s, and removing now-empty content "
+                        u"elements %%s', %s.format_tags(content_els), "
+                        u"%s.format_tag(theme_el), log_text)", var, var, var)
+                else:
+                    out(u"log.debug(%s, 'Copying children of content %%s into "
+                        u"theme element %%s %%s', %s.format_tags(content_els), "
+                        u"%s.format_tag(theme_el), log_text)", var, var, var)
+        else:
+            out(u'move_tail_upwards(theme_el)')
+            out(u'parent = theme_el.getparent()')
+            out(u'pos = parent.index(theme_el)')
+            if content_type == 'elements':
+                self.compile_content_tails(action, out)
+                out(u'parent[pos:pos+1] = content_els')
+                out(u"log.debug(%s, 'Replaced the theme element %%s with the "
+                    u"content %%s (%%s)', %s.format_tag(theme_el), "
+                    u"%s.format_tags(content_els), %r)",
+                    var, var, var, action.move and 'moved' or 'copied')
+            else:
+                out(u'text, els = %s.prepare_content_children(content_els)', var)
+                out(u'if pos == 0:')
+                out(u'    add_text(parent, text)')
+                out(u'else:')
+                out(u'    add_tail(parent[pos-1], text)')
+                out(u'parent[pos:pos+1] = els')
+                if action.move:
+                    out(u'for el in content_els:')
+                    out(u'    el.getparent().remove(el)')
+                    out(u"log.debug(%s, 'Replaced the theme element %%s with the "
+                        u"children of the content %%s, and removed the "
+                        u"now-empty content element(s)', "
+                        u"%s.format_tag(theme_el), %s.format_tags(content_els))",
+                        var, var, var)
+                else:
+                    out(u"log.debug(%s, 'Replaced the theme element %%s with "
+                        u"copies of the children of the content %%s', "
+                        u"%s.format_tag(theme_el), %s.format_tags(content_els))",
+                        var, var, var)
+
+    def compile_append(self, action, var, content_type, theme_type, out):
+        """See ``Append.apply_transformation`` (and ``Prepend``)"""
+        append = action._append
+        if action.move:
+            verb = 'Moving'
+        else:
+            verb = 'Copying'
+        if theme_type == 'children':
+            if content_type == 'elements':
+                self.compile_content_tails(action, out)
+                if append:
+                    out(u'theme_el.extend(content_els)')
+                else:
+                    out(u'add_tail(content_els[-1], theme_el.text)')
+                    out(u'theme_el.text = None')
+                    out(u'theme_el[:0] = content_els')
+                out(u"log.debug(%s, '%%s content %%s to the %%s of theme element "
+                    u"%%s', %r, %s.format_tags(content_els), %r, "
+                    u"%s.format_tag(theme_el))", var, verb, var,
+                    append and 'end' or 'beginning', var)
+                return
+            out(u'text, els = %s.prepare_content_children(content_els)', var)
+            if append:
+                out(u'if len(theme_el):')
+                out(u'    add_tail(theme_el[-1], text)')
+                out(u'else:')
+                out(u'    add_text(theme_el, text)')
+                out(u'theme_el.extend(els)')
+            else:
+                out(u'if len(els):')
+                out(u'    add_tail(els[-1], theme_el.text)')
+                out(u'    theme_el.text = text')
+                out(u'else:')
+                out(u'    old_text = theme_el.text')
+                out(u"    theme_el.text = text or ''")
+                out(u'    if old_text:')
+                out(u'        theme_el.text += old_text')
+                out(u'theme_el[:0] = els')
+            self.compile_remove_parents(action, out)
+            out(u"log.debug(%s, '%%s the children of content %%s to the %%s of "
+                u"the theme element %%s%%s', %r, %s.format_tags(content_els), "
+                u"%r, %s.format_tag(theme_el), %r)", var, verb, var,
+                append and 'end' or 'beginning', var,
+                action.move and ' and removing the now-empty content element(s)'
+                or '')
+            return
+        out(u'parent = theme_el.getparent()')
+        out(u'pos = parent.index(theme_el)')
+        if content_type == 'elements':
+            self.compile_content_tails(action, out)
+            if append:
+                out(u'parent[pos+1:pos+1] = content_els')
+            else:
+                out(u'parent[pos:pos] = content_els')
+            out(u"log.debug(%s, '%%s content %%s %%s the theme element %%s', "
+                u"%r, %s.format_tags(content_els), %r, %s.format_tag(theme_el))",
+                var, verb, var, append and 'after' or 'before', var)
+            return
+        out(u'text, els = %s.prepare_content_children(content_els)', var)
+        if append:
+            out(u'add_tail(theme_el, text)')
+            out(u'parent[pos+1:pos+1] = content_els')
+        else:
+            out(u'if pos == 0:')
+            out(u'    add_text(parent, text)')
+            out(u'else:')
+            out(u'    add_tail(parent[pos-1], text)')
+            out(u'parent[pos:pos] = content_els')
+        self.compile_remove_parents(action, out)
+        out(u"log.debug(%s, '%%s the children of content %%s %%s the theme "
+            u"element %%s%%s', %r, %s.format_tags(content_els), %r, "
+            u"%s.format_tag(theme_el), %r)", var, verb, var,
+            append and 'after' or 'before', var,
+            action.move and ' and removing the now-empty content element(s)'
+            or '')
+
+    def compile_remove_parents(self, action, out):
+        if action.move:
+            out(u'for el in reversed(content_els):')
+            out(u'    move_tail_upwards(el)')
+            out(u'    el.getparent().remove(el)')
+
+    def compile_drop(self, action, var, out):
+        """Generates the body of a ``<drop>`` (see ``Drop._apply_drop``)"""
+        self.compile_if_content(action, var, out)
+        for doc, selector, attr, error, name in [
+            ('theme_doc', action.theme, 'theme', action.notheme, 'theme'),
+            ('content_doc', action.content, 'content', action.nocontent,
+             'content')]:
+            if selector is None:
+                continue
+            sel_type = _single_type(selector)
+            if sel_type not in ('elements', 'children'):
+                out(u'%s._apply_drop(%s, %s.%s, %r, %r, log, state)',
+                    var, doc, var, attr, str(error), name)
+                continue
+            out(u'sel_type, els, attributes = %s.select_elements(', var)
+            out(u'    %s.%s, %s, %r, state)', var, attr, doc, name == 'theme')
+            out(u'if not els:')
+            if error == 'abort':
+                out(u"    log.debug(%s, 'aborting %%s because no %%s element "
+                    u"matches rule %%s=\"%%s\"', %r, %r, %r, %s.%s)",
+                    var, name, name, name, var, attr)
+                out(u"    raise AbortTheme('No %s matches %s=\"%%s\"' %% %s.%s)",
+                    name, name, var, attr)
+            else:
+                out(u"    %s(%s, 'skipping rule because no %%s matches rule "
+                    u"%%s=\"%%s\"', %r, %r, %s.%s)",
+                    _log_method(error), var, name, name, var, attr)
+            out(u'else:')
+            out.indent += 1
+            if sel_type == 'elements':
+                out(u'for el in els:')
+                out(u'    move_tail_upwards(el)')
+                out(u'    el.getparent().remove(el)')
+                out(u"log.debug(%s, 'Dropping %%s %%s', %r, "
+                    u"%s.format_tags(els))", var, name, var)
+            else:
+                out(u'for el in els:')
+                out(u'    el[:] = []')
+                out(u"    el.text = ''")
+                out(u"log.debug(%s, 'Dropping the children of %%s %%s', %r, "
+                    u"%s.format_tags(els))", var, name, var)
+            if name == 'theme':
+                out(u'state.theme_modified(%r)', str(sel_type))
+            else:
+                out(u'state.content_modified(content_doc, %r)', str(sel_type))
+            out.indent -= 1
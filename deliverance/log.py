@@ -15,12 +15,39 @@ NOTIFY = (logging.INFO + logging.WARN) / 2
 
 logging.addLevelName(NOTIFY, 'NOTIFY')
 
+def format_message(msg, args, kw):
+    """Formats a message with the positional or keyword arguments given"""
+    if args:
+        return msg % args
+    elif kw:
+        return msg % kw
+    return msg
+
+# Messages with arguments of these types are formatted right away,
+# since the arguments might change before the message is read:
+_mutable_types = (list, dict, set, _Element)
+
 class SavingLogger(object):
     """
     Logger that saves all its messages locally.
+
+    Messages at or above `level` are kept.  Messages are only
+    formatted with their arguments when `messages` is read, which
+    usually never happens; callers can also check `enabled_for`
+    before building expensive arguments.
+
+    As the messages are only kept to be displayed, `make_log` uses a
+    `NullLogger` instead of this class for requests that can't see
+    the log.  Subclasses are left alone (they may do something else
+    with the messages), unless they set ``display_only = True``.
     """
-    def __init__(self, request, middleware):
-        self.messages = []
+
+    def __init__(self, request, middleware, level=logging.DEBUG):
+        self.level = level
+        # Formatted (level, el, msg):
+        self._messages = []
+        # (level, el, msg, args, kw) not yet formatted:
+        self._unformatted = []
         self.middleware = middleware
         self.request = request
         # This is writable:
@@ -28,14 +55,29 @@ class SavingLogger(object):
         # Also writable (list of (url, name))
         self.edit_urls = []
 
+    def enabled_for(self, level):
+        """True if messages at the given level are kept"""
+        return level >= self.level
+
+    @property
+    def messages(self):
+        """The list of ``(level, context_el, message)``"""
+        if self._unformatted:
+            for level, el, msg, args, kw in self._unformatted:
+                self._messages.append((level, el, format_message(msg, args, kw)))
+            self._unformatted = []
+        return self._messages
+
     def message(self, level, el, msg, *args, **kw):
         """Add one message at the given log level"""
-        if args:
-            msg = msg % args
-        elif kw:
-            msg = msg % kw
-        self.messages.append((level, el, msg))
-        return msg
+        if level < self.level:
+            return
+        for arg in args or kw.values():
+            if isinstance(arg, _mutable_types):
+                msg = format_message(msg, args, kw)
+                args = kw = ()
+                break
+        self._unformatted.append((level, el, msg, args, kw))
     def debug(self, el, msg, *args, **kw):
         """Log at the DEBUG level"""
         return self.message(logging.DEBUG, el, msg, *args, **kw)
@@ -207,11 +249,38 @@ class PrintingLogger(SavingLogger):
 
     def message(self, level, el, msg, *args, **kw):
         """Add one message at the given log level"""
-        msg = super(PrintingLogger, self).message(level, el, msg, *args, **kw)
+        super(PrintingLogger, self).message(level, el, msg, *args, **kw)
         if level >= self.print_level:
             if isinstance(el, _Element):
                 s = tostring(el)
             else:
                 s = str(el)
-            print '%s (%s)' % (msg, s)
-        return msg
+            print '%s (%s)' % (format_message(msg, args, kw), s)
+
+class NullLogger(SavingLogger):
+    """
+    Logger that keeps no messages, for requests whose log can't be
+    displayed anyway.
+    """
+
+    def enabled_for(self, level):
+        """No messages are kept"""
+        return False
+
+    def message(self, level, el, msg, *args, **kw):
+        """Discards the message"""
+
+def make_log(request, middleware, log_factory=SavingLogger, log_factory_kw=None):
+    """
+    Makes the log for a request.  If the messages of `log_factory`'s
+    loggers are only kept to be displayed (it is `SavingLogger`, or
+    has a true ``display_only`` attribute) but the request isn't
+    allowed to see the log (see
+    `deliverance.security.display_logging`), this is a `NullLogger`.
+    """
+    if ((log_factory is SavingLogger
+         or getattr(log_factory, 'display_only', False))
+        and 'deliverance.security_context' in request.environ
+        and not display_logging(request)):
+        return NullLogger(request, middleware)
+    return log_factory(request, middleware, **(log_factory_kw or {}))
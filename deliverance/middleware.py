@@ -3,6 +3,7 @@ Implements the middleware that does the Deliverance transformations.
 """
 
 import posixpath
+import threading
 import mimetypes
 import os
 import urllib
@@ -14,17 +15,21 @@ from webob import Request, Response
 from webob import exc
 from wsgiproxy.exactproxy import proxy_exact_request
 from pygments import highlight as pygments_highlight
-from pygments.lexers import XmlLexer, HtmlLexer
+from pygments.lexers import XmlLexer, HtmlLexer, PythonLexer
 from pygments.formatters import HtmlFormatter
-from tempita import HTMLTemplate, html
+from tempita import HTMLTemplate, html, html_quote
 from lxml.etree import _Element, XMLSyntaxError
 from lxml.html import fromstring, document_fromstring, tostring, Element
-from deliverance.log import SavingLogger
+from deliverance.log import SavingLogger, make_log
 from deliverance.security import display_logging, display_local_files, edit_local_files
+from deliverance.security import SecurityContext
+from deliverance.util.charset import is_utf8, iter_recode
 from deliverance.util.filetourl import url_to_filename
+from deliverance.util.normalize import normalize_response
 from deliverance.editor.editorapp import Editor
 from deliverance.rules import clientside_action
 from deliverance.ruleset import RuleSet
+from deliverance.selector import compiled_selectors
 
 
 __all__ = ['DeliveranceMiddleware', 
@@ -91,14 +96,16 @@ class DeliveranceMiddleware(object):
         if 'deliverance.log' in req.environ:
             log = req.environ['deliverance.log']
         else:
-            log = self.log_factory(req, self, **self.log_factory_kw)
+            log = make_log(req, self, self.log_factory, self.log_factory_kw)
             ## FIXME: should this be put in both the orig_req and this req?
             req.environ['deliverance.log'] = log
-        def resource_fetcher(url, retry_inner_if_not_200=False):
+        def resource_fetcher(url, retry_inner_if_not_200=False, headers=None):
             """
             Return the Response object for the given URL
             """
-            return self.get_resource(url, orig_req, log, retry_inner_if_not_200)
+            return self.get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                     headers=headers)
+        resource_fetcher.detached = self.detached_resource_fetcher(orig_req)
         if req.path_info_peek() == '.deliverance':
             req.path_info_pop()
             resp = self.internal_app(req, resource_fetcher)
@@ -107,11 +114,29 @@ class DeliveranceMiddleware(object):
         clientside = rule_set.check_clientside(req, log)
         if clientside and req.url in self.known_html:
             if req.cookies.get('jsEnabled'):
-                log.debug(self, 'Responding to %s with a clientside theme' % req.url)
+                log.debug(self, 'Responding to %s with a clientside theme', req.url)
                 return self.clientside_response(req, rule_set, resource_fetcher, log)(environ, start_response)
             else:
                 log.debug(self, 'Not doing clientside theming because jsEnabled cookie not set')
 
+        resp = None
+        if (req.method == 'GET' and not clientside
+            and 'deliv_log' not in req.GET):
+            early_head = rule_set.get_early_head(
+                req, resource_fetcher, log,
+                default_theme=self.default_theme(environ))
+            if early_head is not None:
+                # Only the status and headers of the content are
+                # needed before the theme head can be sent; its body
+                # is read afterwards:
+                resp = req.get_response(self.app)
+                if resp.status_int == 200 and resp.content_type == 'text/html':
+                    start_response('200 OK', self.early_flush_headers(resp))
+                    return self.iter_early_flush(
+                        req, rule_set, early_head, resp, resource_fetcher, log)
+                log.debug(self, 'Not sending the theme head early: the response is %s (%s)',
+                          resp.status, html_quote(resp.content_type or ''))
+
         head_response = None
         if req.method == "HEAD":
             # We need to copy the request instead of reusing it, 
@@ -120,7 +145,8 @@ class DeliveranceMiddleware(object):
             head_response = head_req.get_response(self.app)
             req.method = "GET"
 
-        resp = req.get_response(self.app)
+        if resp is None:
+            resp = req.get_response(self.app)
 
         ## FIXME: also XHTML?
         if resp.content_type != 'text/html':
@@ -139,32 +165,87 @@ class DeliveranceMiddleware(object):
         if resp.body == '':
             return resp(environ, start_response)
 
+        normalized = normalize_response(resp)
         if clientside and req.url not in self.known_html:
             log.debug(self, '%s would have been a clientside check; in future will be since we know it is HTML'
                       % req.url)
-            self.known_titles[req.url] = self._get_title(resp.body)
+            self.known_titles[req.url] = normalized.title
             self.known_html.add(req.url)
         resp = rule_set.apply_rules(req, resp, resource_fetcher, log, 
-                                    default_theme=self.default_theme(environ))
+                                    default_theme=self.default_theme(environ),
+                                    normalized=normalized)
         if clientside:
             resp.decode_content()
             resp.body = self._substitute_jsenable(resp.body)
         resp = log.finish_request(req, resp)
 
         if head_response:
+            # The page has to be serialized to know its length:
+            resp.content_length = len(resp.body)
             head_response.headers = resp.headers
             resp = head_response
 
         return resp(environ, start_response)
 
-    _title_re = re.compile(r'<title>(.*?)</title>', re.I|re.S)
+    # The content headers that don't apply to the themed page:
+    _early_flush_dropped_headers = [
+        'content-type', 'content-length', 'content-md5', 'content-encoding',
+        'content-range', 'etag']
 
-    def _get_title(self, body):
-        match = self._title_re.search(body)
-        if match:
-            return match.group(1)
+    def early_flush_headers(self, resp):
+        """
+        The headers to send along with the theme head, before the body
+        of the content response `resp` is read: the headers of the
+        content (like ``Set-Cookie`` and ``Cache-Control``), except
+        those describing its body.  The page is sent as UTF-8.
+        """
+        headers = [(name, value) for name, value in resp.headerlist
+                   if name.lower() not in self._early_flush_dropped_headers]
+        headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        return headers
+
+    def iter_early_flush(self, req, rule_set, early_head, resp,
+                         resource_fetcher, log):
+        """
+        Yields the theme head (`early_head`, from
+        `deliverance.ruleset.RuleSet.get_early_head`), and only then
+        reads the body of the content response `resp` (a 200 HTML
+        response whose headers have been sent with the head, see
+        `early_flush_headers`) and yields the rest of the themed page.
+
+        An empty content body is left out: the rest of the theme is
+        sent without it.  The page is sent as UTF-8, whatever the
+        charset of the content.
+        """
+        yield early_head.text
+        if not resp.body:
+            log.error(self, 'The response %s is empty, but the theme head has '
+                      'been sent; sending the theme without content', resp.status)
+            pieces = iter(early_head.theme_only())
         else:
-            return None
+            pieces = iter(rule_set.apply_rules(
+                req, resp, resource_fetcher, log, early_head=early_head).app_iter)
+            # The page is in the charset of the content:
+            if resp.charset and not is_utf8(resp.charset):
+                log.debug(self, 'Re-encoding the themed page from %s to UTF-8',
+                          resp.charset)
+                pieces = iter_recode(pieces, resp.charset)
+        start = []
+        length = 0
+        for piece in pieces:
+            start.append(piece)
+            length += len(piece)
+            if length >= len(early_head.text):
+                break
+        start = ''.join(start)
+        if not start.startswith(early_head.text):
+            log.error(self, 'The themed page does not start with the theme head '
+                      'that was sent')
+        yield start[len(early_head.text):]
+        for piece in pieces:
+            yield piece
+
+    _title_re = re.compile(r'<title>(.*?)</title>', re.I|re.S)
 
     _end_head_re = re.compile(r'</head>', re.I)
     _jsenable_js = '''\
@@ -198,27 +279,74 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             resp.md5_etag()
         return resp
 
+    def prewarm(self, rule_set, base_url, **security_settings):
+        """
+        Fetches and prepares the themes of `rule_set` (see
+        `deliverance.ruleset.RuleSet.prewarm`) before any request
+        needs them.  The themes are fetched like they would be for a
+        request to `base_url` (the URL this middleware is mounted
+        at), with a `deliverance.security.SecurityContext` made with
+        the given settings.  Returns the log.
+        """
+        req = Request.blank('/', base_url=base_url)
+        req.environ['deliverance.base_url'] = req.application_url
+        SecurityContext.install(req.environ, **security_settings)
+        log = self.log_factory(req, self, **self.log_factory_kw)
+        req.environ['deliverance.log'] = log
+        def resource_fetcher(url, retry_inner_if_not_200=False, headers=None):
+            return self.get_resource(url, req, log, retry_inner_if_not_200,
+                                     headers=headers)
+        rule_set.prewarm(resource_fetcher, req.application_url + '/', log)
+        return log
+
+    def detached_resource_fetcher(self, orig_req):
+        """
+        Returns a function that makes a ``(resource_fetcher, log)``
+        pair for fetching resources after the response to `orig_req`
+        is done (e.g., to revalidate a theme in the background).  The
+        resources are fetched with a new request that only keeps the
+        base URL and security context of `orig_req`, not its headers
+        or cookies.
+        """
+        application_url = orig_req.application_url
+        base_url = orig_req.environ.get('deliverance.base_url', application_url)
+        security_context = orig_req.environ.get('deliverance.security_context')
+        def detached():
+            req = Request.blank('/', base_url=application_url)
+            req.environ['deliverance.base_url'] = base_url
+            if security_context is not None:
+                req.environ['deliverance.security_context'] = security_context
+            log = self.log_factory(req, self, **self.log_factory_kw)
+            req.environ['deliverance.log'] = log
+            def resource_fetcher(url, retry_inner_if_not_200=False, headers=None):
+                return self.get_resource(url, req, log, retry_inner_if_not_200,
+                                         headers=headers)
+            return resource_fetcher, log
+        return detached
+
     def get_resource(self, url, orig_req, log,
                      retry_inner_if_not_200=False,
-                     redirections=5):
-        resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200)
+                     redirections=5, headers=None):
+        resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                  headers=headers)
         if not resp.status.startswith("3") or not resp.location:
             return resp
         max_redirections = redirections
         while redirections > 0:
             redirections = redirections - 1
-            log.debug(self, "Request for %s returned %s; following redirect Location: %s" % (
-                    url, resp.status, resp.location))
+            log.debug(self, "Request for %s returned %s; following redirect Location: %s",
+                      url, resp.status, resp.location)
             url = resp.location
-            resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200)
+            resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                      headers=headers)
             if not resp.status.startswith("3") or not resp.location:
                 return resp
-        log.debug(self, "Max redirects (%s) reached; returning response %s from %s" % (
-                max_redirections, url, resp.status))
+        log.debug(self, "Max redirects (%s) reached; returning response %s from %s",
+                  max_redirections, url, resp.status)
         return resp
 
     def _get_resource(self, url, orig_req, log,
-                      retry_inner_if_not_200=False):
+                      retry_inner_if_not_200=False, headers=None):
         """
         Gets the resource at the given url, using the original request
         `orig_req` as the basis for constructing the subrequest.
@@ -233,6 +361,11 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
         described above, non-200 responses from the inner app will be tossed
         out, and the request will be retried as an external http request.
         Currently this is used only by RuleSet.get_theme
+
+        If `headers` is given, those headers are added to HTTP
+        subrequests, replacing any conditional headers (like
+        ``If-None-Match``) the original request had.  This is used for
+        conditional GETs of cached themes.
         """
         assert url is not None
         if url.lower().startswith('file:'):
@@ -271,6 +404,11 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             assert new_path_info.startswith('/')
             subreq.path_info = new_path_info
             subreq.query_string = query_string
+            if headers is not None:
+                for name in self._conditional_headers:
+                    if name in subreq.headers:
+                        del subreq.headers[name]
+                subreq.headers.update(headers)
             subresp = subreq.get_response(self.app)
             ## FIXME: error if not HTML?
             ## FIXME: handle redirects?
@@ -294,11 +432,19 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             
         ## FIXME: pluggable subrequest handler?
         subreq = self.build_external_subrequest(url, orig_req, log)
+        if headers is not None:
+            for name in self._conditional_headers:
+                if name in subreq.headers:
+                    del subreq.headers[name]
+            subreq.headers.update(headers)
         subresp = subreq.get_response(proxy_exact_request)
         log.debug(self, 'External request for %s: %s content-type: %s',
                   url, subresp.status, subresp.content_type)
         return subresp
 
+    _conditional_headers = ['If-None-Match', 'If-Modified-Since',
+                            'If-Match', 'If-Unmodified-Since', 'If-Range']
+
     def build_external_subrequest(self, url, orig_req, log):
         """
         Returns a webob.Request to be used when Deliverance is getting
@@ -426,6 +572,28 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
         app = Editor(filename=filename, force_syntax='delivxml', title='rule file %s' % os.path.basename(filename))
         return app
 
+    def action_transforms(self, req, resource_fetcher):
+        """
+        Shows the Python source of the transforms the rules have been
+        compiled into (with ``<ruleset engine="compiled">``).
+        """
+        rule_set = self.rule_getter(resource_fetcher, self.app, req)
+        formatter = HtmlFormatter(linenos=True)
+        body = []
+        for transform in rule_set.compiled_transforms():
+            body.append('<h2 id="%s">%s</h2>\n<p>%s</p>\n%s' % (
+                    transform.name, transform.name, html_quote(repr(transform)),
+                    pygments_highlight(transform.source, PythonLexer(),
+                                       formatter)))
+        if not body:
+            body.append('<p>No rules have been compiled (yet).</p>')
+        text = ('<html><head><title>Compiled transforms</title>'
+                '<style type="text/css">%s</style></head><body>'
+                '<h1>Compiled transforms of %s</h1>\n%s</body></html>' % (
+                formatter.get_style_defs('.highlight'),
+                html_quote(rule_set.source_location), '\n'.join(body)))
+        return Response(text.encode('utf8'))
+
     def view_source(self, req, resp, url):
         """
         View the highlighted source (from `action_view`).
@@ -667,6 +835,36 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
 
     action_subreq.exposed = True
 
+    def action_status(self, req, resource_fetcher):
+        """
+        Reports (as JSON) whether the rules are loaded and their themes
+        prewarmed; responds with ``503 Service Unavailable`` while a
+        prewarm is pending.  Only people who can view the log get the
+        prewarmed themes, the errors and the selector cache.
+        """
+        rule_set = self.rule_getter(resource_fetcher, self.app, req)
+        prewarm = rule_set.prewarm_state
+        status = {
+            'ready': prewarm != 'pending',
+            'prewarm': prewarm,
+            }
+        if display_logging(req):
+            status.update({
+                'themes': rule_set.prewarmed,
+                'errors': [{'url': url, 'message': message}
+                           for url, message in rule_set.prewarm_errors],
+                'reloading': bool(req.environ.get('deliverance.reloading')),
+                'selector_cache': {'selectors': len(compiled_selectors),
+                                   'hits': compiled_selectors.hits,
+                                   'misses': compiled_selectors.misses},
+                })
+        resp = Response(simplejson.dumps(status), content_type='application/json')
+        if not status['ready']:
+            resp.status = 503
+        return resp
+
+    action_status.exposed = True
+
 fp = open(os.path.join(os.path.dirname(__file__), 'media', 'clientside.js'))
 CLIENTSIDE_JAVASCRIPT = fp.read()
 del fp
@@ -717,8 +915,18 @@ class FileRuleGetter(object):
     This reads the rules from a file.
 
     If always_reload=True, the file will be re-read on every request.
+
+    If `prewarm` is given, it is called with each newly loaded
+    `RuleSet` before it replaces the old one (e.g., to fetch its
+    themes with `DeliveranceMiddleware.prewarm`).  Reloaded rules
+    keep using the themes cached by the old rules.  The rules loaded
+    first can be prewarmed while they already serve requests, with
+    `prewarm_in_background`.  Rules are not prewarmed with
+    always_reload=True, as they would be on every request.
     """
 
+    ruleset = None
+
     def load_rules(self):
         filename = self.filename
 
@@ -732,13 +940,36 @@ class FileRuleGetter(object):
             'Bad rule tag <%s> in document %s' % (doc.tag, filename))
         assert doc.tag == 'ruleset', (
             'Bad rule tag <%s> in document %s' % (doc.tag, filename))
-        self.ruleset = RuleSet.parse_xml(doc, filename)
+        if self.ruleset is not None:
+            theme_cache = self.ruleset.theme_cache
+        else:
+            theme_cache = None
+        ruleset = RuleSet.parse_xml(doc, filename, theme_cache=theme_cache)
+        if self.prewarm is not None and not self.always_reload:
+            self.prewarm(ruleset)
+        self.ruleset = ruleset
         
-    def __init__(self, filename, always_reload=False):
+    def __init__(self, filename, always_reload=False, prewarm=None):
         self.filename = filename
         self.always_reload = always_reload
+        self.prewarm = prewarm
         self.load_rules()
 
+    def prewarm_in_background(self):
+        """
+        Prewarms the current rules in a background thread, while they
+        serve requests.  Until that is done the rules are reported as
+        not ready (see ``RuleSet.prewarm_state``).  Returns the thread.
+        """
+        ruleset = self.ruleset
+        ruleset.prewarming = True
+        thread = threading.Thread(
+            target=self.prewarm, args=(ruleset,),
+            name='Deliverance prewarm %s' % self.filename)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
     def __call__(self, get_resource, app, orig_req):
         if self.always_reload:
             self.load_rules()
@@ -751,7 +982,8 @@ def make_deliverance_middleware(app, global_conf,
                                 rule_uri=None, rule_filename=None,
                                 theme_uri=None,
                                 debug=None,
-                                execute_pyref=None):
+                                execute_pyref=None,
+                                prewarm_base_url=None):
 
     assert sum([bool(x) for x in [rule_uri, rule_filename]]) == 1, (
         "You must give one, and only one, of rule_uri or rule_filename")
@@ -773,6 +1005,17 @@ def make_deliverance_middleware(app, global_conf,
 
     app = DeliveranceMiddleware(app, rule_getter, default_theme=theme_uri)
 
+    if (prewarm_base_url and isinstance(rule_getter, FileRuleGetter)
+        and not rule_getter.always_reload):
+        deliverator = app
+        security_settings = dict(
+            display_local_files=debug, display_logging=debug,
+            execute_pyref=execute_pyref)
+        def prewarm(ruleset):
+            deliverator.prewarm(ruleset, prewarm_base_url, **security_settings)
+        rule_getter.prewarm = prewarm
+        rule_getter.prewarm_in_background()
+
     app = security.SecurityContext.middleware(
         app,
         display_local_files=debug, display_logging=debug,
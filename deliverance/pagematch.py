@@ -2,11 +2,14 @@
 Handles the <match> tag and matching requests and responses against these patterns.
 """
 
+import logging
 from deliverance.exceptions import DeliveranceSyntaxError, AbortTheme
-from deliverance.stringmatch import compile_matcher, compile_header_matcher
+from deliverance.stringmatch import compile_matcher, compile_header_matcher, PatternIndex
+from deliverance.stringmatch import HeaderWildcardMatcher
 from deliverance.util.converters import asbool, html_quote
 from deliverance.pyref import PyReference
 from deliverance.security import execute_pyref
+from deliverance.util.lru import LRUCache
 
 class AbstractMatch(object):
     """
@@ -110,38 +113,62 @@ class AbstractMatch(object):
         """Override to control the way this object displays in debugging contexts"""
         raise NotImplementedError
 
+    def is_request_only(self):
+        """
+        True if this only looks at the request (so it can be checked
+        before there is a response).
+        """
+        return not (self.response_header or self.response_status or self.pyref)
+
     def log_context(self):
         """The return value is used for the context to ``log.debug()`` etc methds"""
         return self
 
-    def __call__(self, request, resp, response_headers, log):
+    def __call__(self, request, resp, response_headers, log, facts=None):
         """
         Checks this match against the given request and
         response_headers object.
 
         `response_headers` should be a case-insensitive dictionary.
-        `request` should be a :class:webob.Request object.
+        `request` should be a :class:webob.Request object.  `facts`
+        is the `RequestFacts` for the request, if the caller has them.
+        """
+        if facts is None:
+            facts = RequestFacts(request)
+        if self.path and not self.path(facts.path):
+            return self.skip_path(facts, log)
+        if self.domain and not self.domain(facts.host):
+            return self.skip_domain(facts, log)
+        return self.match_rest(request, resp, response_headers, log, facts)
+
+    def skip_path(self, facts, log):
+        """Logs that the request path doesn't match path=, returning False"""
+        if log.enabled_for(logging.DEBUG):
+            log.debug(
+                self.log_context(), 'Skipping %s because request URL (%s) does not '
+                'match path="%s"',
+                self.debug_description(), facts.path, self.path)
+        return False
+
+    def skip_domain(self, facts, log):
+        """Logs that the request host doesn't match domain=, returning False"""
+        if log.enabled_for(logging.DEBUG):
+            log.debug(
+                self.log_context(), 'Skipping %s because request domain (%s) does '
+                'not match domain="%s"',
+                self.debug_description(), facts.host, self.domain)
+        return False
+
+    def match_rest(self, request, resp, response_headers, log, facts):
+        """
+        Checks everything but path= and domain= (which the caller has
+        already checked), like `__call__`
         """
         result = True
         debug_name = self.debug_description()
         debug_context = self.log_context()
-        if self.path:
-            if not self.path(request.path):
-                log.debug(
-                    debug_context, 'Skipping %s because request URL (%s) does not '
-                    'match path="%s"',
-                    debug_name, request.path, self.path)
-                return False
-        if self.domain:
-            host = request.host.split(':', 1)[0]
-            if not self.domain(host):
-                log.debug(
-                    debug_context, 'Skipping %s because request domain (%s) does '
-                    'not match domain="%s"',
-                    debug_name, host, self.domain)
-                return False
         if self.request_header:
-            result, headers = self.request_header(request.headers)
+            result, headers = self.request_header(facts.headers)
             if not result:
                 log.debug(
                     debug_context, 'Skipping %s because request headers %s do not '
@@ -269,13 +296,329 @@ class ClientsideMatch(AbstractMatch):
         """Description for debugging messages"""
         return ''
 
+class RequestFacts(object):
+    """
+    The parts of a request that match objects look at, worked out
+    once for all of them.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.path = request.path
+        self.host = request.host.split(':', 1)[0]
+        self._headers = None
+
+    @property
+    def headers(self):
+        """The request headers, as a `RequestHeaders` (read when first used)"""
+        if self._headers is None:
+            self._headers = RequestHeaders(self.request.headers)
+        return self._headers
+
+class RequestHeaders(object):
+    """
+    A copy of the request headers, so they are only read out of the
+    environ once.  Lookups ignore case, like the headers copied.
+    """
+
+    def __init__(self, headers):
+        self.names = []
+        self.values = {}
+        for name, value in headers.items():
+            self.names.append(name)
+            self.values[name.lower()] = value
+
+    def get(self, name, default=None):
+        return self.values.get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return self.values[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self.values
+
+    def __iter__(self):
+        return iter(self.names)
+
+class MatchIndex(object):
+    """
+    The ``<match>`` objects of a ruleset, with their path= and
+    domain= patterns indexed (see
+    `deliverance.stringmatch.PatternIndex`) so the matches that can't
+    apply to a request are passed over without checking each one.
+
+    The classes found are cached (up to `cache_size` results), keyed
+    by the parts of the request and response that the matches look at
+    (see `cache_key`).  When the classes come from the cache, the
+    messages logged when they were found are logged again.
+
+    Use it in place of the list of match objects with `run_matches`;
+    the result, and what is logged, is the same.  Unless debug
+    messages are logged (saying why each match was skipped), only the
+    matches whose path= and domain= patterns fit the request (see
+    `candidates`) are looked at.
+    """
+
+    def __init__(self, matchers, cache_size=1000):
+        self.matchers = list(matchers)
+        self.path_index = PatternIndex([m.path for m in self.matchers])
+        self.domain_index = PatternIndex([m.domain for m in self.matchers])
+        # What the matches look at, for cache_key:
+        self.uses_path = True in [bool(m.path) for m in self.matchers]
+        self.uses_host = True in [bool(m.domain) for m in self.matchers]
+        self.uses_status = True in [bool(m.response_status) for m in self.matchers]
+        self.request_headers = _distinct_headers(
+            [m.request_header for m in self.matchers], ignore_case=True)
+        self.response_headers = _distinct_headers(
+            [m.response_header for m in self.matchers], ignore_case=True)
+        self.environ_keys = _distinct_headers(
+            [m.environ for m in self.matchers], ignore_case=False)
+        self.pyref_positions = [
+            pos for pos, m in enumerate(self.matchers) if m.pyref]
+        # The matches that any path (or host) fits:
+        self.any_path = frozenset([
+            pos for pos, m in enumerate(self.matchers) if not m.path])
+        self.any_host = frozenset([
+            pos for pos, m in enumerate(self.matchers) if not m.domain])
+        if cache_size:
+            self.cache = LRUCache(max_entries=cache_size)
+        else:
+            self.cache = None
+
+    def __iter__(self):
+        return iter(self.matchers)
+
+    def __len__(self):
+        return len(self.matchers)
+
+    def __unicode__(self):
+        return u'<match> index (%i matches)' % len(self.matchers)
+
+    def __str__(self):
+        return unicode(self).encode('utf8')
+
+    def run(self, request, resp, response_headers, log):
+        """
+        Returns the list of matched classes, like `run_matches`
+        """
+        facts = RequestFacts(request)
+        path_matches = self.path_index.matches(facts.path)
+        domain_matches = self.domain_index.matches(facts.host)
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(facts, resp, response_headers,
+                                 path_matches, domain_matches)
+        if key is None:
+            return _apply_matching(
+                self._iter_matching(request, resp, response_headers, log,
+                                    facts, path_matches, domain_matches),
+                len(self.matchers), log)
+        recording = log.enabled_for(logging.DEBUG)
+        if recording:
+            # Results whose messages weren't kept (nothing was logging
+            # them when the classes were found) count as a miss:
+            cached = self.cache.get(key, usable=_messages_kept)
+        else:
+            cached = self.cache.get(key)
+        if cached is not None:
+            classes, calls = cached
+            for method, el, msg, args in calls or ():
+                getattr(log, method)(el, msg, *args)
+            self._log_hit_ratio(log, 'found in')
+            if classes is None:
+                raise AbortTheme('<match> matched request, aborting')
+            return list(classes)
+        if recording:
+            match_log = _RecordingLogger(log)
+        else:
+            match_log = log
+        try:
+            classes = _apply_matching(
+                self._iter_matching(request, resp, response_headers, match_log,
+                                    facts, path_matches, domain_matches),
+                len(self.matchers), match_log)
+        except AbortTheme:
+            classes = None
+        if recording:
+            calls = match_log.calls
+        else:
+            calls = None
+        if classes is None:
+            self.cache.set(key, (None, calls))
+            self._log_hit_ratio(log, 'added to')
+            raise AbortTheme('<match> matched request, aborting')
+        self.cache.set(key, (tuple(classes), calls))
+        self._log_hit_ratio(log, 'added to')
+        return classes
+
+    def iter_matching(self, request, resp, response_headers, log):
+        """
+        Yields ``(position, matcher, result)`` for each match object in
+        order, where result is what calling the matcher would return.
+        The matchers are only checked as the results are used, so the
+        caller can stop at any point.  This doesn't use the cache.
+
+        Unless `log` is logging debug messages, the matches that
+        aren't `candidates` (which would return False) are left out.
+        """
+        return self._iter_matching(
+            request, resp, response_headers, log, RequestFacts(request))
+
+    def cache_key(self, facts, resp, response_headers,
+                  path_matches, domain_matches):
+        """
+        The key for the classes of a request in the cache: the parts
+        of the request and response that the matches look at.  This
+        is None if the classes can't be cached, because a match with a
+        pyref might be run.
+        """
+        for pos in self.pyref_positions:
+            matcher = self.matchers[pos]
+            if ((not matcher.path or path_matches(pos))
+                and (not matcher.domain or domain_matches(pos))):
+                return None
+        key = [self.uses_path and facts.path,
+               self.uses_host and facts.host]
+        if self.request_headers:
+            key.append(_header_facts(self.request_headers, facts.headers))
+        if self.environ_keys:
+            key.append(_header_facts(self.environ_keys, facts.request.environ))
+        if self.response_headers:
+            key.append(_header_facts(self.response_headers, response_headers))
+        if self.uses_status:
+            key.append(resp is not None and resp.status_int)
+        key = tuple(key)
+        try:
+            hash(key)
+        except TypeError:
+            # Some environ values can't be hashed
+            return None
+        return key
+
+    def candidates(self, facts):
+        """
+        The sorted positions of the matches whose path= and domain=
+        (if any) fit the request of the `RequestFacts`.
+        """
+        positions = self.path_index.matching(facts.path) | self.any_path
+        positions &= self.domain_index.matching(facts.host) | self.any_host
+        return sorted(positions)
+
+    def _iter_matching(self, request, resp, response_headers, log,
+                       facts, path_matches=None, domain_matches=None):
+        if not log.enabled_for(logging.DEBUG):
+            # Nothing is said about the matches that are skipped
+            matchers = self.matchers
+            for pos in self.candidates(facts):
+                yield pos, matchers[pos], matchers[pos].match_rest(
+                    request, resp, response_headers, log, facts)
+            return
+        if path_matches is None:
+            path_matches = self.path_index.matches(facts.path)
+            domain_matches = self.domain_index.matches(facts.host)
+        for pos, matcher in enumerate(self.matchers):
+            if matcher.path and not path_matches(pos):
+                classes = matcher.skip_path(facts, log)
+            elif matcher.domain and not domain_matches(pos):
+                classes = matcher.skip_domain(facts, log)
+            else:
+                classes = matcher.match_rest(
+                    request, resp, response_headers, log, facts)
+            yield pos, matcher, classes
+
+    def _log_hit_ratio(self, log, action):
+        lookups = self.cache.hits + self.cache.misses
+        log.debug(self, 'Page classes %s the cache (%i%% of %i lookups were hits)',
+                  action, 100 * self.cache.hits // lookups, lookups)
+
+def _distinct_headers(header_matchers, ignore_case):
+    """
+    The header (or environ) matchers from the list that look at
+    different headers
+    """
+    result = []
+    seen = set()
+    for matcher in header_matchers:
+        if matcher is None:
+            continue
+        header = matcher.header
+        if ignore_case:
+            header = header.lower()
+        if (matcher.__class__, header) not in seen:
+            seen.add((matcher.__class__, header))
+            result.append(matcher)
+    return result
+
+def _header_facts(header_matchers, headers):
+    """
+    The values in `headers` that the header matchers look at
+    """
+    facts = []
+    for matcher in header_matchers:
+        if isinstance(matcher, HeaderWildcardMatcher):
+            facts.append(tuple([
+                (name, headers[name]) for name in headers
+                if matcher.header_re.match(name)]))
+        else:
+            facts.append(headers.get(matcher.header, ''))
+    return tuple(facts)
+
+def _messages_kept(cached):
+    """
+    True if the log messages of a cached ``(classes, calls)`` result
+    were recorded
+    """
+    return cached[1] is not None
+
+class _RecordingLogger(object):
+    """
+    Passes messages on to a logger, keeping them to be logged again
+    when a cached result is used.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.calls = []
+
+    def enabled_for(self, level):
+        return self.log.enabled_for(level)
+
+    def _record(method):
+        def record(self, el, msg, *args):
+            self.calls.append((method, el, msg, args))
+            return getattr(self.log, method)(el, msg, *args)
+        record.__name__ = method
+        return record
+
+    debug = _record('debug')
+    info = _record('info')
+    notify = _record('notify')
+    warn = _record('warn')
+    error = _record('error')
+    fatal = _record('fatal')
+    del _record
+
 def run_matches(matchers, request, resp, response_headers, log):
     """
-    Runs all the match objects in matchers, returning the list of matched classes.
+    Runs all the match objects in matchers (a list, or a
+    `MatchIndex`), returning the list of matched classes.
+    """
+    if isinstance(matchers, MatchIndex):
+        return matchers.run(request, resp, response_headers, log)
+    facts = RequestFacts(request)
+    matching = (
+        (pos, matcher, matcher(request, resp, response_headers, log, facts))
+        for pos, matcher in enumerate(matchers))
+    return _apply_matching(matching, len(matchers), log)
+
+def _apply_matching(matching, count, log):
+    """
+    Collects the classes from `matching` (``(position, matcher,
+    classes)`` for `count` matchers, as the matchers are called),
+    stopping for ``last`` and raising AbortTheme for ``abort``.
     """
     results = []
-    for matcher in matchers:
-        classes = matcher(request, resp, response_headers, log)
+    for pos, matcher, classes in matching:
         if classes:
             if matcher.abort:
                 log.debug(matcher, '<match> matched request, aborting')
@@ -287,6 +630,6 @@ def run_matches(matchers, request, resp, response_headers, log):
                     results.append(item)
             if matcher.last:
                 log.debug(matcher, 'Stopping matches (skipping %i matches)',
-                          len(matchers) - matchers.index(matcher) - 1)
+                          count - pos - 1)
                 return results
     return results
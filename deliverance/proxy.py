@@ -17,18 +17,20 @@ from tempita import html_quote
 from paste.fileapp import FileApp
 from paste.deploy import loadwsgi
 from lxml.etree import tostring as xml_tostring, Comment, parse
-from lxml.html import document_fromstring, tostring
+from lxml.html import tostring
 from deliverance.exceptions import DeliveranceSyntaxError, AbortProxy
-from deliverance.pagematch import AbstractMatch
+from deliverance.pagematch import AbstractMatch, MatchIndex
 from deliverance.util.converters import asbool
 from deliverance.middleware import DeliveranceMiddleware
 from deliverance.ruleset import RuleSet
-from deliverance.log import SavingLogger
+from deliverance.log import make_log
 from deliverance.util.uritemplate import uri_template_substitute
 from deliverance.util.nesteddict import NestedDict
 from deliverance.security import execute_pyref, edit_local_files
 from deliverance.pyref import PyReference
+from deliverance.stringmatch import compile_matcher
 from deliverance.util.filetourl import filename_to_url, url_to_filename
+from deliverance.util.normalize import parse_html
 from deliverance.util.urlnormalize import url_normalize
 from deliverance.editor.editorapp import Editor
 
@@ -44,6 +46,14 @@ class ProxySet(object):
         self.proxies = proxies
         self.ruleset = ruleset
         self.source_location = source_location
+        # The proxies' matches, indexed by path and domain:
+        self.match_index = MatchIndex(
+            [proxy.match for proxy in proxies], cache_size=0)
+        # (position, editor path, name) for each editable proxy:
+        self.editors = [
+            (index, '/.deliverance/proxy-editor/%s/' % (index+1),
+             proxy.editable_name)
+            for index, proxy in enumerate(proxies) if proxy.editable]
 
         middleware_factory = middleware_factory or DeliveranceMiddleware
         middleware_factory_kwargs = middleware_factory_kwargs or {}
@@ -53,13 +63,14 @@ class ProxySet(object):
     @classmethod
     def parse_xml(cls, el, source_location, 
                   middleware_factory=None,
-                  middleware_factory_kwargs=None):
+                  middleware_factory_kwargs=None,
+                  theme_cache=None):
         """Parse an instance from an XML/etree element"""
         proxies = []
         for child in el:
             if child.tag == 'proxy':
                 proxies.append(Proxy.parse_xml(child, source_location))
-        ruleset = RuleSet.parse_xml(el, source_location)
+        ruleset = RuleSet.parse_xml(el, source_location, theme_cache=theme_cache)
         return cls(proxies, ruleset, source_location, 
                    middleware_factory=middleware_factory,
                    middleware_factory_kwargs=middleware_factory_kwargs)
@@ -67,7 +78,8 @@ class ProxySet(object):
     @classmethod
     def parse_file(cls, filename,
                    middleware_factory=None,
-                   middleware_factory_kwargs=None):
+                   middleware_factory_kwargs=None,
+                   theme_cache=None):
         """Parse this from a filname"""
         file_url = filename_to_url(filename)
         file = open(filename)
@@ -77,7 +89,17 @@ class ProxySet(object):
         tree.xinclude()
         return cls.parse_xml(el, file_url, 
                              middleware_factory=middleware_factory,
-                             middleware_factory_kwargs=middleware_factory_kwargs)
+                             middleware_factory_kwargs=middleware_factory_kwargs,
+                             theme_cache=theme_cache)
+
+    def prewarm(self, base_url, **security_settings):
+        """
+        Fetches and prepares the themes of the ruleset (see
+        `DeliveranceMiddleware.prewarm`), with the proxies serving any
+        themes that are internal to `base_url`.  Returns the log.
+        """
+        return self.deliverator.prewarm(self.ruleset, base_url,
+                                        **security_settings)
 
     def proxy_app(self, environ, start_response):
         """Implements the proxy, finding the matching `Proxy` object and
@@ -85,27 +107,43 @@ class ProxySet(object):
         """
         request = Request(environ)
         log = environ['deliverance.log']
-        for index, proxy in enumerate(self.proxies):
-            if proxy.editable:
-                url = request.application_url + '/.deliverance/proxy-editor/%s/' % (index+1)
-                name = proxy.editable_name
-                if (url, name) not in log.edit_urls:
-                    log.edit_urls.append((url, name))
-            ## FIXME: obviously this is wonky:
-            if proxy.match(request, None, None, log):
+        next_editor = 0
+        ## FIXME: obviously this is wonky:
+        for index, match, matched in self.match_index.iter_matching(
+            request, None, None, log):
+            if matched:
+                next_editor = self._add_edit_urls(
+                    request, log, next_editor, index)
                 try:
-                    return proxy.forward_request(environ, start_response)
+                    return match.proxy.forward_request(environ, start_response)
                 except AbortProxy, e:
                     log.debug(
                         self, '<proxy> aborted (%s), trying next proxy' % e)
                     continue
                 ## FIXME: should also allow for AbortTheme?
+        self._add_edit_urls(request, log, next_editor, len(self.proxies))
         log.error(
             self, 'No proxy matched the request; aborting with a 404 Not Found error')
         ## FIXME: better error handling would be nice:
         resp = exc.HTTPNotFound()
         return resp(environ, start_response)
 
+    def _add_edit_urls(self, request, log, next_editor, position):
+        """
+        Adds the editor URLs of the editable proxies up to `position`
+        to the log, starting from ``self.editors[next_editor]`` (those
+        before it have been added already).  Returns the index of the
+        next editor to add.
+        """
+        while (next_editor < len(self.editors)
+               and self.editors[next_editor][0] <= position):
+            index, path, name = self.editors[next_editor]
+            url = request.application_url + path
+            if (url, name) not in log.edit_urls:
+                log.edit_urls.append((url, name))
+            next_editor += 1
+        return next_editor
+
     def rule_getter(self, get_resource, app, orig_req):
         """The rule getter for this (since the rules are parsed and intrinsic,
         this doesn't really *get* anything)"""
@@ -116,7 +154,7 @@ class ProxySet(object):
         the proxies itself.
         """
         req = Request(environ)
-        log = SavingLogger(req, self.deliverator)
+        log = make_log(req, self.deliverator)
         req.environ['deliverance.log'] = log
         if req.path_info.startswith('/.deliverance/proxy-editor/'):
             req.path_info_pop()
@@ -319,13 +357,13 @@ class Proxy(object):
         dest, wsgiapp = None, None
         if self.dest:
             dest = self.dest(request, log)
-            log.debug(self, '<proxy> matched; forwarding request to %s' % dest)
+            log.debug(self, '<proxy> matched; forwarding request to %s', dest)
         else:
             wsgi_app = self.wsgi(request, log)
-            log.debug(self, '<proxy> matched; forwarding request to %s' % wsgi_app)
+            log.debug(self, '<proxy> matched; forwarding request to %s', wsgi_app)
 
         if self.classes:
-            log.debug(self, 'Adding class="%s" to page' % ' '.join(self.classes))
+            log.debug(self, 'Adding class="%s" to page', ' '.join(self.classes))
             existing_classes = request.environ.setdefault('deliverance.page_classes', [])
             existing_classes.extend(self.classes)
 
@@ -757,16 +795,19 @@ class ProxyResponseModification(object):
                     'Not rewriting links in response from %s, because Content-Type is %s'
                     % (proxied_url, response.content_type))
             else:
-                if not response.charset:
-                    ## FIXME: maybe we should guess the encoding?
-                    body = response.body
-                else:
-                    body = response.unicode_body
+                ## FIXME: maybe we should guess the encoding if there's
+                ## no charset?
+                charset = response.charset
+                body = response.body
                 if len(body) > 0:
-                    body_doc = document_fromstring(body, base_url=proxied_url)
+                    # lxml decodes and encodes the body itself:
+                    body_doc = parse_html(body, proxied_url, charset)
                     body_doc.make_links_absolute()
                     body_doc.rewrite_links(link_repl_func)
-                    response.body = tostring(body_doc)
+                    try:
+                        response.body = tostring(body_doc, encoding=charset)
+                    except LookupError:
+                        response.body = tostring(body_doc)
             if response.location:
                 ## FIXME: if you give a proxy like
                 ## http://openplans.org, and it redirects to
@@ -804,7 +845,8 @@ class ProxySettings(object):
                  dev_expiration=0, dev_secret_file='/tmp/deliverance/devauth.txt',
                  source_location=None,
                  middleware_factory=None,
-                 middleware_factory_kwargs=None):
+                 middleware_factory_kwargs=None,
+                 sites=None, site_idle_timeout=3600):
         self.server_host = server_host
         self.execute_pyref = execute_pyref
         self.display_local_files = display_local_files
@@ -819,6 +861,11 @@ class ProxySettings(object):
 
         self.middleware_factory = middleware_factory
         self.middleware_factory_kwargs = middleware_factory_kwargs
+        # [(domain matcher, rule filename)] from <site>:
+        self.sites = sites or []
+        # Seconds a site's rules are kept without any requests (0 for
+        # forever):
+        self.site_idle_timeout = site_idle_timeout
 
     @classmethod
     def parse_xml(cls, el, source_location, environ=None, traverse=False):
@@ -848,6 +895,8 @@ class ProxySettings(object):
         dev_expiration = 0
         dev_users = {}
         dev_secret_file = os.path.join(tempfile.gettempdir(), 'deliverance', 'devauth.txt')
+        sites = []
+        site_idle_timeout = 3600
         for child in el:
             if child.tag is Comment:
                 continue
@@ -885,6 +934,23 @@ class ProxySettings(object):
                 dev_users[username] = password
             elif child.tag == 'dev-secret-file':
                 dev_secret_file = cls.substitute(child.text, environ)
+            elif child.tag == 'site':
+                domain = cls.substitute(child.get('domain', ''), environ)
+                rules = cls.substitute(child.get('rules', ''), environ)
+                if not domain or not rules:
+                    raise DeliveranceSyntaxError(
+                        "<site> must have both a domain and rules attribute",
+                        element=child)
+                rules = os.path.join(
+                    os.path.dirname(url_to_filename(source_location)), rules)
+                if not os.path.exists(rules):
+                    raise DeliveranceSyntaxError(
+                        '<site domain="%s"> has a rule file that does not exist: %s'
+                        % (domain, rules),
+                        element=child)
+                sites.append((compile_matcher(domain, 'wildcard-insensitive'), rules))
+            elif child.tag == 'site-idle-timeout':
+                site_idle_timeout = int(cls.substitute(child.text, environ))
             elif child.tag == 'middleware-factory':
                 ref = PyReference.parse_xml(child, source_location)
                 middleware_factory = ref.function
@@ -910,7 +976,8 @@ class ProxySettings(object):
                    source_location=source_location,
                    dev_secret_file=dev_secret_file,
                    middleware_factory=middleware_factory,
-                   middleware_factory_kwargs=middleware_factory_kwargs)
+                   middleware_factory_kwargs=middleware_factory_kwargs,
+                   sites=sites, site_idle_timeout=site_idle_timeout)
 
     @classmethod
     def parse_file(cls, filename):
@@ -946,6 +1013,13 @@ class ProxySettings(object):
             host += ':%s' % self.port
         return 'http://' + host
 
+    @property
+    def security_settings(self):
+        """The arguments for `deliverance.security.SecurityContext`"""
+        return dict(execute_pyref=self.execute_pyref,
+                    display_local_files=self.display_local_files,
+                    edit_local_files=self.edit_local_files)
+
     @staticmethod
     def substitute(template, environ):
         """Substitute the given template with the given environment"""
@@ -953,6 +1027,17 @@ class ProxySettings(object):
             return template
         return string.Template(template).substitute(environ)
 
+    def site_for_host(self, host):
+        """
+        The rule filename of the first ``<site>`` whose domain matches
+        `host` (which may include a port), or None
+        """
+        host = host.split(':', 1)[0]
+        for domain, rules in self.sites:
+            if domain(host):
+                return rules
+        return None
+
     def middleware(self, app):
         """
         Wrap the given application in an appropriate DevAuth and Security instance
@@ -963,9 +1048,7 @@ class ProxySettings(object):
             password_checker = self.check_password
         else:
             password_checker = None
-        app = SecurityContext.middleware(app, execute_pyref=self.execute_pyref,
-                                         display_local_files=self.display_local_files,
-                                         edit_local_files=self.edit_local_files)
+        app = SecurityContext.middleware(app, **self.security_settings)
         if password_checker is None and not self.dev_htpasswd:
             ## FIXME: warn here?
             return app
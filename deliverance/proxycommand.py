@@ -3,8 +3,10 @@
 import sys
 import os
 import optparse
+import threading
+import time
 from paste.httpserver import serve
-from pkg_resources import get_distribution
+from pkg_resources import get_distribution, DistributionNotFound
 from deliverance.proxy import ProxySet
 from deliverance.proxy import ProxySettings
 
@@ -12,7 +14,11 @@ description = """\
 Starts up a proxy server using the given rule file.
 """
 
-version = get_distribution("deliverance").version
+try:
+    version = get_distribution("deliverance").version
+except DistributionNotFound:
+    # Running from a checkout that hasn't been installed
+    version = None
 
 parser = optparse.OptionParser(
     usage='%prog [OPTIONS] RULE.xml',
@@ -60,7 +66,10 @@ def run_command(rule_filename, debug=False, interactive_debugger=False,
                 garbage_collect=False):
     """Actually runs the command from the parsed arguments"""
     settings = ProxySettings.parse_file(rule_filename)
-    app = ReloadingApp(rule_filename, settings)
+    if settings.sites:
+        app = MultiSiteApp(rule_filename, settings)
+    else:
+        app = ReloadingApp(rule_filename, settings)
     if profile:
         try:
             from repoze.profile.profiler import AccumulatingProfileMiddleware
@@ -103,32 +112,177 @@ class ReloadingApp(object):
     """
     This is a WSGI app that notices when the rule file changes, and
     reloads it in that case.
+
+    The themes of reloaded rules are prewarmed (see
+    `ProxySet.prewarm`) before the rules are used; the rules loaded
+    first serve requests while they are prewarmed in the background
+    (``/.deliverance/status`` reports them as not ready until then).
+    Reloading happens in a background thread; until the new rules are
+    ready the old ones keep serving requests (with
+    ``environ['deliverance.reloading']`` set).
+
+    With ``lazy=True`` the rule file isn't loaded until the first
+    request.  The themes are prewarmed as if requested from
+    `base_url`, ``settings.base_url`` by default.
     """
-    def __init__(self, rule_filename, settings):
+    def __init__(self, rule_filename, settings, lazy=False, base_url=None):
         self.rule_filename = rule_filename
         self.settings = settings
+        if base_url is None:
+            base_url = settings.base_url
+        self.base_url = base_url
         self.proxy_set = None
         self.proxy_set_mtime = None
         self.application = None
-        # This gives syntax errors earlier:
-        self.load_proxy_set(warn=False)
+        self._reloading = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        if not lazy:
+            # This gives syntax errors earlier:
+            self.load_proxy_set(warn=False)
         
     def __call__(self, environ, start_response):
-        if (self.proxy_set is None
-            or self.proxy_set_mtime < os.path.getmtime(self.rule_filename)):
-            self.load_proxy_set()
+        if self.proxy_set is None:
+            self._load_lock.acquire()
+            try:
+                # Another request may have loaded it meanwhile:
+                if self.proxy_set is None:
+                    self.load_proxy_set(warn=False)
+            finally:
+                self._load_lock.release()
+        elif self.proxy_set_mtime < os.path.getmtime(self.rule_filename):
+            self.reload_in_background()
+        if self._reloading:
+            environ['deliverance.reloading'] = True
         return self.application(environ, start_response)
 
+    def reload_in_background(self):
+        """Starts a thread to reload the rule file, unless one is running"""
+        self._lock.acquire()
+        try:
+            if self._reloading:
+                return
+            self._reloading = True
+        finally:
+            self._lock.release()
+        thread = threading.Thread(
+            target=self._background_reload,
+            name='Deliverance rule reload %s' % self.rule_filename)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _background_reload(self):
+        mtime = os.path.getmtime(self.rule_filename)
+        try:
+            try:
+                self.load_proxy_set()
+            except Exception, e:
+                print 'Error reloading rule file %s: %s' % (self.rule_filename, e)
+                # Keep the old rules until the file changes again:
+                self.proxy_set_mtime = mtime
+        finally:
+            self._reloading = False
+
     def load_proxy_set(self, warn=True):
-        """Loads or reloads the ProxySet object from the file"""
+        """Loads or reloads the ProxySet object from the file, and
+        prewarms its themes"""
         if warn:
             print 'Reloading rule file %s' % self.rule_filename
-        self.proxy_set = ProxySet.parse_file(
+        mtime = os.path.getmtime(self.rule_filename)
+        if self.proxy_set is not None:
+            theme_cache = self.proxy_set.ruleset.theme_cache
+        else:
+            theme_cache = None
+        proxy_set = ProxySet.parse_file(
             self.rule_filename,
             middleware_factory=self.settings.middleware_factory,
-            middleware_factory_kwargs=self.settings.middleware_factory_kwargs)
-        self.proxy_set_mtime = os.path.getmtime(self.rule_filename)
-        self.application = self.settings.middleware(self.proxy_set.application)
+            middleware_factory_kwargs=self.settings.middleware_factory_kwargs,
+            theme_cache=theme_cache)
+        first_load = self.proxy_set is None
+        if first_load:
+            # There are no old rules to keep serving requests, so these
+            # do while they are prewarmed (reported as not ready):
+            proxy_set.ruleset.prewarming = True
+        else:
+            self.prewarm(proxy_set)
+        application = self.settings.middleware(proxy_set.application)
+        self.proxy_set = proxy_set
+        self.proxy_set_mtime = mtime
+        self.application = application
+        if first_load:
+            thread = threading.Thread(
+                target=self.prewarm, args=(proxy_set,),
+                name='Deliverance prewarm %s' % self.rule_filename)
+            thread.setDaemon(True)
+            thread.start()
+
+    def prewarm(self, proxy_set):
+        """Prewarms the themes of the proxy set, printing any errors"""
+        proxy_set.prewarm(self.base_url,
+                          **self.settings.security_settings)
+        for url, message in proxy_set.ruleset.prewarm_errors:
+            print 'Could not prewarm the theme %s: %s' % (url, message)
+
+class MultiSiteApp(object):
+    """
+    A WSGI app that serves each ``<site>`` in the server settings
+    (see `ProxySettings.sites`) with the rules in its own file.
+
+    Each site's rules are loaded with a `ReloadingApp` on the first
+    request for that site (with its themes prewarmed for the host of
+    that request), and are reloaded independently of the others.
+    Sites that get no requests for ``settings.site_idle_timeout``
+    seconds are unloaded.  Requests for hosts that aren't in any site
+    use the main rule file.
+    """
+    def __init__(self, rule_filename, settings):
+        self.rule_filename = rule_filename
+        self.settings = settings
+        self.default_app = ReloadingApp(rule_filename, settings)
+        # site rule filename -> ReloadingApp
+        self.site_apps = {}
+        # site rule filename -> time of the last request
+        self.last_used = {}
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        rules = self.settings.site_for_host(host)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if rules is None:
+                app = self.default_app
+            else:
+                app = self.site_apps.get(rules)
+                if app is None:
+                    print 'Loading rule file %s for %s' % (rules, host)
+                    base_url = '%s://%s' % (environ['wsgi.url_scheme'], host)
+                    app = self.site_apps[rules] = ReloadingApp(
+                        rules, self.settings, lazy=True, base_url=base_url)
+                self.last_used[rules] = now
+            # Requests for any host unload the idle sites:
+            self.evict_idle(now)
+        finally:
+            self._lock.release()
+        return app(environ, start_response)
+
+    def evict_idle(self, now):
+        """
+        Unloads the sites that have been idle too long.  This only
+        looks at the sites every tenth of the timeout.
+        """
+        timeout = self.settings.site_idle_timeout
+        if not timeout or now - self._last_sweep < timeout / 10.0:
+            return
+        self._last_sweep = now
+        for rules, last_used in self.last_used.items():
+            if now - last_used > timeout:
+                print 'Unloading rule file %s (idle for %i seconds)' % (
+                    rules, now - last_used)
+                del self.site_apps[rules]
+                del self.last_used[rules]
 
 def main(args=None):
     """Runs the command from ``sys.argv``"""
@@ -6,18 +6,18 @@ puts them together
 import copy
 import urlparse
 from lxml import etree
-from lxml.html import document_fromstring, tostring
+from lxml.html import tostring
 from urllib import quote as url_quote
 from tempita import html
 from deliverance.exceptions import DeliveranceSyntaxError, AbortTheme
 from deliverance.util.converters import asbool, html_quote
 from deliverance.selector import Selector
+from deliverance.applystate import ApplyState
 from deliverance.pagematch import AbstractMatch
 from deliverance.themeref import Theme
-from deliverance.util.cdata import escape_cdata, unescape_cdata
-from deliverance.util.charset import fix_meta_charset_position
+from deliverance.util.cdata import unescape_cdata
+from deliverance.util.normalize import normalize_document
 
-CONTENT_ATTRIB = 'x-a-marker-attribute-for-deliverance'
 
 class Rule(object):
     """
@@ -25,13 +25,15 @@ class Rule(object):
     """
 
     def __init__(self, classes, actions, theme, match, suppress_standard, 
-                 source_location):
+                 source_location, early_flush=None):
         self.classes = classes
         self._actions = actions
         self.theme = theme
         self.match = match
         self.suppress_standard = suppress_standard
         self.source_location = source_location
+        # None means the <ruleset early-flush> setting applies:
+        self.early_flush = early_flush
 
     @classmethod
     def parse_xml(cls, el, source_location):
@@ -55,7 +57,11 @@ class Rule(object):
             action = parse_action(child, source_location)
             actions.append(action)
         match = None
-        inst = cls(classes, actions, theme, match, suppress_standard, source_location)
+        early_flush = el.get('early-flush')
+        if early_flush is not None:
+            early_flush = asbool(early_flush)
+        inst = cls(classes, actions, theme, match, suppress_standard, source_location,
+                   early_flush=early_flush)
         for attr in RuleMatch.match_attrs:
             if el.get(attr):
                 inst.match = RuleMatch.parse_xml(inst, el, source_location)
@@ -63,18 +69,32 @@ class Rule(object):
                 break
         return inst
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state=None):
         """
         Applies all the actions in this rule to the theme_doc
 
-        Note that this leaves behind attributes to mark elements that
-        originated in the content.  You should call
-        :func:`remove_content_attribs` after applying all rules.
+        `state` is the :class:`deliverance.applystate.ApplyState` shared
+        by all the rules applied to these documents.  It remembers which
+        elements of the theme were moved in from the content, so when
+        rules are applied one at a time the same state has to be passed
+        to each of them; otherwise a new one is made for this rule only.
         """
+        if state is None:
+            state = ApplyState(theme_doc)
         for action in self._actions:
-            action.apply(content_doc, theme_doc, resource_fetcher, log)
+            action.apply(content_doc, theme_doc, resource_fetcher, log, state)
         return theme_doc
 
+    def content_selectors(self):
+        """
+        The selectors the actions of this rule evaluate against the
+        content document.
+        """
+        selectors = []
+        for action in self._actions:
+            selectors.extend(action.content_selectors())
+        return selectors
+
     def clientside_actions(self, content_doc, log):
         actions = []
         for action in self._actions:
@@ -210,7 +230,7 @@ class AbstractAction(object):
                 return None
         return '%s="%s"' % (attr, html_quote(text))
 
-    def if_content_matches(self, content_doc, log):
+    def if_content_matches(self, content_doc, log, state=None):
         """
         Returns true if the if-content selector matches something,
         i.e., if this rule should be executed.
@@ -219,7 +239,7 @@ class AbstractAction(object):
             # No if-content means always run
             return True
         sel_type, els, attributes = self.select_elements(
-            self.if_content, content_doc, theme=False)
+            self.if_content, content_doc, theme=False, state=state)
         matched = bool(els)
         if sel_type == 'elements':
             # els is fine then
@@ -258,6 +278,35 @@ class AbstractAction(object):
     # Set to true in subclasses if the move attribute means something:
     move_supported = True
 
+    def is_content_independent(self):
+        """
+        True if the effect of this action on the theme never depends
+        on the content, so it can be applied to the theme in advance.
+        """
+        return False
+
+    def content_selectors(self):
+        """
+        The selectors this action evaluates against the content
+        document of the request.
+        """
+        if getattr(self, 'content_href', None):
+            return []
+        return [selector for selector in (getattr(self, 'content', None),
+                                          self.if_content)
+                if selector is not None]
+
+    def reshapes_theme(self):
+        """
+        True if this action can change the attributes or tags of theme
+        elements (or add content that counts as theme), which can
+        change what theme selectors match.
+        """
+        types = set()
+        if getattr(self, 'theme', None) is not None:
+            types.update(self.theme.selector_types())
+        return bool(types & set(['attributes', 'tag']))
+
     def __unicode__(self):
         return unicode(self.log_description(log=None))
 
@@ -306,21 +355,30 @@ class AbstractAction(object):
             result.extend(el)
         return els[0].text, result
 
-    def select_elements(self, selector, doc, theme):
+    def select_elements(self, selector, doc, theme, state=None):
         """
         Selects the elements from the document.  `theme` is a boolean,
         true if the document is the theme (in which case elements
         originating in the content are not selectable).
         """
-        type, elements, attributes = selector(doc)
+        if state is None:
+            return selector(doc)
+        result = state.get_selection(selector, doc)
+        if result is not None:
+            return result
         if theme:
-            bad_els = []
-            for el in elements:
-                if is_content_element(el):
-                    bad_els.append(el)
-            for el in bad_els:
-                elements.remove(el)
-        return type, elements, attributes
+            result = state.select_theme(selector, doc)
+        if result is None:
+            index = state.element_index(doc)
+            batch = None
+            if not theme:
+                batch = state.batch_for(doc)
+            type, elements, attributes = selector(doc, index, batch)
+            if theme and state.content_roots:
+                elements = [el for el in elements if not state.is_content(el)]
+            result = type, elements, attributes
+        state.set_selection(selector, doc, result)
+        return result
 
     def log_description(self, log=None):
         """
@@ -379,21 +437,10 @@ class AbstractAction(object):
         """Formats the tags for display in a log message.
 
         If `include_name` is true then "element" or "elements" is put
-        before the elements.
+        before the elements.  This returns a `FormattedTags`, which
+        only makes the text when the log message is formatted.
         """
-        if not elements:
-            if include_name:
-                return 'no elements'
-            else:
-                return '(none)'
-        text = ', '.join('<%s>' % el.tag for el in elements)
-        if include_name:
-            if len(elements) > 1:
-                return 'elements %s' % text
-            else:
-                return 'element %s' % text
-        else:
-            return text
+        return FormattedTags(tuple([el.tag for el in elements]), include_name)
 
     def format_tag(self, tag, include_name=False):
         """
@@ -475,7 +522,7 @@ class TransformAction(AbstractAction):
                    manycontent=tag.get('manycontent'),
                    collapse_sources=collapse_sources)
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state=None):
         """
         Applies this action to the theme_doc.
         """
@@ -491,15 +538,41 @@ class TransformAction(AbstractAction):
                     self, 'Resource %s returned the status %s; skipping rule',
                     href, content_resp.status)
                 return
-            body = content_resp.body
-            body = escape_cdata(body)
-            body = fix_meta_charset_position(body)
-            content_doc = document_fromstring(
-                body, base_url=self.content_href)
-        if not self.if_content_matches(content_doc, log):
+            content_doc = normalize_document(
+                content_resp.body, content_resp.charset).parse(
+                self.content_href)
+        if not self.if_content_matches(content_doc, log, state):
+            return
+        content = self.select_content(content_doc, log, state)
+        if content is None:
+            return
+        content_type, content_els, content_attributes = content
+        theme_type, theme_els, theme_attributes = self.select_elements(
+            self.theme, theme_doc, theme=True, state=state)
+        attributes = self.join_attributes(content_attributes, theme_attributes)
+        theme_el = self.choose_theme_element(theme_els, log)
+        if theme_el is None:
             return
+        if not self.move and theme_type in ('children', 'elements'):
+            content_els = copy.deepcopy(content_els)
+        if not self.collapse_sources and state is not None:
+            state.mark_content(content_els)
+        self.apply_transformation(content_type, content_els, attributes, 
+                                  theme_type, theme_el, log)
+        if state is not None:
+            state.theme_modified(theme_type, content_type, self.collapse_sources)
+            if self.move:
+                state.content_modified(content_doc, content_type)
+
+    def select_content(self, content_doc, log, state=None):
+        """
+        Selects the content elements, returning ``(type, elements,
+        attributes)``, or None if nothing matched and the action
+        should be skipped.  Raises AbortTheme when that is what
+        ``nocontent`` asks for.
+        """
         content_type, content_els, content_attributes = self.select_elements(
-            self.content, content_doc, theme=False)
+            self.content, content_doc, theme=False, state=state)
         if not content_els:
             if self.nocontent == 'abort':
                 log.debug(
@@ -513,10 +586,16 @@ class TransformAction(AbstractAction):
             log_meth(
                 self, 'skipping rule because no content matches rule content="%s"', 
                 self.content)
-            return
-        theme_type, theme_els, theme_attributes = self.select_elements(
-            self.theme, theme_doc, theme=True)
-        attributes = self.join_attributes(content_attributes, theme_attributes)
+            return None
+        return content_type, content_els, content_attributes
+
+    def choose_theme_element(self, theme_els, log):
+        """
+        Picks the theme element to apply the action to from the
+        selected `theme_els`, or returns None if the action should be
+        skipped.  Raises AbortTheme when that is what ``notheme`` or
+        ``manytheme`` asks for.
+        """
         if not theme_els:
             if self.notheme == 'abort':
                 log.debug(
@@ -531,7 +610,7 @@ class TransformAction(AbstractAction):
             log_meth(
                 self, 'skipping rule because no theme element matches rule theme="%s"', 
                 self.theme)
-            return
+            return None
         if len(theme_els) > 1:
             if self.manytheme[0] == 'abort':
                 log.debug(
@@ -552,12 +631,44 @@ class TransformAction(AbstractAction):
                 len(theme_els), self.theme, self.manytheme[1])
         else:
             theme_el = theme_els[0]
-        if not self.move and theme_type in ('children', 'elements'):
+        return theme_el
+
+    def take_content(self, content_type, content_els):
+        """
+        Prepares content for insertion into the children of a theme
+        element the way `apply_transformation` does (moving tails,
+        removing emptied content elements, etc), but without
+        inserting it.  Returns ``(text, elements)``.
+        """
+        if not self.move:
             content_els = copy.deepcopy(content_els)
-        if not self.collapse_sources:
-            mark_content_els(content_els)
-        self.apply_transformation(content_type, content_els, attributes, 
-                                  theme_type, theme_el, log)
+        if content_type == 'elements':
+            if self.move:
+                for el in reversed(content_els):
+                    move_tail_upwards(el)
+            else:
+                for el in content_els:
+                    el.tail = None
+            return None, content_els
+        text, els = self.prepare_content_children(content_els)
+        if self.move:
+            self.remove_content_parents(content_els)
+        return text, els
+
+    def remove_content_parents(self, content_els):
+        """
+        Removes content elements whose children were moved into the
+        theme.
+        """
+        for el in content_els:
+            el.getparent().remove(el)
+
+    def reshapes_theme(self):
+        if self.collapse_sources:
+            return True
+        if self.content.selector_types() & set(['attributes', 'tag']):
+            return True
+        return super(TransformAction, self).reshapes_theme()
 
     def clientside_actions(self, content_doc, log):
         if self.content_href:
@@ -827,6 +938,11 @@ class Append(TransformAction):
         # Removing 'tag'
         ]
 
+    def remove_content_parents(self, content_els):
+        for el in reversed(content_els):
+            move_tail_upwards(el)
+            el.getparent().remove(el)
+
     def apply_transformation(self, content_type, content_els, attributes, 
                              theme_type, theme_el, log):
         """Applies the transformation"""
@@ -1064,19 +1180,34 @@ class Drop(AbstractAction):
         self.nocontent = self.convert_error('nocontent', nocontent)
         self.notheme = self.convert_error('notheme', notheme)
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state=None):
         """Applies the action"""
-        if not self.if_content_matches(content_doc, log):
+        if state is not None and state.is_preapplied(self):
+            log.debug(self, 'Theme elements were already dropped from the cached theme')
+            return
+        if not self.if_content_matches(content_doc, log, state):
             return
         for doc, selector, error, name in [
             (theme_doc, self.theme, self.notheme, 'theme'), 
             (content_doc, self.content, self.nocontent, 'content')]:
-            self._apply_drop(doc, selector, error, name, log)
+            self._apply_drop(doc, selector, error, name, log, state)
+
+    def is_content_independent(self):
+        return (self.theme is not None and self.content is None
+                and self.if_content is None)
+
+    def preapply(self, theme_doc, log):
+        """
+        Applies a content-independent action to a theme document
+        ahead of time (see `is_content_independent`).
+        """
+        self._apply_drop(theme_doc, self.theme, self.notheme, 'theme', log)
 
-    def _apply_drop(self, doc, selector, error, name, log):
+    def _apply_drop(self, doc, selector, error, name, log, state=None):
         if selector is None:
             return
-        sel_type, els, attributes = self.select_elements(selector, doc, name=='theme')
+        sel_type, els, attributes = self.select_elements(
+            selector, doc, name=='theme', state=state)
         if not els:
             if error == 'abort':
                 log.debug(
@@ -1139,6 +1270,11 @@ class Drop(AbstractAction):
                 name, self.format_tags(els))
         else:
             assert 0
+        if state is not None:
+            if name == 'theme':
+                state.theme_modified(sel_type)
+            else:
+                state.content_modified(doc, sel_type)
 
     @classmethod
     def from_xml(cls, tag, source_location):
@@ -1158,6 +1294,37 @@ _actions['drop'] = Drop
             
 ## Element utilities ##
 
+class FormattedTags(object):
+    """
+    The tags of some elements, as formatted by
+    `AbstractAction.format_tags` when this is turned into a string.
+    The tag names are taken when the message is logged (as the
+    elements may be changed or moved later); only the text is made
+    later.
+    """
+
+    def __init__(self, tags, include_name=True):
+        self.tags = tags
+        self.include_name = include_name
+
+    def __str__(self):
+        if not self.tags:
+            if self.include_name:
+                return 'no elements'
+            else:
+                return '(none)'
+        text = ', '.join(['<%s>' % tag for tag in self.tags])
+        if self.include_name:
+            if len(self.tags) > 1:
+                return 'elements %s' % text
+            else:
+                return 'element %s' % text
+        else:
+            return text
+
+    def __unicode__(self):
+        return unicode(str(self))
+
 def add_text(el, text):
     """
     Add the given text to the end of the el's text
@@ -1201,37 +1368,3 @@ def iter_self_and_ancestors(el):
     for item in el.iterancestors():
         yield item
 
-def mark_content_els(els):
-    """
-    Mark an element as originating from the content (this uses a special attribute)
-    """
-    ## FIXME: see http://trac.socialplanning.org/deliverance/ticket/70
-    for el in els:
-        ## FIXME: maybe put something that is trackable to the rule
-        ## that moved the element
-        try:
-            el.set(CONTENT_ATTRIB, '1')
-        except TypeError:
-            # If the element is an comment node or some other node
-            # that doesn't support setting attributes, just ignore it.
-            # http://trac.socialplanning.org/deliverance/ticket/69
-            pass
-
-def is_content_element(el):
-    """
-    Tests if the element came from the content (which includes if any of its ancestors)
-    """
-    ## FIXME: should this check children too?
-    for parent in iter_self_and_ancestors(el):
-        if parent.get(CONTENT_ATTRIB):
-            return True
-    return False
-
-def remove_content_attribs(doc):
-    """
-    Remove the markers placed by :func:`mark_content_els`
-    """
-    for parent in doc.getiterator():
-        if parent.get(CONTENT_ATTRIB, None) is not None:
-            del parent.attrib[CONTENT_ATTRIB]
-
@@ -1,7 +1,7 @@
 """Implements the <ruleset> handler."""
 
-import re
-from lxml.html import tostring, document_fromstring
+import weakref
+from lxml.html import tostring
 from lxml.etree import XML, Comment
 
 try: # webob 1.0
@@ -9,12 +9,25 @@ try: # webob 1.0
 except ImportError:  # webob 0.9.8
     from webob.headerdict import HeaderDict as ResponseHeaders
 
+from deliverance.applystate import ApplyState
+from deliverance.codegen import CompiledTransform
 from deliverance.exceptions import AbortTheme, DeliveranceSyntaxError
 from deliverance.pagematch import run_matches, Match, ClientsideMatch
-from deliverance.rules import Rule, remove_content_attribs
+from deliverance.pagematch import MatchIndex, RequestFacts
+from deliverance.rules import Rule
+from deliverance.template import ThemeTemplate, TemplateNotPossible
+from deliverance.stylesheet import ThemeStylesheet, StylesheetNotPossible
+from deliverance.themecache import ThemeCache
+from deliverance.selector import SelectorBatch
 from deliverance.themeref import Theme
-from deliverance.util.cdata import escape_cdata, unescape_cdata
-from deliverance.util.charset import fix_meta_charset_position, force_charset
+from deliverance.themeslots import ThemeSlotIndex, find_preappliable_actions
+from deliverance.themeslots import touches_head
+from deliverance.util.charset import force_charset
+from deliverance.util.normalize import normalize_document, normalize_response
+from deliverance.util.normalize import parse_html
+from deliverance.util.converters import asbool, html_quote
+from deliverance.util.lru import LRUCache
+from deliverance.util.serialize import iter_serialize_document, serialize_head
 from urlparse import urljoin
 
 class RuleSet(object):
@@ -24,27 +37,107 @@ class RuleSet(object):
 
     This is a container for rules/actions.  It contains many
     ``<rule>`` objects.
+
+    Parsed themes are kept in ``theme_cache`` (a
+    `deliverance.themecache.ThemeCache`); call
+    ``ruleset.theme_cache.invalidate(url)`` to force a theme to be
+    parsed again.  For each cached theme the matches of the theme
+    selectors are precomputed too (see `deliverance.themeslots`), and
+    for each set of rules the actions that don't depend on the content
+    (like ``<drop theme="...">``) are applied to a copy of the cached
+    theme that requests then start from.
+
+    Themes with a fixed URL can be fetched and prepared before the
+    first request with `prewarm`; ``warm`` is true after that, and
+    ``prewarm_state`` tells whether prewarming is disabled, pending or
+    done.
+
+    With ``early-flush`` the theme head can be sent before the content
+    is requested (see `get_early_head`).
+
+    What the rules come down to for each combination of page classes
+    is worked out once, as an `ExecutionPlan` (see
+    `plan_for_classes`).
     """
 
+    # The values of <ruleset engine="...">:
+    engines = ('tree', 'template', 'xslt', 'compiled')
+
     def __init__(self, matchers, clientsides, rules_by_class, default_theme=None,
-                 source_location=None):
+                 source_location=None, theme_cache=None, engine='tree',
+                 early_flush=False):
         self.matchers = matchers
+        # The matchers indexed by their path= and domain=:
+        self.match_index = MatchIndex(matchers or [])
         self.clientsides = clientsides
         self.rules_by_class = rules_by_class
         self.default_theme = default_theme
         self.source_location = source_location
+        if theme_cache is None:
+            theme_cache = ThemeCache()
+        self.theme_cache = theme_cache
+        # CachedTheme -> ThemeSlotIndex
+        self._theme_slots = weakref.WeakKeyDictionary()
+        # CachedTheme -> {rules: (prepared CachedTheme, preapplied actions)}
+        self._prepared_themes = weakref.WeakKeyDictionary()
+        self.engine = engine
+        self.warm = False
+        # True while prewarm() runs, or from when a loader schedules it
+        # while these rules already serve requests:
+        self.prewarming = False
+        # The theme URLs prewarmed, and (url, message) for failures:
+        self.prewarmed = []
+        self.prewarm_errors = []
+        # prepared CachedTheme -> {(rules, doctype...): ThemeTemplate}
+        self._templates = weakref.WeakKeyDictionary()
+        # prepared CachedTheme -> {applied rules: ThemeStylesheet}
+        self._stylesheets = weakref.WeakKeyDictionary()
+        # (applied rules, preapplied actions) -> CompiledTransform; they
+        # are made again when the rules are reloaded
+        self._transforms = {}
+        self.early_flush = early_flush
+        self._may_flush_early = early_flush or True in [
+            rule.early_flush for class_rules in (rules_by_class or {}).values()
+            for rule in class_rules]
+        # prepared CachedTheme -> {applied rules: head text or None}
+        self._early_heads = weakref.WeakKeyDictionary()
+        # (classes, default theme) -> ExecutionPlan
+        self._plans = LRUCache(max_entries=1000)
 
-    def apply_rules(self, req, resp, resource_fetcher, log, default_theme=None):
+    def apply_rules(self, req, resp, resource_fetcher, log, default_theme=None,
+                    early_head=None, normalized=None):
         """
         Apply the whatever the appropriate rules are to the request/response.
+
+        `normalized` is the response body as normalized by
+        `deliverance.util.normalize.normalize_response`, if the caller
+        has already done that.
+
+        If the theme head has already been sent, `early_head` (an
+        `EarlyHead` from `get_early_head`) gives the rules and theme
+        to use.  The page is then always themed: if theming is aborted
+        the theme is used without any content.
         """
-        extra_headers = parse_meta_headers(resp.body)
-        if extra_headers:
-            response_headers = ResponseHeaders(resp.headerlist + extra_headers)
+        if early_head is not None:
+            try:
+                return self.theme_page(
+                    req, resp, early_head.plan, early_head.applied_rules,
+                    early_head.prepared_theme, early_head.preapplied,
+                    early_head.docinfo, resource_fetcher, log, normalized)
+            except AbortTheme:
+                log.error(self, 'Theming was aborted after the theme head was '
+                          'sent; sending the theme without content')
+                resp.app_iter = early_head.theme_only()
+                return resp
+        if normalized is None:
+            normalized = normalize_response(resp)
+        if normalized.headers:
+            response_headers = ResponseHeaders(
+                resp.headerlist + normalized.headers)
         else:
             response_headers = resp.headers
         try:
-            classes = run_matches(self.matchers, req, resp, response_headers, log)
+            classes = run_matches(self.match_index, req, resp, response_headers, log)
         except AbortTheme:
             return resp
         if 'X-Deliverance-Page-Class' in response_headers:
@@ -53,15 +146,70 @@ class RuleSet(object):
         if 'deliverance.page_classes' in req.environ:
             log.debug(self, "Found page class in WSGI environ: %s", ' '.join(req.environ["deliverance.page_classes"]))
             classes.extend(req.environ['deliverance.page_classes'])
+        plan = self.plan_for_classes(classes, default_theme)
+        if plan.theme is None:
+            log.error(self, "No theme has been defined for the request")
+            return resp
+
+        try:
+            theme_href = plan.theme.resolve_href(req, resp, log)
+            original_theme_resp = self.get_theme_response(
+                theme_href, resource_fetcher, log)
+            cached_theme = self.get_cached_theme(
+                original_theme_resp, theme_href,
+                should_escape_cdata=True,
+                should_fix_meta_charset_position=True)
+            prepared_theme, preapplied = self.get_prepared_theme(
+                cached_theme, plan.rules, log)
+            applied_rules = self.iter_rules(
+                plan, req, resp, response_headers, log)
+            return self.theme_page(
+                req, resp, plan, applied_rules, prepared_theme, preapplied,
+                None, resource_fetcher, log, normalized)
+        except AbortTheme:
+            return resp
+
+    def rules_for_classes(self, classes, default_theme=None):
+        """
+        Returns ``(rules, theme)``: the rules for the page `classes`
+        (or for ``default`` if there are none), and the theme to use
+        (None if no theme is defined).
+        """
+        plan = self.plan_for_classes(classes, default_theme)
+        return plan.rules, plan.theme
+
+    def plan_for_classes(self, classes, default_theme=None):
+        """
+        Returns the `ExecutionPlan` for the page `classes` (or for
+        ``default`` if there are none), made the first time those
+        classes are seen.
+        """
         if not classes:
             classes = ['default']
-        rules = []
-        theme = None
+        # Classes without rules (or seen before) don't change anything;
+        # the order of the others does:
+        known = []
         for class_name in classes:
             ## FIXME: handle case of unknown classes
             ## Or do that during compilation?
-            for rule in self.rules_by_class.get(class_name, []):
-                if rule not in rules:
+            if class_name in self.rules_by_class and class_name not in known:
+                known.append(class_name)
+        key = (tuple(known), default_theme)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self.make_plan(known, default_theme)
+            self._plans.set(key, plan)
+        return plan
+
+    def make_plan(self, classes, default_theme=None):
+        """Makes the `ExecutionPlan` for `plan_for_classes`"""
+        rules = []
+        seen = set()
+        theme = None
+        for class_name in classes:
+            for rule in self.rules_by_class[class_name]:
+                if rule not in seen:
+                    seen.add(rule)
                     rules.append(rule)
                     if rule.theme:
                         theme = rule.theme
@@ -71,63 +219,314 @@ class RuleSet(object):
         if theme is None and default_theme is not None:
             theme = Theme(href=default_theme, 
                           source_location=self.source_location)
-            
-        if theme is None:
-            log.error(self, "No theme has been defined for the request")
-            return resp
+        return ExecutionPlan(rules, theme)
 
-        try:
-            theme_href = theme.resolve_href(req, resp, log)
-            original_theme_resp = self.get_theme_response(
-                theme_href, resource_fetcher, log)
-            theme_doc = self.get_theme_doc(
-                original_theme_resp, theme_href,
-                should_escape_cdata=True,
-                should_fix_meta_charset_position=True)
+    def theme_page(self, req, resp, plan, applied_rules, prepared_theme,
+                   preapplied, docinfo, resource_fetcher, log, normalized=None):
+        """
+        Applies the rules to the content in `resp`, putting the themed
+        page in its ``app_iter``.  `applied_rules` are the rules of
+        the `ExecutionPlan` `plan` that apply to the request (see
+        `iter_rules`).  If
+        `docinfo` is None the doctype is taken from the theme, or else
+        from the content.  `normalized` is the normalized body, if
+        there is one already.  May raise AbortTheme.
+        """
+        if normalized is None:
+            normalized = normalize_response(resp)
+        if not resp.charset:
+            resp.charset = normalized.charset
+        content_doc = self.parse_document(
+            normalized.text, req.url, normalized.charset)
+        if docinfo is None:
+            if prepared_theme.declares_doctype:
+                docinfo = prepared_theme
+            else:
+                docinfo = content_doc.getroottree().docinfo
 
-            resp = force_charset(resp)
-            body = resp.unicode_body
-            body = escape_cdata(body)
-            body = fix_meta_charset_position(body)
-            content_doc = self.parse_document(body, req.url)
+        if self.engine == 'xslt':
+            applied_rules = tuple(applied_rules)
+            stylesheet = self.get_stylesheet(
+                prepared_theme, applied_rules, preapplied, log)
+            if stylesheet is not None:
+                doc = stylesheet.transform(content_doc, log)
+                if doc is not None:
+                    resp.app_iter = iter_serialize_document(doc, docinfo)
+                    return resp
 
-            run_standard = True
-            for rule in rules:
-                if rule.match is not None:
-                    matches = rule.match(req, resp, response_headers, log)
-                    if not matches:
-                        log.debug(rule, "Skipping <rule>")
-                        continue
-                rule.apply(content_doc, theme_doc, resource_fetcher, log)
-                if rule.suppress_standard:
-                    run_standard = False
-            if run_standard:
-                ## FIXME: should it be possible to put the standard rule in the ruleset?
-                standard_rule.apply(content_doc, theme_doc, resource_fetcher, log)
-        except AbortTheme:
-            return resp
-        remove_content_attribs(theme_doc)
-        ## FIXME: handle caching?
+        content_batch = SelectorBatch(content_doc, plan.selectors)
+        if self.engine == 'template':
+            template = self.get_template(
+                prepared_theme, plan.rules, preapplied, docinfo, log)
+            if template is not None:
+                resp.app_iter = template.render(
+                    content_doc, applied_rules, resource_fetcher, log,
+                    content_batch)
+                return resp
 
-        if original_theme_resp.body.strip().startswith("<!DOCTYPE"):
-            tree = theme_doc.getroottree()
+        theme_doc = prepared_theme.clone()
+        state = ApplyState(theme_doc, self.get_theme_slots(prepared_theme),
+                           preapplied, content_batch)
+        if self.engine == 'compiled':
+            transform = self.get_transform(tuple(applied_rules), preapplied, log)
+            transform.apply(content_doc, theme_doc, resource_fetcher, log, state)
         else:
-            tree = content_doc.getroottree()
+            for rule in applied_rules:
+                rule.apply(content_doc, theme_doc, resource_fetcher, log, state)
+        ## FIXME: handle caching?
+
+        # The page is serialized as the response is sent:
+        resp.app_iter = iter_serialize_document(theme_doc, docinfo)
+        return resp
 
-        if "XHTML" in tree.docinfo.doctype:
-            method = "xml"
+    def iter_rules(self, plan, req, resp, response_headers, log):
+        """
+        Returns the rules to apply to the request, in order: those of
+        the `ExecutionPlan` `plan` that match, then the standard rule
+        (unless one of the rules applied had ``suppress-standard``).
+        When no rule has a ``<match>`` these are known in advance.
+        """
+        if plan.applied_rules is not None:
+            return plan.applied_rules
+        return self._iter_matching_rules(
+            plan.rules, req, resp, response_headers, log)
+
+    def _iter_matching_rules(self, rules, req, resp, response_headers, log):
+        run_standard = True
+        facts = RequestFacts(req)
+        for rule in rules:
+            if rule.match is not None:
+                matches = rule.match(req, resp, response_headers, log, facts)
+                if not matches:
+                    log.debug(rule, "Skipping <rule>")
+                    continue
+            yield rule
+            if rule.suppress_standard:
+                run_standard = False
+        if run_standard:
+            ## FIXME: should it be possible to put the standard rule in the ruleset?
+            yield standard_rule
+
+    def get_template(self, prepared_theme, rules, preapplied, docinfo, log):
+        """
+        Returns the `deliverance.template.ThemeTemplate` for the
+        theme and rules, or None if the rules can't be applied with a
+        template (and the tree engine has to be used).
+        """
+        templates = self._templates.get(prepared_theme)
+        if templates is None:
+            templates = self._templates.setdefault(prepared_theme, {})
+        key = (tuple(rules), docinfo.doctype, docinfo.public_id,
+               docinfo.system_url)
+        if key not in templates:
+            try:
+                templates[key] = ThemeTemplate(
+                    prepared_theme, list(rules) + [standard_rule],
+                    self.get_theme_slots(prepared_theme), docinfo, preapplied)
+            except TemplateNotPossible, e:
+                templates[key] = e
+        template = templates[key]
+        if isinstance(template, TemplateNotPossible):
+            log.debug(self, 'Not using the template engine: %s',
+                      html_quote(str(template)))
+            return None
+        return template
+
+    def get_stylesheet(self, prepared_theme, applied_rules, preapplied, log):
+        """
+        Returns the `deliverance.stylesheet.ThemeStylesheet` for the
+        theme and the rules that apply to a request, or None if the
+        rules can't be compiled into a stylesheet (and the tree engine
+        has to be used).
+        """
+        stylesheets = self._stylesheets.get(prepared_theme)
+        if stylesheets is None:
+            stylesheets = self._stylesheets.setdefault(prepared_theme, {})
+        if applied_rules not in stylesheets:
+            try:
+                stylesheets[applied_rules] = ThemeStylesheet(
+                    prepared_theme, applied_rules,
+                    self.get_theme_slots(prepared_theme), preapplied)
+            except StylesheetNotPossible, e:
+                stylesheets[applied_rules] = e
+        stylesheet = stylesheets[applied_rules]
+        if isinstance(stylesheet, StylesheetNotPossible):
+            log.debug(self, 'Not using the XSLT engine: %s',
+                      html_quote(str(stylesheet)))
+            return None
+        return stylesheet
+
+    def get_transform(self, applied_rules, preapplied, log):
+        """
+        Returns the `deliverance.codegen.CompiledTransform` of the
+        rules that apply to a request, when the actions in
+        `preapplied` were applied to the theme in advance.
+        """
+        key = (applied_rules, preapplied)
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = CompiledTransform(
+                applied_rules, preapplied,
+                name='transform-%i' % (len(self._transforms) + 1))
+            transform = self._transforms.setdefault(key, transform)
+        base_url = log.request.environ.get('deliverance.base_url')
+        if base_url is not None:
+            name = '<a href="%s/.deliverance/transforms#%s" target="_blank">%s</a>' % (
+                html_quote(base_url), transform.name, transform.name)
         else:
-            method = "html"
+            name = transform.name
+        log.debug(self, 'Applying the compiled %s (%i actions)',
+                  name, transform.actions)
+        return transform
 
-        theme_str = tostring(theme_doc, include_meta_content_type=True)
-        theme_str = tree.docinfo.doctype + theme_str
-        theme_doc = document_fromstring(theme_str)
-        tree = theme_doc.getroottree()
+    def compiled_transforms(self):
+        """
+        The `deliverance.codegen.CompiledTransform` objects made for
+        these rules so far, in the order they were made.
+        """
+        transforms = self._transforms.values()
+        transforms.sort(key=lambda transform: int(transform.name.split('-')[1]))
+        return transforms
 
-        resp.body = tostring(tree, method=method, include_meta_content_type=True)
-        resp.body = unescape_cdata(resp.body)
+    def get_early_head(self, req, resource_fetcher, log, default_theme=None):
+        """
+        Returns an `EarlyHead` with the themed page up to the end of
+        ``<head>`` (to send before the content is even requested), or
+        None if early flushing isn't enabled (see ``early-flush`` on
+        ``<ruleset>`` and ``<rule>``) or isn't possible for this request.
 
-        return resp
+        It is possible when everything deciding the page classes and
+        the rules only looks at the request, the theme is known from
+        the request and declares its own doctype, and no rule changes
+        the theme head (which the standard rule does, unless it is
+        suppressed).
+        """
+        if not self._may_flush_early:
+            return None
+        for matcher in self.matchers:
+            if not matcher.is_request_only():
+                log.debug(self, 'Not sending the theme head early: %s looks at the response',
+                          html_quote(unicode(matcher)))
+                return None
+        try:
+            classes = run_matches(self.match_index, req, None, {}, log)
+        except AbortTheme:
+            return None
+        if 'deliverance.page_classes' in req.environ:
+            classes.extend(req.environ['deliverance.page_classes'])
+        plan = self.plan_for_classes(classes, default_theme)
+        rules, theme = plan.rules, plan.theme
+        settings = set([rule.early_flush for rule in rules
+                        if rule.early_flush is not None])
+        if False in settings or not (self.early_flush or True in settings):
+            return None
+        if theme is None or theme.pyref:
+            log.debug(self, 'Not sending the theme head early: the theme is not known from the request')
+            return None
+        for rule in rules:
+            if rule.match is not None and not rule.match.is_request_only():
+                log.debug(rule, 'Not sending the theme head early: the &lt;rule&gt; looks at the response')
+                return None
+        try:
+            theme_href = theme.resolve_href(req, None, log)
+            cached_theme = self.get_cached_theme(
+                self.get_theme_response(theme_href, resource_fetcher, log),
+                theme_href,
+                should_escape_cdata=True,
+                should_fix_meta_charset_position=True)
+        except AbortTheme:
+            return None
+        if not cached_theme.declares_doctype:
+            log.debug(self, 'Not sending the theme head early: the theme %s has no doctype',
+                      theme_href)
+            return None
+        prepared_theme, preapplied = self.get_prepared_theme(
+            cached_theme, rules, log)
+        applied_rules = tuple(self.iter_rules(plan, req, None, {}, log))
+        heads = self._early_heads.get(prepared_theme)
+        if heads is None:
+            heads = self._early_heads.setdefault(prepared_theme, {})
+        key = tuple(applied_rules)
+        if key not in heads:
+            heads[key] = None
+            slots = self.get_theme_slots(prepared_theme)
+            if slots is not None and not touches_head(
+                applied_rules, slots, prepared_theme.doc, preapplied):
+                heads[key] = serialize_head(prepared_theme.clone(),
+                                            prepared_theme)
+        text = heads[key]
+        if text is None:
+            log.debug(self, 'Not sending the theme head early: the rules change the head of the theme %s',
+                      theme_href)
+            return None
+        log.debug(self, 'Sending the head of the theme %s before the content', theme_href)
+        return EarlyHead(text, plan, applied_rules, prepared_theme, preapplied)
+
+    def static_themes(self):
+        """
+        Returns ``[(theme, rules)]`` for every page class whose theme
+        has a fixed URL (see `deliverance.themeref.Theme.is_static`),
+        with the rules of that class.
+        """
+        result = []
+        for class_name in sorted(self.rules_by_class):
+            plan = self.plan_for_classes([class_name])
+            if plan.theme is not None and plan.theme.is_static():
+                result.append((plan.theme, plan.rules))
+        return result
+
+    def prewarm(self, resource_fetcher, base_url, log):
+        """
+        Fetches, parses and prepares the themes with fixed URLs
+        (resolved relative to `base_url`), so that the first requests
+        using them don't have to.  Failures are logged and kept in
+        ``prewarm_errors``.  Sets ``warm`` when done.
+        """
+        self.prewarming = True
+        # Each theme is only fetched once, though it may be prepared
+        # for several sets of rules:
+        themes = {}
+        for theme, rules in self.static_themes():
+            url = urljoin(base_url, theme.href)
+            try:
+                if url not in themes:
+                    theme_resp = self.get_theme_response(
+                        url, resource_fetcher, log)
+                    themes[url] = self.get_cached_theme(
+                        theme_resp, url,
+                        should_escape_cdata=True,
+                        should_fix_meta_charset_position=True)
+                cached_theme = themes[url]
+                if cached_theme is None:
+                    continue
+                prepared_theme, preapplied = self.get_prepared_theme(
+                    cached_theme, rules, log)
+                if self.engine == 'template' and cached_theme.declares_doctype:
+                    self.get_template(prepared_theme, rules, preapplied,
+                                      cached_theme, log)
+            except Exception, e:
+                log.warn(self, 'Could not prewarm the theme %s: %s', url,
+                         html_quote(str(e)))
+                themes[url] = None
+                self.prewarm_errors.append((url, str(e)))
+                continue
+            if url not in self.prewarmed:
+                log.debug(self, 'Prewarmed the theme %s', url)
+                self.prewarmed.append(url)
+        self.warm = True
+        self.prewarming = False
+
+    @property
+    def prewarm_state(self):
+        """
+        ``'done'`` once `prewarm` has run, ``'pending'`` while it runs
+        (or has been scheduled), and ``'disabled'`` if it never does.
+        """
+        if self.warm:
+            return 'done'
+        elif self.prewarming:
+            return 'pending'
+        return 'disabled'
 
     def check_clientside(self, req, log):
         for clientside in self.clientsides:
@@ -137,11 +536,24 @@ class RuleSet(object):
         return False
 
     def get_theme_response(self, url, resource_fetcher, log):
-        log.info(self, 'Fetching theme from %s' % url)
+        log.info(self, 'Fetching theme from %s', url)
         log.theme_url = url
-        ## FIXME: should do caching
-        ## FIXME: check response status
-        resp = resource_fetcher(url, retry_inner_if_not_200=True)
+        def fetch(url, headers):
+            return resource_fetcher(url, retry_inner_if_not_200=True,
+                                    headers=headers)
+        # Stale themes are only revalidated in the background if the
+        # fetcher can work after this request is done:
+        detached = getattr(resource_fetcher, 'detached', None)
+        if detached is not None:
+            def detached_fetch():
+                background_fetcher, background_log = detached()
+                def fetch(url, headers):
+                    return background_fetcher(url, retry_inner_if_not_200=True,
+                                              headers=headers)
+                return fetch, background_log
+        else:
+            detached_fetch = None
+        resp = self.theme_cache.get_response(url, fetch, log, detached_fetch)
         if resp.status_int != 200:
             log.fatal(
                 self, "The resource %s was not 200 OK: %s" % (url, resp.status))
@@ -153,14 +565,86 @@ class RuleSet(object):
     def get_theme_doc(self, resp, url, 
                       should_escape_cdata=False,
                       should_fix_meta_charset_position=False):
-        
-        body = resp.unicode_body
+        """
+        Returns a private copy of the parsed theme document for the
+        response, reusing the cached parse when possible.
+        """
+        return self.get_cached_theme(
+            resp, url, should_escape_cdata,
+            should_fix_meta_charset_position).clone()
+
+    def get_cached_theme(self, resp, url,
+                         should_escape_cdata=False,
+                         should_fix_meta_charset_position=False):
+        """
+        Returns the `deliverance.themecache.CachedTheme` for the
+        response.  Its document is shared and must not be modified.
+        """
+        def parse(resp, url):
+            return self.parse_theme_doc(resp, url, should_escape_cdata,
+                                        should_fix_meta_charset_position)
+        return self.theme_cache.get_theme(
+            url, resp, parse,
+            variant=(should_escape_cdata, should_fix_meta_charset_position))
+
+    def get_theme_slots(self, cached_theme):
+        """
+        Returns the `deliverance.themeslots.ThemeSlotIndex` of the
+        theme selectors in this ruleset, for the cached theme.
+        """
+        slots = self._theme_slots.get(cached_theme)
+        if slots is None:
+            selectors = []
+            rules = [standard_rule]
+            for class_rules in self.rules_by_class.values():
+                rules.extend(class_rules)
+            for rule in rules:
+                for action in rule._actions:
+                    if getattr(action, 'theme', None) is not None:
+                        selectors.append(action.theme)
+            slots = ThemeSlotIndex(cached_theme.doc, selectors)
+            self._theme_slots[cached_theme] = slots
+        return slots
 
-        if should_escape_cdata:
-            body = escape_cdata(body)
-        if should_fix_meta_charset_position:
-            body = fix_meta_charset_position(body)
-        doc = self.parse_document(body, url)
+    def get_prepared_theme(self, cached_theme, rules, log):
+        """
+        Returns ``(prepared_theme, preapplied)``: a `CachedTheme` with
+        the content-independent actions of `rules` already applied,
+        and the set of those actions.
+        """
+        prepared = self._prepared_themes.get(cached_theme)
+        if prepared is None:
+            prepared = self._prepared_themes.setdefault(cached_theme, {})
+        key = tuple(rules)
+        if key not in prepared:
+            slots = self.get_theme_slots(cached_theme)
+            if slots is not None:
+                actions = find_preappliable_actions(
+                    rules, slots, cached_theme.doc)
+            else:
+                actions = []
+            if actions:
+                doc = cached_theme.clone()
+                for action in actions:
+                    action.preapply(doc, log)
+                log.debug(self, 'Applied %i content-independent actions to the cached theme %s',
+                          len(actions), cached_theme.url)
+                prepared[key] = (cached_theme.derive(doc), frozenset(actions))
+            else:
+                prepared[key] = (cached_theme, frozenset())
+        return prepared[key]
+
+    def parse_theme_doc(self, resp, url,
+                        should_escape_cdata=False,
+                        should_fix_meta_charset_position=False):
+        """
+        Parses and normalizes the theme response, without any caching.
+        """
+        normalized = normalize_document(
+            resp.body, resp.charset,
+            escape_cdata=should_escape_cdata,
+            fix_meta_charset_position=should_fix_meta_charset_position)
+        doc = self.parse_document(normalized.text, url, normalized.charset)
         self.make_links_absolute(doc)
         return doc
 
@@ -185,11 +669,12 @@ class RuleSet(object):
                 return urljoin(base_url, href)
         doc.rewrite_links(link_repl_preserve_internal)
 
-    def parse_document(self, s, url):
+    def parse_document(self, s, url, charset=None):
         """
-        Parses the given document as an HTML document.
+        Parses the given document as an HTML document.  If `s` is a
+        byte string, `charset` is its charset.
         """    
-        return document_fromstring(s, base_url=url)
+        return parse_html(s, url, charset)
 
     def log_description(self, log=None):
         """Description for use in log messages"""
@@ -202,12 +687,20 @@ class RuleSet(object):
         return desc
 
     @classmethod
-    def parse_xml(cls, doc, source_location):
+    def parse_xml(cls, doc, source_location, theme_cache=None):
         """
         Parses the given XML/etree document into an instance of this
-        class.
+        class.  A `theme_cache` can be given to reuse the themes cached
+        by an earlier instance (e.g., when reloading the rules).
         """
         assert doc.tag == 'ruleset'
+        early_flush = asbool(doc.get('early-flush'))
+        engine = doc.get('engine', 'tree')
+        if engine not in cls.engines:
+            raise DeliveranceSyntaxError(
+                'Invalid engine="%s" (must be one of %s)'
+                % (engine, ', '.join(cls.engines)),
+                element=doc)
         matchers = []
         clientsides = []
         rules = []
@@ -239,16 +732,19 @@ class RuleSet(object):
             for class_name in rule.classes:
                 rules_by_class.setdefault(class_name, []).append(rule)
         return cls(matchers, clientsides, rules_by_class, default_theme=default_theme,
-                   source_location=source_location)
+                   source_location=source_location, theme_cache=theme_cache,
+                   engine=engine, early_flush=early_flush)
 
     def clientside_actions(self, req, resp, log):
-        extra_headers = parse_meta_headers(resp.body)
-        if extra_headers:
-            response_headers = ResponseHeaders(resp.headerlist + extra_headers)
+        normalized = normalize_response(
+            resp, escape_cdata=False, fix_meta_charset_position=False)
+        if normalized.headers:
+            response_headers = ResponseHeaders(
+                resp.headerlist + normalized.headers)
         else:
             response_headers = resp.headers
         try:
-            classes = run_matches(self.matchers, req, resp, response_headers, log)
+            classes = run_matches(self.match_index, req, resp, response_headers, log)
         except AbortTheme:
             assert 0, 'no abort should happen'
         if 'X-Deliverance-Page-Class' in response_headers:
@@ -266,13 +762,14 @@ class RuleSet(object):
                     rules.append(rule)
                     if rule.theme:
                         assert 0, 'no rule themes should be present'
-        resp = force_charset(resp)
-        content_doc = self.parse_document(resp.unicode_body, req.url)
+        content_doc = self.parse_document(
+            normalized.text, req.url, normalized.charset)
         actions = []
         run_standard = True
+        facts = RequestFacts(req)
         for rule in rules:
             if rule.match is not None:
-                matches = rule.match(req, resp, response_headers, log)
+                matches = rule.match(req, resp, response_headers, log, facts)
                 if not matches:
                     log.debug(rule, "Skipping <rule>")
                     continue
@@ -285,10 +782,68 @@ class RuleSet(object):
         return actions
         
 
-_meta_tag_re = re.compile(r'<meta\s+(.*?)>', re.I | re.S)
-_http_equiv_re = re.compile(r'http-equiv=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
-_content_re = re.compile(r'content=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
-        
+class ExecutionPlan(object):
+    """
+    What the rules of one combination of page classes come down to
+    (see `RuleSet.plan_for_classes`): the ``rules`` (in order, each
+    once), the ``theme`` (or None), the ``selectors`` the rules and
+    the standard rule evaluate against the content, and, when no rule
+    has a ``<match>``, the ``applied_rules`` (otherwise None: which
+    rules apply, and so whether the standard rule does, is decided
+    for each request by `RuleSet.iter_rules`).
+
+    Plans are shared by requests, and must not be modified.
+    """
+
+    def __init__(self, rules, theme):
+        self.rules = tuple(rules)
+        self.theme = theme
+        selectors = []
+        for rule in self.rules + (standard_rule,):
+            selectors.extend(rule.content_selectors())
+        self.selectors = tuple(selectors)
+        self.applied_rules = None
+        if not [rule for rule in self.rules if rule.match is not None]:
+            applied_rules = self.rules
+            if not [rule for rule in self.rules if rule.suppress_standard]:
+                applied_rules += (standard_rule,)
+            self.applied_rules = applied_rules
+
+    def __repr__(self):
+        return '<%s %i rules theme=%s>' % (
+            self.__class__.__name__, len(self.rules),
+            self.theme and (self.theme.href or self.theme.pyref))
+
+
+class EarlyHead(object):
+    """
+    The themed page up to the end of ``<head>`` (``text``), sent
+    before the content, along with the `ExecutionPlan` and theme the
+    rest of the page has to be made with.
+    """
+
+    def __init__(self, text, plan, applied_rules, prepared_theme, preapplied):
+        self.text = text
+        self.plan = plan
+        self.applied_rules = applied_rules
+        self.prepared_theme = prepared_theme
+        self.preapplied = preapplied
+        # The theme always declares the doctype:
+        self.docinfo = prepared_theme
+
+    def __repr__(self):
+        return '<%s %s %i rules>' % (
+            self.__class__.__name__, self.prepared_theme.url,
+            len(self.applied_rules))
+
+    def theme_only(self):
+        """
+        The whole page made from the theme alone, for when the content
+        can't be used.
+        """
+        return iter_serialize_document(self.prepared_theme.clone(),
+                                       self.docinfo)
+
 def parse_meta_headers(body):
     """
     Returns a list of headers (in the form ``[(header_name,
@@ -296,22 +851,8 @@ def parse_meta_headers(body):
     headers are in the format ``<meta http-equiv="header_name"
     content="header_value">``
     """
-    headers = []
-    for match in _meta_tag_re.finditer(body):
-        content = match.group(1)
-        http_equiv_match = _http_equiv_re.search(content)
-        content_match = _content_re.search(content)
-        if not http_equiv_match or not content_match:
-            ## FIXME: log partial matches?
-            continue
-        http_equiv = (http_equiv_match.group(1) or http_equiv_match.group(2) or '')
-        http_equiv = http_equiv.strip()
-        content = content_match.group(1) or content_match.group(2) or ''
-        if not http_equiv or not content:
-            ## FIXME: is empty content really meaningless?
-            continue
-        headers.append((http_equiv, content))
-    return headers
+    return normalize_document(body, escape_cdata=False,
+                              fix_meta_charset_position=False).headers
 
 # Note: these are included in the documentation; any changes should be
 # reflected there as well.
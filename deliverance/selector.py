@@ -7,11 +7,297 @@ import re
 from lxml.etree import XPath
 from lxml.cssselect import CSSSelector
 from deliverance.exceptions import DeliveranceSyntaxError
+from deliverance.util.lru import LRUCache
 
 type_re = re.compile(r'^(elements?|children|tag|attributes?):')
 type_map = dict(element='elements', attribute='attributes')
 attributes_re = re.compile(r'^attributes[(]([a-zA-Z0-9_, -:]+)[)]:')
 
+_xpath_literal_re = re.compile(r'"[^"]*"|\'[^\']*\'')
+_xpath_token_re = re.compile(
+    r'(@?)([a-zA-Z_][\w.-]*(?::[a-zA-Z_][\w.-]*)?)\s*(::|\()?'
+    r'|(\d+(?:\.\d*)?|\.\d+)|(\.\.?)|([\[\]$*])')
+_stable_axes = set(['child', 'descendant', 'descendant-or-self', 'self',
+                    'attribute'])
+_stable_functions = set(['contains', 'concat', 'normalize-space',
+                         'starts-with', 'translate', 'substring-before',
+                         'substring-after', 'not', 'boolean', 'true',
+                         'false', 'lang'])
+_operator_names = set(['and', 'or'])
+
+def xpath_is_stable(path):
+    """
+    Tests if the matches of an XPath expression can only change when
+    the matching elements themselves, or their ancestors, are
+    modified.
+
+    This is true of expressions that only test element names and
+    attributes along the child/descendant axes (which includes the
+    translations of most CSS selectors).  For these expressions,
+    removing *other* elements from a document will not add or remove
+    any matches, so the matches found in the unmodified document are
+    still valid (minus any removed elements).  Positional tests, text
+    tests, and tests on children or siblings are not stable.
+    """
+    path = _xpath_literal_re.sub("''", path)
+    depth = 0
+    for match in _xpath_token_re.finditer(path):
+        at, name, follows, number, dots, punct = match.groups()
+        if name:
+            if name in _operator_names and not at and depth:
+                continue
+            if follows == '::':
+                if name not in _stable_axes:
+                    return False
+            elif follows == '(':
+                if name not in _stable_functions:
+                    return False
+                if (name not in ('true', 'false')
+                    and path[match.end():].lstrip().startswith(')')):
+                    # A function of the context node's text
+                    return False
+            elif depth and not at:
+                # A test for a child element
+                return False
+        elif number:
+            if depth:
+                # Possibly a position
+                return False
+        elif dots:
+            if dots == '..' or depth:
+                return False
+        elif punct == '[':
+            depth += 1
+        elif punct == ']':
+            depth -= 1
+        elif punct == '$':
+            return False
+        elif punct == '*' and depth:
+            return False
+    return True
+
+# The compiled XPath and CSS selectors, shared by all rule sets (so
+# reloading the rules doesn't translate and compile them again), keyed
+# on (type, expression, namespaces).  The hits and misses are counted
+# by the cache.
+compiled_selectors = LRUCache(max_entries=5000)
+
+def compile_expression(expr, namespaces=None):
+    """
+    Returns the compiled ``XPath`` (for expressions starting with
+    ``/``) or ``CSSSelector`` for `expr`, reusing the one in
+    `compiled_selectors` if it was compiled before.  The compiled
+    objects are shared, and must not be modified.
+    """
+    if expr.startswith('/'):
+        type = 'xpath'
+    else:
+        type = 'css'
+    if namespaces:
+        key = (type, expr, tuple(sorted(namespaces.items())))
+    else:
+        key = (type, expr, None)
+    selector = compiled_selectors.get(key)
+    if selector is None:
+        if type == 'xpath':
+            selector = XPath(expr, namespaces=namespaces)
+        else:
+            selector = CSSSelector(expr, namespaces=namespaces)
+        compiled_selectors.set(key, selector)
+    return selector
+
+_simple_css_re = re.compile(r'^([#.]?)([a-zA-Z_][a-zA-Z0-9_-]*)$')
+_simple_xpath_re = re.compile(r'^(?:/[a-zA-Z_][a-zA-Z0-9_-]*)+$')
+_descendant_xpath_re = re.compile(r'^//([a-zA-Z_][a-zA-Z0-9_-]*)$')
+
+def simple_selector(expr):
+    """
+    Recognizes the expressions `ElementIndex` can answer without
+    evaluating them: ``#id``, ``.class`` and ``tag`` CSS selectors,
+    and ``/html/head/title`` and ``//tag`` XPath expressions.  Returns
+    ``(kind, name)`` (where `name` is a list of tag names for the
+    ``'path'`` kind), or None.
+    """
+    match = _simple_css_re.match(expr)
+    if match:
+        prefix, name = match.groups()
+        return ({'#': 'id', '.': 'class', '': 'tag'}[prefix], name)
+    if _simple_xpath_re.match(expr):
+        return ('path', expr[1:].split('/'))
+    match = _descendant_xpath_re.match(expr)
+    if match:
+        return ('tag', match.group(1))
+    return None
+
+# The whitespace XPath's normalize-space() (used by the translation of
+# .class CSS selectors) splits on:
+_xml_space_re = re.compile(r'[ \t\r\n]+')
+_id_attributes = XPath('//@id')
+_class_attributes = XPath('//@class')
+
+class ElementIndex(object):
+    """
+    Finds the elements of one document (`doc`, the root element) by
+    id, class and tag name, in document order, for the simple
+    selectors that `simple_selector` recognizes.
+
+    The id map is built the first time it is needed, and the elements
+    of each class the first time that class is selected.  Elements
+    that were removed from the document or lost the id or
+    class since then are skipped, but elements that were added to the
+    document or gained an id or class are not found; the index must
+    be discarded when that can happen.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._ids = None
+        self._classes = None
+
+    def __repr__(self):
+        return '<%s for %s>' % (self.__class__.__name__, self.doc.tag)
+
+    def select(self, simple, selector):
+        """
+        Returns the elements matching the ``(kind, name)`` simple
+        selector, as a new list.  `selector` is the compiled form of
+        the same selector.
+        """
+        kind, name = simple
+        if kind == 'tag':
+            return list(self.doc.iter(name))
+        if kind == 'path':
+            els = [self.doc]
+            if self.doc.tag != name[0]:
+                return []
+            for tag in name[1:]:
+                els = [child for el in els for child in el if child.tag == tag]
+            return els
+        if kind == 'id':
+            if self._ids is None:
+                # The elements are only looked up for the ids asked for
+                self._ids = {}
+                for value in _id_attributes(self.doc):
+                    self._ids.setdefault(value, []).append(value)
+            candidates = [value.getparent()
+                          for value in self._ids.get(name, ())]
+        else:
+            if self._classes is None:
+                self._classes = {}
+            candidates = self._classes.get(name)
+            if candidates is None:
+                candidates = self._classes[name] = selector(self.doc)
+                return list(candidates)
+        return [el for el in candidates if self._has(el, kind, name)]
+
+    def _has(self, el, kind, name):
+        value = el.get(kind)
+        if value is None:
+            return False
+        if kind == 'id':
+            if value != name:
+                return False
+        elif name not in _xml_space_re.split(value):
+            return False
+        doc = self.doc
+        while el is not None:
+            if el is doc:
+                return True
+            el = el.getparent()
+        return False
+
+    @staticmethod
+    def can_index(doc):
+        """
+        True if `doc` is the root element of its document (the simple
+        selectors only mean the same thing there).
+        """
+        return doc.getparent() is None and doc.getroottree().getroot() is doc
+
+
+class SelectorBatch(object):
+    """
+    The matches of many selectors in one document (`doc`, the root
+    element), evaluated together up front: all the ``#id`` selectors
+    with one pass over the ``id`` attributes of the document, all the
+    ``.class`` selectors with one pass over the ``class`` attributes,
+    and the other stable selectors (see `xpath_is_stable`) once each,
+    however many actions use them.  Tag and path selectors (which
+    `ElementIndex` finds without evaluating anything) and selectors
+    that are not stable are not part of the batch.
+
+    The matches stay valid as long as elements are only removed from
+    the document (removed elements are skipped); if anything else
+    changes, the batch must not be used anymore.
+    """
+
+    def __init__(self, doc, selectors):
+        self.doc = doc
+        # compiled selector -> matching elements
+        self.results = {}
+        if not ElementIndex.can_index(doc):
+            return
+        simple = {}
+        others = []
+        for selector in selectors:
+            for (sel_type, compiled, sel_expr, sel_attributes), simple_form, stable in zip(
+                selector.selectors, selector.simple, selector.stable):
+                if compiled in simple or compiled in others:
+                    continue
+                if simple_form is not None:
+                    if simple_form[0] in ('id', 'class'):
+                        simple[compiled] = simple_form
+                elif stable:
+                    others.append(compiled)
+        if simple:
+            self.evaluate_simple(simple)
+        for compiled in others:
+            self.results[compiled] = compiled(doc)
+
+    def __repr__(self):
+        return '<%s %i selectors>' % (self.__class__.__name__, len(self.results))
+
+    def evaluate_simple(self, simple):
+        """
+        Finds the matches of all the ``{compiled: (kind, name)}`` id and
+        class selectors, with one pass over each attribute.
+        """
+        by_kind = {'id': {}, 'class': {}}
+        for kind, name in simple.values():
+            by_kind[kind][name] = []
+        ids, classes = by_kind['id'], by_kind['class']
+        if ids:
+            for value in _id_attributes(self.doc):
+                if value in ids:
+                    ids[value].append(value.getparent())
+        if classes:
+            for value in _class_attributes(self.doc):
+                for name in set(_xml_space_re.split(value)):
+                    if name in classes:
+                        classes[name].append(value.getparent())
+        for compiled, (kind, name) in simple.items():
+            self.results[compiled] = by_kind[kind][name]
+
+    def get(self, compiled):
+        """
+        Returns the current matches of the `compiled` selector (as a
+        new list), or None if it is not part of the batch.
+        """
+        els = self.results.get(compiled)
+        if els is None:
+            return None
+        doc = self.doc
+        result = []
+        for el in els:
+            parent = el
+            while parent is not None:
+                if parent is doc:
+                    result.append(el)
+                    break
+                parent = parent.getparent()
+        return result
+
+
 class Selector(object):
     """
     Represents one selection attribute
@@ -26,6 +312,16 @@ class Selector(object):
         self.selectors_source = selectors
         self.selectors = [self.compile_selector(selector, default_type=major_type)
                           for selector in selectors]
+        # The simple_selector() form of each selector, if it has one
+        self.simple = [simple_selector(self.parse_prefix(
+                    selector, default_type=major_type)[2])
+                       for selector in selectors]
+        self.stable = [xpath_is_stable(selector.path)
+                       for sel_type, selector, sel_expr, sel_attributes
+                       in self.selectors]
+        # Selectors with the same key select the same things:
+        self.key = (major_type, attributes and tuple(attributes),
+                    tuple(selectors))
 
     @classmethod
     def parse(cls, expr):
@@ -93,30 +389,53 @@ class Selector(object):
                 "Expression %s in selector %r uses the type %r, but this is not "
                 "compatible with the type %r already declared earlier in the selector"
                 % (expr, self, type, self.major_type))
-        if rest_expr.startswith('/'):
-            selector = XPath(rest_expr)
-        else:
-            try:
-                selector = CSSSelector(rest_expr)
-            except AssertionError, e:
-                raise DeliveranceSyntaxError('Bad CSS selector: "%s" (%s)' % (expr, e))
+        try:
+            selector = compile_expression(rest_expr)
+        except AssertionError, e:
+            raise DeliveranceSyntaxError('Bad CSS selector: "%s" (%s)' % (expr, e))
         return (type, selector, expr, attributes)
 
-    def __call__(self, doc):
+    def __call__(self, doc, index=None, batch=None):
         """
         Match this selector against the doc.  Returns (type, elements,
         attributes), where type is one of elements, children, tag,
         attributes.  attributes is the list of attributes, if that was
         given.
+
+        If `index` (the `ElementIndex` of `doc`) is given, simple
+        selectors are looked up in it instead of being evaluated, and
+        if `batch` (a `SelectorBatch` for `doc`) is given the matches it
+        has are used.
         """
-        for sel_type, selector, sel_expr, sel_attributes in self.selectors:
-            result = selector(doc)
+        if index is not None and (
+            index.doc is not doc or not index.can_index(doc)):
+            index = None
+        if batch is not None and batch.doc is not doc:
+            batch = None
+        for (sel_type, selector, sel_expr, sel_attributes), simple in zip(
+            self.selectors, self.simple):
+            result = None
+            if batch is not None:
+                result = batch.get(selector)
+            if result is not None:
+                pass
+            elif index is not None and simple is not None:
+                result = index.select(simple, selector)
+            else:
+                result = selector(doc)
             if result:
                 type = sel_type or self.major_type
                 attributes = sel_attributes or self.attributes
                 return (type, result, attributes)
         return (self.major_type, [], self.attributes)
     
+    def is_stable(self):
+        """
+        True if all the expressions in this selector are stable (see
+        `xpath_is_stable`).
+        """
+        return False not in self.stable
+
     def selector_types(self):
         """
         Returns a set of all types used in this expression (usually a
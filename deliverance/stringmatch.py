@@ -6,7 +6,8 @@ import fnmatch
 import re
 from deliverance.util.converters import asbool
 
-__all__ = ['compile_matcher', 'compile_header_matcher', 'MatchSyntaxError']
+__all__ = ['compile_matcher', 'compile_header_matcher', 'MatchSyntaxError',
+           'PatternIndex']
 
 _prefix_re = re.compile(r'^([a-z_-]+):', re.I)
 
@@ -242,8 +243,12 @@ class ExactInsensitiveMatcher(Matcher):
     
     name = 'exact-insensitive'
 
+    def __init__(self, pattern):
+        super(ExactInsensitiveMatcher, self).__init__(pattern)
+        self.lowered = pattern.lower()
+
     def __call__(self, s):
-        return s.lower() == self.pattern.lower()
+        return s.lower() == self.lowered
 
 _add_matcher(ExactInsensitiveMatcher)
 
@@ -266,8 +271,12 @@ class ContainsInsensitiveMatcher(Matcher):
 
     name = 'contains-insensitive'
 
+    def __init__(self, pattern):
+        super(ContainsInsensitiveMatcher, self).__init__(pattern)
+        self.lowered = pattern.lower()
+
     def __call__(self, s):
-        return self.pattern.lower() in s.lower()
+        return self.lowered in s.lower()
 
 _add_matcher(ContainsInsensitiveMatcher)
 
@@ -342,3 +351,146 @@ class HeaderWildcardMatcher(object):
 
     def __str__(self):
         return unicode(self).encode('utf8')
+
+class PatternIndex(object):
+    """
+    Indexes a list of matchers (some of which may be None), so that
+    all the ones matching a string can be found at once.
+
+    ``path:``, ``subpath:`` and ``exact:`` patterns are put in a trie
+    of ``/``-delimited segments, ``exact-insensitive:`` patterns in a
+    dictionary, and wildcard and regex patterns are combined into a
+    few regular expressions.  Any other matchers (including regexes
+    with groups or inline flags) are called as usual.
+
+    >>> index = PatternIndex([PathMatcher('/foo'), None,
+    ...     SubpathMatcher('/foo'), WildcardMatcher('*.html'),
+    ...     ReverseMatcher('/foo')])
+    >>> check = index.matches('/foo')
+    >>> [check(pos) for pos in range(5)]
+    [True, False, False, False, False]
+    >>> check = index.matches('/foo/bar.html')
+    >>> [check(pos) for pos in range(5)]
+    [True, False, True, True, True]
+    >>> sorted(index.matching('/foo/bar.html'))
+    [0, 2, 3, 4]
+    """
+
+    # Python's regular expressions can't have more groups than this:
+    max_groups = 99
+
+    def __init__(self, matchers):
+        self.trie = _TrieNode()
+        self.insensitive = {}
+        # regex flags -> [(position, regex source)]
+        self.combinable = {}
+        # position -> matcher
+        self.other = {}
+        for pos, matcher in enumerate(matchers):
+            if matcher is None:
+                continue
+            type = matcher.__class__
+            if type in (PathMatcher, SubpathMatcher, ExactMatcher):
+                pattern = matcher.pattern
+                if type is not ExactMatcher:
+                    pattern = pattern[:-1]
+                node = self.trie
+                for segment in pattern.split('/'):
+                    node = node.children.setdefault(segment, _TrieNode())
+                getattr(node, type.name).append(pos)
+            elif type is ExactInsensitiveMatcher:
+                self.insensitive.setdefault(matcher.lowered, []).append(pos)
+            elif (type in (WildcardMatcher, WildcardInsensitiveMatcher)
+                  or (type is RegexMatcher and not matcher.compiled.groups
+                      and not matcher.compiled.flags)):
+                # Wildcards are translated with fnmatch, which only
+                # adds (?ms); a regex with inline flags (which apply to
+                # the whole expression, and with (?x) can comment out
+                # the rest of it) is left on its own
+                self.combinable.setdefault(matcher.compiled.flags, []).append(
+                    (pos, matcher.compiled.pattern))
+            else:
+                self.other[pos] = matcher
+        # (flags, start) -> regex combining the patterns from start on
+        self._combined = {}
+
+    def matches(self, s):
+        """
+        Returns a function that tells if the matcher at a position
+        matches `s`.  Positions with no matcher never match.  The
+        matchers that aren't indexed are only called when asked about.
+        """
+        matched = self._match_indexed(s)
+        other = self.other
+        def check(pos):
+            if pos in other:
+                return other[pos](s)
+            return pos in matched
+        return check
+
+    def matching(self, s):
+        """
+        Returns the set of the positions of the matchers that match
+        `s`.
+        """
+        matched = self._match_indexed(s)
+        for pos, matcher in self.other.iteritems():
+            if matcher(s):
+                matched.add(pos)
+        return matched
+
+    def _match_indexed(self, s):
+        matched = set(self.insensitive.get(s.lower(), ()))
+        self._match_trie(s, matched)
+        for flags, patterns in self.combinable.iteritems():
+            self._match_combined(flags, patterns, s, matched)
+        return matched
+
+    def _match_trie(self, s, matched):
+        segments = s.split('/')
+        node = self.trie
+        for depth, segment in enumerate(segments):
+            node = node.children.get(segment)
+            if node is None:
+                return
+            # The segments of the pattern are a prefix of the
+            # segments of s:
+            matched.update(node.path)
+            rest = segments[depth+1:]
+            if not rest:
+                matched.update(node.exact)
+            elif rest != ['']:
+                matched.update(node.subpath)
+
+    def _match_combined(self, flags, patterns, s, matched):
+        # Each pattern is a group of the combined regex; the first
+        # that matches is the last group set, and the patterns after
+        # it are tried again in another regex:
+        start = 0
+        while start < len(patterns):
+            regex = self._combined.get((flags, start))
+            if regex is None:
+                regex = re.compile(
+                    '|'.join(['(%s)' % pattern for pos, pattern
+                              in patterns[start:start+self.max_groups]]),
+                    flags)
+                self._combined[flags, start] = regex
+            match = regex.match(s)
+            if match is None:
+                start += self.max_groups
+            else:
+                index = start + match.lastindex - 1
+                matched.add(patterns[index][0])
+                start = index + 1
+
+class _TrieNode(object):
+    """
+    A node of `PatternIndex`'s trie, with the positions of the
+    patterns that end here
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.path = []
+        self.subpath = []
+        self.exact = []
@@ -0,0 +1,516 @@
+"""
+The ``xslt`` engine: the theme and the rules are compiled into one
+XSLT stylesheet, with the theme embedded as literal result elements,
+and each content document is themed with a single call to libxslt.
+
+The stylesheet works on the unmodified content document.  What the
+tree engine does to the content (moving content into the theme,
+dropping it) is followed with node-sets of the nodes that have been
+removed from the content so far, which later selections leave out.
+This is only exact for selectors whose matches don't change when
+other elements are removed (see `deliverance.selector.xpath_is_stable`),
+so other selectors are only supported before anything is removed.
+Cases that can only be detected on a request (like
+``nocontent="abort"``, or the same content selected twice) make the
+stylesheet give up, and the tree engine is used for that request.
+"""
+
+import re
+from lxml.etree import XSLT, XSLTParseError, XSLTApplyError
+from lxml.etree import Element, SubElement
+from lxml.etree import Comment, ProcessingInstruction
+from deliverance.rules import Drop, Replace, Append, Prepend
+from deliverance.selector import _xpath_literal_re
+from deliverance.util.converters import html_quote
+
+__all__ = ['ThemeStylesheet', 'StylesheetNotPossible']
+
+XSL_NS = 'http://www.w3.org/1999/XSL/Transform'
+# The result of a stylesheet that gives up:
+FALLBACK_TAG = '{urn:x-deliverance:fallback}fallback'
+
+class StylesheetNotPossible(Exception):
+    """
+    Raised when the rules can't be compiled into a stylesheet, and the
+    tree engine has to be used instead.
+    """
+
+def _xsl(parent, tag, **attrs):
+    el = SubElement(parent, '{%s}%s' % (XSL_NS, tag))
+    for attr, value in attrs.items():
+        el.set(attr.replace('_', '-'), value)
+    return el
+
+def _text(parent, text):
+    if text:
+        _xsl(parent, 'text').text = text
+
+def _not_removed(removed):
+    """
+    An XPath predicate for nodes that are not in (or inside) the
+    node-set variable `removed` (None if nothing was removed).
+    """
+    if removed is None:
+        return ''
+    return ('[count(ancestor-or-self::node()|$%s) = '
+            'count(ancestor-or-self::node()) + count($%s)]'
+            % (removed, removed))
+
+def _any(conditions):
+    if not conditions:
+        return 'false()'
+    return ' or '.join(['(%s)' % condition for condition in conditions])
+
+def _all(conditions):
+    if not conditions:
+        return 'true()'
+    return ' and '.join(['(%s)' % condition for condition in conditions])
+
+# Prefixed names in XPath expressions (like the extension functions
+# some CSS selectors use), which the stylesheet doesn't have:
+_prefixed_name_re = re.compile(r'(?<![:\w.-])[\w.-]+:[\w.-]')
+
+def _is_name(name):
+    return isinstance(name, basestring) and ':' not in name and '{' not in name
+
+
+class _Hole(object):
+    """
+    A theme element whose children the actions replace or add to.
+    """
+
+    def __init__(self, el):
+        self.el = el
+        # [(action, fired variable, content type, content variable,
+        #   removed variable)], in the order the actions apply
+        self.pieces = []
+
+
+class ThemeStylesheet(object):
+    """
+    A theme document with the `rules` (in order, as they apply to a
+    request) compiled into an `lxml.etree.XSLT` stylesheet.
+
+    Like `deliverance.template.ThemeTemplate`, only ``<replace>``,
+    ``<append>`` and ``<prepend>`` actions into ``theme="children:..."``
+    of theme elements with precomputed matches, and ``<drop>`` actions
+    that only touch the content (or that were applied to the cached
+    theme in advance) are supported; the content has to be selected
+    with ``elements:`` or ``children:``.  Otherwise
+    `StylesheetNotPossible` is raised.
+    """
+
+    def __init__(self, cached_theme, rules, slots, preapplied=()):
+        self.preapplied = preapplied
+        doc = cached_theme.clone()
+        self.elements = list(doc.iter())
+        self.slots = slots
+        self.doc = doc
+        self.stylesheet = Element('{%s}stylesheet' % XSL_NS,
+                                  nsmap={'xsl': XSL_NS})
+        self.stylesheet.set('version', '1.0')
+        self.add_copy_templates()
+        self.root = _xsl(self.stylesheet, 'template', match='/')
+        self.holes = {}
+        # The node-set variable of the content removed so far:
+        self.removed = None
+        # [(condition, reason)] for giving up on a request:
+        self.fallbacks = []
+        self.count = 0
+        self.actions = 0
+        for rule in rules:
+            for action in rule._actions:
+                self.compile_action(action)
+        self.compile_output()
+        try:
+            self.transform_doc = XSLT(self.stylesheet)
+        except XSLTParseError, e:
+            raise StylesheetNotPossible(
+                'the stylesheet could not be compiled: %s' % e)
+        # Only the compiled stylesheet is needed from here on:
+        del self.doc, self.elements, self.slots, self.root, self.holes
+
+    def __repr__(self):
+        return '<%s %i actions %i variables>' % (
+            self.__class__.__name__, self.actions, self.count)
+
+    def add_copy_templates(self):
+        """
+        Adds the templates that copy content, leaving out the nodes in
+        the ``removed`` parameter.
+        """
+        template = _xsl(self.stylesheet, 'template', match='*',
+                        mode='copy', priority='1')
+        _xsl(template, 'param', name='removed')
+        copy = _xsl(template, 'copy')
+        _xsl(copy, 'copy-of', select='@*')
+        apply = _xsl(copy, 'apply-templates', mode='copy',
+                     select='node()[count(.|$removed) != count($removed)]')
+        _xsl(apply, 'with-param', name='removed', select='$removed')
+        template = _xsl(self.stylesheet, 'template', match='node()',
+                        mode='copy')
+        _xsl(template, 'copy-of', select='.')
+        # The tail of moved content (the text up to the next sibling
+        # that stays in the content) goes with it; this includes the
+        # tails of the ``taken`` elements moved along with it.
+        template = _xsl(self.stylesheet, 'template', match='node()',
+                        mode='tail')
+        _xsl(template, 'param', name='removed', select='/..')
+        _xsl(template, 'param', name='taken')
+        _xsl(template, 'variable', name='skip', select=(
+                'count(.|$removed) = count($removed) '
+                'or count(.|$taken) = count($taken)'))
+        _xsl(_xsl(template, 'if', test='self::text() and not($skip)'),
+             'copy-of', select='.')
+        apply = _xsl(_xsl(template, 'if', test='self::text() or $skip'),
+                     'apply-templates', mode='tail',
+                     select='following-sibling::node()[1]')
+        _xsl(apply, 'with-param', name='removed', select='$removed')
+        _xsl(apply, 'with-param', name='taken', select='$taken')
+
+    def variable(self, select):
+        """Adds a variable to the root template, returning its name"""
+        self.count += 1
+        name = 'v%i' % self.count
+        _xsl(self.root, 'variable', name=name, select=select)
+        return name
+
+    def compile_action(self, action):
+        if isinstance(action, Drop):
+            if action in self.preapplied:
+                return
+            if action.theme is not None:
+                raise StylesheetNotPossible(
+                    '<drop theme="%s"> changes the theme' % action.theme)
+            self.actions += 1
+            self.compile_drop(action)
+            return
+        if type(action) not in (Replace, Append, Prepend):
+            raise StylesheetNotPossible(
+                'the action %s is not supported' % action.name)
+        desc = '<%s theme="%s">' % (action.name, action.theme)
+        if action.content_href:
+            raise StylesheetNotPossible('%s uses href' % desc)
+        if action.collapse_sources:
+            raise StylesheetNotPossible('%s uses collapse-sources' % desc)
+        self.actions += 1
+        candidates = self.theme_candidates(action, desc)
+        matches = self.if_content(action, desc)
+        content_type, content = self.select_content(action.content, desc)
+        present = '(%s) and boolean($%s)' % (matches, content)
+        if action.nocontent == 'abort':
+            self.fallbacks.append((
+                '(%s) and not($%s)' % (matches, content),
+                'no content matches content="%s"' % action.content))
+        # The action goes into the first candidate whose ancestors
+        # haven't been replaced already
+        detached = [self.detached(el) for el in candidates]
+        fired = []
+        for i, el in enumerate(candidates):
+            name = self.variable('(%s) and not(%s) and %s' % (
+                    present, detached[i], _all(detached[:i])))
+            fired.append(name)
+            hole = self.holes.get(el)
+            if hole is None:
+                hole = self.holes[el] = _Hole(el)
+            hole.pieces.append((action, name, content_type, content,
+                                self.removed))
+        fired_any = _any(['$%s' % name for name in fired])
+        if action.notheme == 'abort':
+            self.fallbacks.append((
+                '(%s) and not(%s)' % (present, fired_any),
+                'no theme element matches theme="%s"' % action.theme))
+        if content_type == 'children':
+            self.fallbacks.append((
+                '(%s) and count($%s) > 1' % (fired_any, content),
+                'several elements match content="%s"' % action.content))
+        else:
+            self.fallbacks.append((
+                '(%s) and $%s[ancestor::*[count(.|$%s) = count($%s)]]'
+                % (fired_any, content, content, content),
+                'elements inside each other match content="%s"'
+                % action.content))
+        if action.move:
+            if content_type == 'elements':
+                self.remove('$%s[%s]' % (content, fired_any))
+            else:
+                removed = '$%s' % content
+                if isinstance(action, Replace):
+                    # The content element is removed with its tail
+                    removed += (
+                        ' | $%s/following-sibling::text()[generate-id('
+                        'preceding-sibling::node()[not(self::text())]%s[1]) '
+                        '= generate-id($%s)]'
+                        % (content, _not_removed(self.removed), content))
+                self.remove('(%s)[%s]' % (removed, fired_any))
+
+    def compile_drop(self, action):
+        desc = '<drop content="%s">' % action.content
+        matches = self.if_content(action, desc)
+        content_type, content = self.select_content(action.content, desc)
+        if action.nocontent == 'abort':
+            self.fallbacks.append((
+                '(%s) and not($%s)' % (matches, content),
+                'no content matches content="%s"' % action.content))
+        if content_type == 'elements':
+            self.remove('$%s[%s]' % (content, matches))
+        else:
+            self.remove('$%s/node()[%s]' % (content, matches))
+
+    def remove(self, select):
+        if self.removed is not None:
+            select = '$%s | %s' % (self.removed, select)
+        self.removed = self.variable(select)
+
+    def detached(self, el):
+        """
+        The condition for the theme element `el` having been removed
+        from the theme by the actions so far.
+        """
+        conditions = []
+        for parent in el.iterancestors():
+            hole = self.holes.get(parent)
+            if hole is None:
+                continue
+            for piece in hole.pieces:
+                if piece[0].name == 'replace':
+                    conditions.append('$%s' % piece[1])
+        return _any(conditions)
+
+    def theme_candidates(self, action, desc):
+        """
+        The theme elements the action can go into, in the order they
+        are tried.
+        """
+        result = self.slots.select(action.theme, self.doc, self.elements)
+        if result is None:
+            raise StylesheetNotPossible(
+                'the theme elements of %s are not known in advance' % desc)
+        theme_type, theme_els, theme_attributes = result
+        if theme_type != 'children':
+            raise StylesheetNotPossible(
+                '%s does not use theme="children:..."' % desc)
+        if len(theme_els) > 1 and action.manytheme[0] == 'abort':
+            raise StylesheetNotPossible(
+                '%s matches several theme elements' % desc)
+        if len(action.theme.selectors) > 1:
+            for el in theme_els:
+                if self.detached(el) != 'false()':
+                    # Another alternative may be used once it is gone
+                    raise StylesheetNotPossible(
+                        '%s may have to use another alternative' % desc)
+        if action.manytheme[1] == 'last':
+            theme_els = list(reversed(theme_els))
+        return theme_els
+
+    def selections(self, selector, desc):
+        """
+        Adds the variables with the current matches of each
+        alternative of `selector`, returning ``(type, [names])``.
+        """
+        types = set([sel_type or selector.major_type
+                     for sel_type, compiled, expr, attributes
+                     in selector.selectors])
+        if len(types) != 1:
+            raise StylesheetNotPossible(
+                '%s mixes selection types' % desc)
+        names = []
+        for (sel_type, compiled, expr, attributes), stable in zip(
+            selector.selectors, selector.stable):
+            if _prefixed_name_re.search(
+                    _xpath_literal_re.sub("''", compiled.path)):
+                raise StylesheetNotPossible(
+                    '"%s" in %s uses XPath extensions' % (expr, desc))
+            if self.removed is not None and not stable:
+                raise StylesheetNotPossible(
+                    'the matches of "%s" in %s can change as content is removed'
+                    % (expr, desc))
+            names.append(self.variable(
+                '(%s)%s' % (compiled.path, _not_removed(self.removed))))
+        return types.pop(), names
+
+    def select_content(self, selector, desc):
+        """
+        Adds the variable with the content `selector` selects (from
+        the first alternative that matches), returning ``(type,
+        name)``.
+        """
+        content_type, names = self.selections(selector, desc)
+        if content_type not in ('elements', 'children'):
+            raise StylesheetNotPossible(
+                '%s selects the %s of the content' % (desc, content_type))
+        if len(names) == 1:
+            return content_type, names[0]
+        parts = []
+        for i, name in enumerate(names):
+            parts.append('$%s%s' % (name, ''.join(
+                ['[not($%s)]' % previous for previous in names[:i]])))
+        return content_type, self.variable(' | '.join(parts))
+
+    def if_content(self, action, desc):
+        """
+        The condition for the ``if-content`` of the action matching.
+        """
+        if action.if_content is None:
+            return 'true()'
+        sel_type, names = self.selections(action.if_content, desc)
+        if sel_type == 'elements':
+            matched = _any(['$%s' % name for name in names])
+        elif sel_type == 'children':
+            # Only the first alternative that matches counts:
+            matched = _any([
+                '$%s[node()%s]%s' % (name, _not_removed(self.removed), ''.join(
+                        ['[not($%s)]' % previous for previous in names[:i]]))
+                for i, name in enumerate(names)])
+        else:
+            raise StylesheetNotPossible(
+                '%s uses if-content="%s"' % (desc, action.if_content))
+        if action.if_content.inverted:
+            matched = 'not(%s)' % matched
+        return '$%s' % self.variable(matched)
+
+    def compile_output(self):
+        """
+        Adds the theme (with the holes filled in), or the fallback
+        element if any of the reasons to give up apply.
+        """
+        choose = _xsl(self.root, 'choose')
+        for condition, reason in self.fallbacks:
+            when = _xsl(choose, 'when', test=condition)
+            fallback = SubElement(when, FALLBACK_TAG)
+            fallback.text = reason
+        parent = _xsl(choose, 'otherwise')
+        for el in self.doc.itersiblings(preceding=True):
+            self.literal(el, parent, 0)
+        self.literal(self.doc, parent)
+        for el in self.doc.itersiblings():
+            self.literal(el, parent)
+
+    def literal(self, el, parent, insert=None):
+        """
+        Adds the theme element `el` (without its tail) to `parent` as
+        a literal result element.
+        """
+        if el.tag is Comment:
+            out = Element('{%s}comment' % XSL_NS)
+            _text(out, el.text)
+        elif el.tag is ProcessingInstruction:
+            out = Element('{%s}processing-instruction' % XSL_NS)
+            out.set('name', el.target)
+            _text(out, el.text)
+        elif not _is_name(el.tag):
+            raise StylesheetNotPossible(
+                'the theme has a <%s> element' % el.tag)
+        else:
+            out = Element(el.tag)
+            for name, value in el.attrib.items():
+                if not _is_name(name):
+                    raise StylesheetNotPossible(
+                        'the theme has a %s attribute' % name)
+                out.set(name, value.replace('{', '{{').replace('}', '}}'))
+            hole = self.holes.get(el)
+            if hole is None:
+                self.literal_children(el, out)
+            else:
+                self.fill(hole, out)
+        if insert is None:
+            parent.append(out)
+        else:
+            parent.insert(insert, out)
+
+    def literal_children(self, el, out):
+        _text(out, el.text)
+        for child in el:
+            self.literal(child, out)
+            _text(out, child.tail)
+
+    def fill(self, hole, out):
+        """
+        Adds the children of the theme element of `hole`: its own
+        children or the content of the last action that replaced
+        them, with the content that was prepended or appended after
+        that.
+        """
+        replaces = [i for i, piece in enumerate(hole.pieces)
+                    if piece[0].name == 'replace']
+        if not replaces:
+            self.fill_after(hole, None, out)
+            return
+        choose = _xsl(out, 'choose')
+        for i in reversed(replaces):
+            when = _xsl(choose, 'when', test='$%s' % hole.pieces[i][1])
+            self.fill_after(hole, i, when)
+        self.fill_after(hole, None, _xsl(choose, 'otherwise'))
+
+    def fill_after(self, hole, start, out):
+        if start is None:
+            later = hole.pieces
+        else:
+            later = hole.pieces[start+1:]
+        prepends = [piece for piece in later if piece[0].name == 'prepend']
+        appends = [piece for piece in later if piece[0].name == 'append']
+        for piece in reversed(prepends):
+            self.content(piece, _xsl(out, 'if', test='$%s' % piece[1]))
+        if start is None:
+            self.literal_children(hole.el, out)
+        else:
+            self.content(hole.pieces[start], out)
+        for piece in appends:
+            self.content(piece, _xsl(out, 'if', test='$%s' % piece[1]))
+
+    def content(self, piece, out):
+        """
+        Adds the content one action puts into a hole, as it was at the
+        time of the action.
+        """
+        action, fired, content_type, content, removed = piece
+        if content_type == 'elements':
+            select = '$%s' % content
+        else:
+            select = '$%s/node()%s' % (content, _not_removed(removed))
+        loop = _xsl(out, 'for-each', select=select)
+        self.copy(loop, removed)
+        if content_type == 'elements' and action.move:
+            apply = _xsl(loop, 'apply-templates', mode='tail',
+                         select='following-sibling::node()[1]')
+            if removed is not None:
+                _xsl(apply, 'with-param', name='removed',
+                     select='$%s' % removed)
+            _xsl(apply, 'with-param', name='taken', select='$%s' % content)
+
+    def copy(self, out, removed):
+        """
+        Copies the current node, without the `removed` nodes.
+        """
+        if removed is None:
+            _xsl(out, 'copy-of', select='.')
+            return
+        choose = _xsl(out, 'choose')
+        # Only content with removed nodes inside has to be copied
+        # node by node
+        when = _xsl(choose, 'when', test=(
+                '$%s[count(ancestor::node()|current()) = count(ancestor::node())]'
+                % removed))
+        apply = _xsl(when, 'apply-templates', select='.', mode='copy')
+        _xsl(apply, 'with-param', name='removed', select='$%s' % removed)
+        _xsl(_xsl(choose, 'otherwise'), 'copy-of', select='.')
+
+    def transform(self, content_doc, log):
+        """
+        Themes `content_doc`, returning the root element of the themed
+        document, or None if the tree engine has to be used for it.
+        """
+        try:
+            result = self.transform_doc(content_doc.getroottree())
+        except XSLTApplyError, e:
+            log.warn(self, 'The XSLT stylesheet failed: %s', html_quote(str(e)))
+            return None
+        root = result.getroot()
+        if root is None or root.tag == FALLBACK_TAG:
+            log.debug(self, 'Not using the XSLT stylesheet for this page: %s',
+                      html_quote(root is not None and root.text
+                                 or 'there was no result'))
+            return None
+        log.debug(self, 'Themed the page with the XSLT stylesheet (%i actions)',
+                  self.actions)
+        return root
@@ -0,0 +1,299 @@
+"""
+The ``template`` engine: the theme is serialized once into static
+fragments around "holes" (the theme elements whose children the rules
+replace or add to), and on each request only the selected content is
+serialized and joined with the fragments.
+"""
+
+import os
+import re
+from lxml.html import Element
+from lxml.etree import Comment, SubElement
+from deliverance.applystate import ApplyState
+from deliverance.rules import Drop, Replace, Append, Prepend
+from deliverance.util.serialize import serialize_document, output_method
+
+__all__ = ['ThemeTemplate', 'TemplateNotPossible']
+
+class TemplateNotPossible(Exception):
+    """
+    Raised when the rules can't be applied with a template, and the
+    tree engine has to be used instead.
+    """
+
+# Stands for the original children of a hole:
+ORIGINAL = object()
+
+_auto_meta_re = re.compile(
+    r'<meta http-equiv="Content-Type" content="[^"]*" />$')
+
+def _is_content_type_meta(el):
+    return (el.tag == 'meta'
+            and (el.get('http-equiv') or '').lower() == 'content-type')
+
+
+class Hole(object):
+    """
+    A theme element whose children are filled in on each request.
+    """
+
+    def __init__(self, index, el):
+        self.index = index
+        self.el = el
+        # Indexes into ThemeTemplate.tokens:
+        self.start = self.end = None
+        # For an XHTML <head>: the length of the meta tag the
+        # serializer added because the theme has none
+        self.auto_meta = 0
+
+
+class _Fill(object):
+    """
+    The pieces of each hole during one request.
+    """
+
+    def __init__(self, holes, marker):
+        self.pieces = [[ORIGINAL] for hole in holes]
+        self.replaced = [False] * len(holes)
+        self.marker = marker
+        # The content is moved here (so later selectors don't find it
+        # in the content document), in pieces separated by markers
+        self.scratch = None
+        self.count = 0
+        # Pieces with a <meta http-equiv="Content-Type">
+        self.content_type_metas = set()
+
+    def add(self, text, els):
+        """
+        Adds a piece of content, returning its index.
+        """
+        if self.scratch is None:
+            self.scratch = Element('html')
+            self.body = SubElement(self.scratch, 'body')
+        body = self.body
+        marker = Comment(self.marker)
+        marker.tail = text
+        body.append(marker)
+        body.extend(els)
+        self.count += 1
+        return self.count - 1
+
+    def serialize(self, docinfo):
+        """
+        Serializes all the pieces of content in one document (so they
+        are serialized exactly like they would be in the theme).
+        """
+        if self.scratch is None:
+            return []
+        self.body.append(Comment(self.marker))
+        parts = serialize_document(self.scratch, docinfo).split(
+            '<!--%s-->' % self.marker)
+        return parts[1:-1]
+
+    def is_detached(self, hole_indexes):
+        for index in hole_indexes:
+            if self.replaced[index]:
+                return True
+        return False
+
+
+class ThemeTemplate(object):
+    """
+    A theme document (with `deliverance.ruleset.RuleSet` rules)
+    compiled into serialized fragments.
+
+    Only ``<replace>``, ``<append>`` and ``<prepend>`` actions into
+    ``theme="children:..."`` of theme elements with precomputed
+    matches, and ``<drop>`` actions that only touch the content (or
+    that were applied to the cached theme in advance) are supported;
+    otherwise `TemplateNotPossible` is raised.
+    """
+
+    def __init__(self, cached_theme, rules, slots, docinfo, preapplied=()):
+        self.docinfo = docinfo
+        self.method = output_method(docinfo.doctype)
+        self.preapplied = preapplied
+        doc = cached_theme.clone()
+        elements = list(doc.iter())
+        self.holes = []
+        holes_by_el = {}
+        theme_els = {}
+        for rule in rules:
+            for action in rule._actions:
+                if action not in theme_els:
+                    theme_els[action] = self.compile_action(
+                        action, slots, doc, elements)
+        for els in theme_els.values():
+            for el in els or ():
+                if el not in holes_by_el:
+                    hole = Hole(len(self.holes), el)
+                    self.holes.append(hole)
+                    holes_by_el[el] = hole
+        def ancestor_holes(el):
+            return [holes_by_el[parent].index for parent in el.iterancestors()
+                    if parent in holes_by_el]
+        # action -> None (applied as usual) or the candidate theme
+        # elements, the holes around each, and the hole of each
+        self.steps = {}
+        for action, els in theme_els.items():
+            if els is None:
+                self.steps[action] = None
+            else:
+                self.steps[action] = (
+                    els, [ancestor_holes(el) for el in els],
+                    dict([(el, holes_by_el[el].index) for el in els]))
+        self.marker = 'deliverance-%s' % os.urandom(8).encode('hex')
+        for hole in self.holes:
+            start = Comment('%s:%i' % (self.marker, hole.index))
+            start.tail = hole.el.text
+            hole.el.text = None
+            hole.el.insert(0, start)
+            hole.el.append(Comment('%s:%i' % (self.marker, hole.index)))
+        self.tokens = []
+        parts = re.split(r'<!--%s:(\d+)-->' % self.marker,
+                         serialize_document(doc, docinfo))
+        for i, part in enumerate(parts):
+            if i % 2:
+                hole = self.holes[int(part)]
+                if hole.start is None:
+                    hole.start = len(self.tokens)
+                else:
+                    hole.end = len(self.tokens)
+                self.tokens.append(hole)
+            else:
+                self.tokens.append(part)
+        for hole in self.holes:
+            if hole.start is None or hole.end is None:
+                raise TemplateNotPossible(
+                    'theme element %s could not be found in the serialized theme'
+                    % hole.el.tag)
+            if self.method == 'xml' and hole.el.tag == 'head':
+                match = _auto_meta_re.search(self.tokens[hole.start-1])
+                if match and not [el for el in hole.el
+                                  if _is_content_type_meta(el)]:
+                    hole.auto_meta = len(match.group(0))
+
+    def __repr__(self):
+        return '<%s %i holes %s>' % (
+            self.__class__.__name__, len(self.holes), self.method)
+
+    def compile_action(self, action, slots, doc, elements):
+        """
+        Returns the theme elements the action could apply to, or None
+        if the action is applied as usual.
+        """
+        if isinstance(action, Drop):
+            if action in self.preapplied or action.theme is None:
+                return None
+            raise TemplateNotPossible(
+                '<drop theme="%s"> changes the theme' % action.theme)
+        if type(action) not in (Replace, Append, Prepend):
+            raise TemplateNotPossible(
+                'the action %s is not supported' % action.name)
+        desc = '<%s theme="%s">' % (action.name, action.theme)
+        if action.content_href:
+            raise TemplateNotPossible('%s uses href' % desc)
+        if action.collapse_sources:
+            raise TemplateNotPossible('%s uses collapse-sources' % desc)
+        if not action.content.selector_types() <= set(['children', 'elements']):
+            raise TemplateNotPossible(
+                '%s changes the attributes or tags of the theme' % desc)
+        result = slots.select(action.theme, doc, elements)
+        if result is None:
+            raise TemplateNotPossible(
+                'the theme elements of %s are not known in advance' % desc)
+        theme_type, theme_els, theme_attributes = result
+        if theme_type != 'children':
+            raise TemplateNotPossible(
+                '%s does not use theme="children:..."' % desc)
+        for el in theme_els:
+            if el.tag in ('script', 'style'):
+                raise TemplateNotPossible(
+                    '%s inserts content into a <%s> tag' % (desc, el.tag))
+        return theme_els
+
+    def render(self, content_doc, rules, resource_fetcher, log,
+               content_batch=None):
+        """
+        Applies the `rules` (in order) to the content document,
+        returning the serialized page as a list of strings (to be used
+        as the response ``app_iter``).  `content_batch` is the
+        `deliverance.selector.SelectorBatch` of the content selectors,
+        if there is one.  May raise AbortTheme.
+        """
+        fill = _Fill(self.holes, self.marker)
+        state = ApplyState(preapplied=self.preapplied,
+                           content_batch=content_batch)
+        for rule in rules:
+            for action in rule._actions:
+                step = self.steps[action]
+                if step is None:
+                    action.apply(content_doc, None, resource_fetcher, log, state)
+                    continue
+                self.apply_action(action, step, content_doc, fill, log, state)
+        return self.serialize(fill)
+
+    def apply_action(self, action, step, content_doc, fill, log, state=None):
+        theme_els, ancestors, hole_indexes = step
+        if not action.if_content_matches(content_doc, log, state):
+            return
+        content = action.select_content(content_doc, log, state)
+        if content is None:
+            return
+        content_type, content_els, content_attributes = content
+        theme_els = [el for el, el_ancestors in zip(theme_els, ancestors)
+                     if not fill.is_detached(el_ancestors)]
+        theme_el = action.choose_theme_element(theme_els, log)
+        if theme_el is None:
+            return
+        text, els = action.take_content(content_type, content_els)
+        if action.move and state is not None:
+            state.content_modified(content_doc, content_type)
+        index = hole_indexes[theme_el]
+        piece = fill.add(text, els)
+        if self.holes[index].auto_meta:
+            for el in els:
+                if _is_content_type_meta(el):
+                    fill.content_type_metas.add(piece)
+        pieces = fill.pieces[index]
+        if action.name == 'replace':
+            fill.pieces[index] = [piece]
+            fill.replaced[index] = True
+        elif action.name == 'append':
+            pieces.append(piece)
+        else:
+            pieces.insert(0, piece)
+        log.debug(
+            action, 'Filling in %s of theme element %s from content %s',
+            action.name == 'replace' and 'the children' or 'the %s' % (
+                action.name == 'append' and 'end' or 'beginning'),
+            action.format_tag(theme_el), action.format_tags(content_els))
+
+    def serialize(self, fill):
+        """
+        Returns the static fragments with the content filled in, in
+        order.
+        """
+        out = []
+        self._emit(0, len(self.tokens), fill, fill.serialize(self.docinfo), out)
+        return out
+
+    def _emit(self, pos, end, fill, contents, out):
+        tokens = self.tokens
+        while pos < end:
+            token = tokens[pos]
+            if isinstance(token, basestring):
+                out.append(token)
+                pos += 1
+                continue
+            hole = token
+            pieces = fill.pieces[hole.index]
+            if hole.auto_meta and fill.content_type_metas.intersection(pieces):
+                # The serializer only adds its meta tag if there is none
+                out[-1] = out[-1][:-hole.auto_meta]
+            for piece in pieces:
+                if piece is ORIGINAL:
+                    self._emit(hole.start + 1, hole.end, fill, contents, out)
+                else:
+                    out.append(contents[piece])
+            pos = hole.end + 1
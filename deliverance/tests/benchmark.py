@@ -0,0 +1,119 @@
+"""
+Rough throughput benchmarks for theming large pages.
+
+Run with ``python deliverance/tests/benchmark.py [iterations]``.
+"""
+
+import sys
+import time
+from lxml.etree import XML
+from lxml.html import document_fromstring, tostring
+from webob import Request, Response
+from deliverance.log import SavingLogger, NullLogger
+from deliverance.ruleset import RuleSet
+from deliverance.util.cdata import unescape_cdata
+from deliverance.util.serialize import serialize_document
+
+THEME = '''\
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html>
+  <head>
+    <title>Theme</title>
+    <link rel="stylesheet" href="/style.css" />
+  </head>
+  <body>
+    <div id="header"><h1>Site</h1><ul class="nav">%s</ul></div>
+    <div id="sidebar"><p>Sidebar</p></div>
+    <div id="content"><p>Replaced</p></div>
+    <div id="footer">Footer</div>
+  </body>
+</html>''' % ''.join(['<li><a href="/s%i">Section %i</a></li>' % (i, i)
+                     for i in range(50)])
+
+RULES = '''\
+<ruleset engine="%s">
+  <theme href="/theme.html" />
+  <rule>
+    <replace content="children:#main" theme="children:#content" />
+    <replace content="children:#related" theme="children:#sidebar" nocontent="ignore" />
+    <drop content="#ads" />
+  </rule>
+</ruleset>'''
+
+def make_page(paragraphs):
+    """A content page of roughly 200 bytes per paragraph"""
+    body = ''.join([
+        '<div class="item" id="item%i"><h2>Item %i</h2><p>Some <b>text</b> '
+        'for item %i, with <a href="/link/%i">a link</a> and more text to '
+        'make it longer.</p></div>\n' % (i, i, i, i)
+        for i in range(paragraphs)])
+    return ('<html><head><title>Content</title>'
+            '<script type="text/javascript">//<![CDATA[\nvar x = 1 < 2;\n//]]></script>'
+            '</head><body><div id="main">%s</div><div id="related">related</div>'
+            '<div id="ads">ads</div></body></html>' % body)
+
+def timeit(func, iterations):
+    start = time.time()
+    for i in range(iterations):
+        func()
+    return (time.time() - start) / iterations
+
+def legacy_serialize(doc, doctype, method):
+    """The old output stage: serialize, reparse and serialize again"""
+    s = doctype + tostring(doc, include_meta_content_type=True)
+    tree = document_fromstring(s).getroottree()
+    return unescape_cdata(
+        tostring(tree, method=method, include_meta_content_type=True))
+
+def bench_output(page, iterations):
+    theme = document_fromstring(THEME)
+    doc = document_fromstring(page)
+    theme.body.extend(doc.body[:])
+    # Like the clones apply_rules works on, without a doctype of its own
+    from copy import deepcopy
+    docinfo = theme.getroottree().docinfo
+    legacy = timeit(lambda: legacy_serialize(
+        deepcopy(theme), docinfo.doctype, 'xml'), iterations)
+    single = timeit(lambda: serialize_document(
+        deepcopy(theme), docinfo), iterations)
+    return legacy, single
+
+def bench_apply_rules(page, iterations, ruleset=None, engine='tree',
+                      log_factory=SavingLogger):
+    if ruleset is None:
+        ruleset = RuleSet.parse_xml(XML(RULES % engine), 'benchmark')
+    theme_resp = Response(THEME)
+    def resource_fetcher(url, retry_inner_if_not_200=False, headers=None):
+        return theme_resp
+    def run():
+        req = Request.blank('http://localhost/page.html')
+        resp = Response(page)
+        log = log_factory(req, None)
+        # The output is only serialized as the body is read:
+        return ruleset.apply_rules(req, resp, resource_fetcher, log).body
+    return timeit(run, iterations)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args:
+        iterations = int(args[0])
+    else:
+        iterations = 50
+    for paragraphs in (10, 1000):
+        page = make_page(paragraphs)
+        print '%iKB page:' % (len(page) / 1024)
+        legacy, single = bench_output(page, iterations)
+        print '  output stage:  %6.2fms (legacy round trip %6.2fms)' % (
+            single * 1000, legacy * 1000)
+        print ('  apply_rules:   %6.2fms (compiled engine %6.2fms, '
+               'template engine %6.2fms, xslt engine %6.2fms)' % (
+            bench_apply_rules(page, iterations) * 1000,
+            bench_apply_rules(page, iterations, engine='compiled') * 1000,
+            bench_apply_rules(page, iterations, engine='template') * 1000,
+            bench_apply_rules(page, iterations, engine='xslt') * 1000))
+        print '  apply_rules with a NullLogger: %6.2fms' % (
+            bench_apply_rules(page, iterations, log_factory=NullLogger) * 1000)
+
+if __name__ == '__main__':
+    main()
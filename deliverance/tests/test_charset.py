@@ -39,3 +39,14 @@ def should_match(doc, charset):
     match = META_CHARSET_TAG.search(doc)
     assert_true(match)
     assert_equals(match.group('charset'), charset)
+
+def test_recode():
+    from deliverance.util.charset import is_utf8, iter_recode
+    assert_true(is_utf8('UTF8'))
+    assert_true(is_utf8('us-ascii'))
+    assert_false(is_utf8('shift_jis'))
+    assert_false(is_utf8('no-such-charset'))
+    pieces = ['<p>', u'\u30be'.encode('shift_jis'), '</p>']
+    assert_equals(list(iter_recode(pieces, 'shift_jis')),
+                  ['<p>', u'\u30be'.encode('utf8'), '</p>'])
+    assert_equals(list(iter_recode(pieces, 'no-such-charset')), pieces)
@@ -517,3 +517,252 @@ def test_head_requests():
     resp = deliv_filename.get("/collapse_content.html")
     assert resp.content_length == head_resp.content_length
     assert resp.headers == head_resp.headers
+
+def test_prewarm():
+    import simplejson
+    import threading
+    from deliverance.security import SecurityContext
+    fetched = []
+    # Set to make the theme server hang until release is set:
+    blocking = []
+    fetching = threading.Event()
+    release = threading.Event()
+    def app(environ, start_response):
+        if blocking and environ['PATH_INFO'].endswith('theme.html'):
+            fetching.set()
+            release.wait(5)
+        fetched.append(environ['PATH_INFO'])
+        return raw_app.app(environ, start_response)
+    fd, filename = tempfile.mkstemp()
+    f = open(filename, 'w')
+    f.write(get_text("rule.xml"))
+    f.close()
+    rule_getter = FileRuleGetter(filename)
+    deliv = DeliveranceMiddleware(
+        app, rule_getter,
+        PrintingLogger, log_factory_kw=dict(print_level=logging.WARNING))
+    test_app = HtmlTestApp(SecurityContext.middleware(
+        deliv, display_logging=True))
+    # Without prewarming the rules are ready as soon as they're loaded:
+    status = simplejson.loads(test_app.get('/.deliverance/status').body)
+    assert status['ready']
+    assert status['prewarm'] == 'disabled'
+    assert fetched == []
+
+    # The rules loaded first are prewarmed while they serve requests,
+    # and aren't ready until that is done:
+    first_rule_getter = FileRuleGetter(filename)
+    first_rule_getter.prewarm = lambda ruleset: deliv.prewarm(
+        ruleset, 'http://localhost')
+    first_app = HtmlTestApp(SecurityContext.middleware(
+        DeliveranceMiddleware(app, first_rule_getter), display_logging=True))
+    blocking.append(True)
+    thread = first_rule_getter.prewarm_in_background()
+    assert fetching.wait(5)
+    status = simplejson.loads(first_app.get('/.deliverance/status', status=503).body)
+    assert not status['ready']
+    assert status['prewarm'] == 'pending'
+    del blocking[:]
+    release.set()
+    thread.join(5)
+    status = simplejson.loads(first_app.get('/.deliverance/status').body)
+    assert status['ready']
+    assert status['prewarm'] == 'done'
+    del fetched[:]
+
+    rule_getter.prewarm = lambda ruleset: deliv.prewarm(ruleset, 'http://localhost')
+    old_ruleset = rule_getter.ruleset
+    rule_getter.load_rules()
+    # Each theme is fetched once (one of them redirects):
+    assert sorted(fetched) == [
+        '/redirect_test/theme.html', '/theme.html', '/theme.html']
+    assert rule_getter.ruleset is not old_ruleset
+    assert rule_getter.ruleset.theme_cache is old_ruleset.theme_cache
+    assert len(rule_getter.ruleset.theme_cache.themes) == 2
+    status = simplejson.loads(test_app.get('/.deliverance/status').body)
+    assert status['ready']
+    assert status['prewarm'] == 'done'
+    assert sorted(status['themes']) == [
+        'http://localhost/redirect_test/theme.html',
+        'http://localhost/theme.html']
+    assert status['errors'] == []
+    # Without a login only the readiness is reported:
+    anonymous_app = HtmlTestApp(SecurityContext.middleware(deliv))
+    status = simplejson.loads(anonymous_app.get('/.deliverance/status').body)
+    assert status == {'ready': True, 'prewarm': 'done'}
+
+    # The page is themed with the prewarmed theme:
+    resp = test_app.get('/blog/index.html')
+    resp.mustcontain("2000 Some Corporation")
+    assert len(rule_getter.ruleset.theme_cache.themes) == 2
+
+    # Rules read again on every request aren't prewarmed each time:
+    prewarmed = []
+    reloading_getter = FileRuleGetter(filename, always_reload=True,
+                                      prewarm=prewarmed.append)
+    HtmlTestApp(DeliveranceMiddleware(app, reloading_getter)).get(
+        '/blog/index.html')
+    assert prewarmed == []
+
+def test_early_flush():
+    from lxml.etree import XML
+    from deliverance.ruleset import RuleSet
+    from deliverance.security import SecurityContext
+    app = URLMap()
+    app['/theme.html'] = make_response(
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'
+        '<html><head><title>Theme</title>'
+        '<link rel="stylesheet" href="/style.css" /></head>\n'
+        '<body><div id="main">theme</div></body></html>')
+    read = []
+    def streamed(body, status='200 OK', headers=()):
+        # Sends the status and headers right away, and the body only
+        # when it is read:
+        def f(environ, start_response):
+            start_response(status, [('Content-Type', 'text/html; charset=UTF-8'),
+                                    ('Set-Cookie', 'session=1'),
+                                    ('Content-Length', str(len(body)))]
+                           + list(headers))
+            def app_iter():
+                read.append(environ['SCRIPT_NAME'])
+                yield body
+            return app_iter()
+        return f
+    app['/page.html'] = streamed(get_text("blog_index.html"))
+    app['/empty'] = streamed("")
+    app['/missing'] = streamed("<html><body>Not here</body></html>",
+                               status='404 Not Found')
+    def get(rules, path='/page.html'):
+        rule_set = RuleSet.parse_xml(XML(
+            '<ruleset %s><theme href="/theme.html" /><rule %s>'
+            '<replace content="children:#content" theme="children:#main" />'
+            '</rule></ruleset>' % rules), 'test')
+        deliv = SecurityContext.middleware(DeliveranceMiddleware(
+            app, lambda *args: rule_set,
+            PrintingLogger, log_factory_kw=dict(print_level=logging.CRITICAL)))
+        del read[:]
+        started = []
+        def start_response(status, headers):
+            started.append((status, headers))
+        app_iter = iter(deliv(Request.blank(path).environ, start_response))
+        first = app_iter.next()
+        read_first = list(read)
+        return first, ''.join([first] + list(app_iter)), read_first, started[0]
+    head, body, read_first, (status, headers) = get(
+        ('early-flush="1"', 'suppress-standard="1"'))
+    # The theme head is sent before the content body is read, with
+    # the status and headers of the content:
+    assert read_first == []
+    assert head.endswith('</head>'), head
+    assert 'the blog post' in body
+    assert body == get(('', 'suppress-standard="1"'))[1]
+    assert status == '200 OK'
+    assert ('Set-Cookie', 'session=1') in headers
+    assert ('Content-Type', 'text/html; charset=UTF-8') in headers
+    assert 'Content-Length' not in dict(headers)
+    # The standard rule changes the head:
+    head, body, read_first, started = get(('early-flush="1"', ''))
+    assert read_first == ['/page.html']
+    head, body, read_first, started = get(
+        ('early-flush="1"', 'suppress-standard="1" early-flush="0"'))
+    assert read_first == ['/page.html']
+    # Responses that aren't 200 OK are handled as usual:
+    head, body, read_first, (status, headers) = get(
+        ('early-flush="1"', 'suppress-standard="1"'), '/missing')
+    assert status == '404 Not Found'
+    assert read_first == ['/missing']
+    # An empty body is left out:
+    head, body, read_first, started = get(
+        ('early-flush="1"', 'suppress-standard="1"'), '/empty')
+    assert read_first == []
+    assert body.endswith('<div id="main">theme</div></body></html>'), body
+
+def test_compiled_transforms_console():
+    from deliverance.security import SecurityContext
+    def make_app(engine, display_logging=True):
+        fd, filename = tempfile.mkstemp()
+        f = open(filename, 'w')
+        f.write(get_text("rule.xml").replace(
+                '<ruleset', '<ruleset engine="%s"' % engine, 1))
+        f.close()
+        deliv = DeliveranceMiddleware(
+            raw_app.app, FileRuleGetter(filename),
+            PrintingLogger, log_factory_kw=dict(print_level=logging.WARNING))
+        return HtmlTestApp(SecurityContext.middleware(
+                deliv, display_logging=display_logging))
+    test_app = make_app('compiled')
+    test_app.get('/.deliverance/transforms').mustcontain(
+        'No rules have been compiled')
+    resp = test_app.get('/blog/index.html')
+    resp.mustcontain("2000 Some Corporation")
+    assert resp.body == make_app('tree').get('/blog/index.html').body
+    resp = test_app.get('/.deliverance/transforms')
+    resp.mustcontain('id="transform-1"', 'action_0')
+    make_app('compiled', display_logging=False).get(
+        '/.deliverance/transforms', status=403)
+
+def test_null_logger():
+    from deliverance.log import NullLogger, SavingLogger
+    from deliverance.security import SecurityContext
+    logs = []
+    def app(environ, start_response):
+        if 'deliverance.log' in environ:
+            logs.append(environ['deliverance.log'])
+        return raw_app.app(environ, start_response)
+    def make_app(display_logging):
+        fd, filename = tempfile.mkstemp()
+        f = open(filename, 'w')
+        f.write(get_text("rule.xml"))
+        f.close()
+        deliv = DeliveranceMiddleware(app, FileRuleGetter(filename))
+        return HtmlTestApp(SecurityContext.middleware(
+                deliv, display_logging=display_logging))
+    resp = make_app(False).get('/blog/index.html?deliv_log')
+    resp.mustcontain("2000 Some Corporation")
+    assert 'Deliverance Information' not in resp.body
+    assert isinstance(logs[-1], NullLogger)
+    assert logs[-1].messages == []
+    resp = make_app(True).get('/blog/index.html?deliv_log')
+    resp.mustcontain("2000 Some Corporation", 'Deliverance Information',
+                     'Fetching theme from')
+    assert not isinstance(logs[-1], NullLogger)
+    assert isinstance(logs[-1], SavingLogger)
+
+    # Subclasses of SavingLogger (which may do more than keep the
+    # messages for display) are only replaced if they say so:
+    from deliverance.log import make_log
+    req = Request.blank('/')
+    SecurityContext.install(req.environ, display_logging=False)
+    class AuditLogger(SavingLogger):
+        pass
+    assert isinstance(make_log(req, None, AuditLogger), AuditLogger)
+    class QuietLogger(SavingLogger):
+        display_only = True
+    assert isinstance(make_log(req, None, QuietLogger), NullLogger)
+    assert isinstance(make_log(req, None, PrintingLogger), PrintingLogger)
+    def custom_factory(request, middleware):
+        return SavingLogger(request, middleware)
+    assert not isinstance(make_log(req, None, custom_factory), NullLogger)
+    custom_factory.display_only = True
+    assert isinstance(make_log(req, None, custom_factory), NullLogger)
+
+def test_detached_resource_fetcher():
+    seen = []
+    def app(environ, start_response):
+        seen.append((environ['PATH_INFO'], environ.get('HTTP_COOKIE'),
+                     environ.get('HTTP_IF_NONE_MATCH')))
+        return Response('theme')(environ, start_response)
+    deliv = DeliveranceMiddleware(
+        app, lambda *args: None,
+        PrintingLogger, log_factory_kw=dict(print_level=logging.CRITICAL))
+    orig_req = Request.blank('/page.html', base_url='http://localhost/app',
+                             headers={'Cookie': 'session=1'})
+    detached = deliv.detached_resource_fetcher(orig_req)
+    del orig_req
+    resource_fetcher, log = detached()
+    resp = resource_fetcher('http://localhost/app/theme.html',
+                            headers={'If-None-Match': '"v1"'})
+    assert resp.body == 'theme'
+    # The user's cookies aren't sent along:
+    assert seen == [('/theme.html', None, '"v1"')]
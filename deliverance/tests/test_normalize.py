@@ -0,0 +1,98 @@
+import os
+from webob import Response
+from deliverance.util.cdata import escape_cdata
+from deliverance.util.charset import fix_meta_charset_position
+from deliverance.util.normalize import normalize_document, normalize_response
+from deliverance.util.normalize import is_ascii_compatible, parse_html
+from nose.tools import assert_equals
+
+content_dir = os.path.join(os.path.dirname(__file__), 'test_content')
+
+doc = '''\
+<html><head><title>A <b>title</b></title>
+<meta http-equiv="X-Deliverance-Page-Class" content="blog">
+<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1" />
+<script>//<![CDATA[
+  var x = '<meta http-equiv="X-Ignored" content="yes">' && 1 < 2;
+//]]></script></head>
+<body><meta charset="utf-8"></body></html>'''
+
+def test_document():
+    normalized = normalize_document(doc)
+    assert_equals(normalized.title, 'A <b>title</b>')
+    assert_equals(normalized.headers, [
+            ('X-Deliverance-Page-Class', 'blog'),
+            ('Content-Type', 'text/html; charset=ISO-8859-1')])
+    assert_equals(normalized.text,
+                  fix_meta_charset_position(escape_cdata(doc)))
+    assert normalized.text.startswith(
+        '<html><head><meta http-equiv="Content-Type" '
+        'content="text/html; charset=ISO-8859-1" /><title>')
+    assert 'charset=' not in normalized.text.split('</title>', 1)[1]
+
+def test_options():
+    assert_equals(
+        normalize_document(doc, fix_meta_charset_position=False).text,
+        escape_cdata(doc))
+    assert_equals(
+        normalize_document(doc, escape_cdata=False).text,
+        fix_meta_charset_position(doc))
+    unchanged = normalize_document(
+        doc, escape_cdata=False, fix_meta_charset_position=False)
+    assert unchanged.text is doc
+
+def test_same_as_separate_steps():
+    for filename in os.listdir(content_dir):
+        if not filename.endswith('.html'):
+            continue
+        f = open(os.path.join(content_dir, filename), 'rb')
+        body = f.read()
+        f.close()
+        assert_equals(normalize_document(body).text,
+                      fix_meta_charset_position(escape_cdata(body)))
+
+def test_response():
+    resp = Response(doc.replace('<', '\xe9<', 1), charset=None)
+    normalized = normalize_response(resp)
+    assert_equals(normalized.charset, 'ISO-8859-1')
+    # The body is normalized as bytes:
+    assert normalized.text.startswith('\xe9<html><head><meta ')
+    assert_equals(resp.charset, None)
+    assert_equals(normalized.parse().findtext('.//title'), 'A ')
+    assert_equals(normalized.parse().text_content()[0], u'\xe9')
+    assert_equals(normalize_response(Response('<p/>', charset=None)).charset,
+                  'utf8')
+
+def test_not_ascii_compatible():
+    assert is_ascii_compatible('utf8')
+    assert is_ascii_compatible('ISO-8859-1')
+    assert not is_ascii_compatible('utf-16')
+    assert not is_ascii_compatible('utf-7')
+    assert not is_ascii_compatible('no-such-charset')
+    resp = Response(doc.decode('latin1').encode('utf-16'), charset='utf-16')
+    normalized = normalize_response(resp)
+    assert isinstance(normalized.text, unicode)
+    assert_equals(normalized.text, normalize_document(doc).text)
+    assert_equals(normalized.title, 'A <b>title</b>')
+
+def test_multibyte_trail_bytes():
+    # The second byte of u'\u30be' in Shift_JIS is "]":
+    for charset in ('shift_jis', 'cp932', 'big5', 'gbk', 'gb18030'):
+        assert not is_ascii_compatible(charset), charset
+    text = (u'<html><head><title>\u30be</title></head><body><script>'
+            u'<![CDATA[ var x = "\u30be]>"; ]]></script></body></html>')
+    resp = Response(text.encode('shift_jis'), charset='shift_jis')
+    normalized = normalize_response(resp)
+    assert_equals(normalized.text, normalize_document(text).text)
+    assert_equals(normalized.title, u'\u30be')
+    # The whole CDATA section is escaped:
+    script = normalized.parse().find('.//script')
+    assert script.text.endswith(u'"\u30be]__GT__"; __END_CDATA__'), script.text
+
+def test_parse_html():
+    body = u'<html><body><p>caf\xe9</p></body></html>'
+    for charset in ('utf8', 'cp1252', 'mac-roman'):
+        doc = parse_html(body.encode(charset), 'http://localhost/', charset)
+        assert_equals(doc.findtext('.//p'), u'caf\xe9')
+    doc = parse_html(body, 'http://localhost/')
+    assert_equals(doc.findtext('.//p'), u'caf\xe9')
@@ -1,6 +1,6 @@
 import datetime
 from deliverance.log import SavingLogger
-from deliverance.proxy import Proxy
+from deliverance.proxy import Proxy, ProxySet
 from deliverance.util.filetourl import filename_to_url
 from lxml.etree import fromstring
 from pkg_resources import resource_filename
@@ -48,3 +48,132 @@ def test_no_cache_theme_file():
     resp = app.get("/_theme/theme.html", extra_environ=dict(HTTP_IF_MODIFIED_SINCE=recently))
     assert resp.status == "200 OK", resp.status
     
+
+def test_proxy_set_routing():
+    el = fromstring("""
+<ruleset>
+  <proxy path="/blog" domain="blog.example.com">
+    <dest href="{here}/blog-host" />
+  </proxy>
+  <proxy path="/blog">
+    <dest next="1" />
+  </proxy>
+  <proxy path="/blog" editable="1">
+    <dest href="{here}/blog" />
+  </proxy>
+  <proxy path="/">
+    <dest href="{here}/root" />
+  </proxy>
+</ruleset>
+""")
+    here = resource_filename("deliverance", "tests/test_proxy.py")
+    proxy_set = ProxySet.parse_xml(el, filename_to_url(here))
+    here_url = filename_to_url(here).rsplit('/', 1)[0]
+
+    def route(url):
+        req = Request.blank(url)
+        log = SavingLogger(req, None)
+        req.environ['deliverance.log'] = log
+        req.get_response(proxy_set.proxy_app)
+        forwarded = [msg.split(here_url, 1)[1] for level, el, msg in log.messages
+                     if msg.startswith('<proxy> matched')]
+        return forwarded, [name for url, name in log.edit_urls]
+
+    assert route('http://blog.example.com/blog/post') == (['/blog-host'], [])
+    assert route('http://other.example.com/blog/post') == (['/blog'], ['blog'])
+    assert route('http://other.example.com/about') == (['/root'], ['blog'])
+
+    # Unless debug messages are kept, only the proxies whose path and
+    # domain fit are looked at:
+    import logging
+    def candidates(url):
+        req = Request.blank(url)
+        return [index for index, match, matched
+                in proxy_set.match_index.iter_matching(
+                    req, None, None, SavingLogger(req, None, level=logging.INFO))]
+    assert candidates('http://blog.example.com/blog/post') == [0, 1, 2, 3]
+    assert candidates('http://other.example.com/blog/post') == [1, 2, 3]
+    assert candidates('http://other.example.com/about') == [3]
+
+def test_site_settings():
+    import os, shutil, tempfile
+    from deliverance.exceptions import DeliveranceSyntaxError
+    from deliverance.proxy import ProxySettings
+    tmp = tempfile.mkdtemp()
+    try:
+        for name in 'a.xml', 'b.xml':
+            open(os.path.join(tmp, name), 'w').close()
+        def parse(body):
+            return ProxySettings.parse_xml(
+                fromstring('<server-settings>%s</server-settings>' % body),
+                filename_to_url(os.path.join(tmp, 'main.xml')))
+        settings = parse("""
+  <site domain="*.a.example.com" rules="a.xml" />
+  <site domain="b.example.com" rules="b.xml" />
+  <site-idle-timeout>60</site-idle-timeout>""")
+        assert settings.site_idle_timeout == 60
+        assert settings.site_for_host('www.a.example.com:8080') == os.path.join(tmp, 'a.xml')
+        assert settings.site_for_host('B.example.com') == os.path.join(tmp, 'b.xml')
+        assert settings.site_for_host('a.example.com') is None
+        try:
+            parse('<site domain="c.example.com" rules="c.xml" />')
+        except DeliveranceSyntaxError, e:
+            assert 'does not exist' in str(e)
+        else:
+            assert 0, 'a missing rule file should be an error'
+    finally:
+        shutil.rmtree(tmp)
+
+def test_multi_site():
+    import os, shutil, tempfile
+    from deliverance.proxy import ProxySettings
+    from deliverance.proxycommand import MultiSiteApp
+    tmp = tempfile.mkdtemp()
+    try:
+        for name in 'main', 'a', 'b':
+            os.makedirs(os.path.join(tmp, 'content', name))
+            f = open(os.path.join(tmp, 'content', name, 'index.txt'), 'w')
+            f.write('site %s' % name)
+            f.close()
+        def write_rules(filename, body):
+            f = open(os.path.join(tmp, filename), 'w')
+            f.write('<ruleset>%s</ruleset>' % body)
+            f.close()
+        for name in 'a', 'b':
+            write_rules('%s.xml' % name,
+                        '<proxy><dest href="{here}/content/%s" /></proxy>' % name)
+        write_rules('main.xml', """
+<server-settings>
+  <site domain="*.a.example.com" rules="a.xml" />
+  <site domain="b.example.com" rules="b.xml" />
+  <site-idle-timeout>60</site-idle-timeout>
+</server-settings>
+<proxy><dest href="{here}/content/main" /></proxy>""")
+        a_rules = os.path.join(tmp, 'a.xml')
+        b_rules = os.path.join(tmp, 'b.xml')
+        settings = ProxySettings.parse_file(os.path.join(tmp, 'main.xml'))
+        app = MultiSiteApp(os.path.join(tmp, 'main.xml'), settings)
+        test_app = TestApp(app)
+        def get(host):
+            return test_app.get(
+                '/index.txt', extra_environ=dict(HTTP_HOST=host)).body
+        # The site rules are only loaded when they're needed:
+        assert app.site_apps == {}
+        assert get('B.example.com') == 'site b'
+        assert app.site_apps.keys() == [b_rules]
+        # ...and their themes prewarmed for the requested host:
+        assert app.site_apps[b_rules].base_url == 'http://B.example.com'
+        assert get('www.a.example.com') == 'site a'
+        assert get('other.example.com') == 'site main'
+        assert sorted(app.site_apps.keys()) == [a_rules, b_rules]
+
+        # Requests for other hosts unload the sites that have been
+        # idle for longer than the timeout:
+        app.last_used[b_rules] -= 120
+        app._last_sweep -= 120
+        assert get('other.example.com') == 'site main'
+        assert app.site_apps.keys() == [a_rules]
+        assert get('b.example.com') == 'site b'
+        assert sorted(app.site_apps.keys()) == [a_rules, b_rules]
+    finally:
+        shutil.rmtree(tmp)
@@ -27,3 +27,618 @@ def check_href(href, expected):
     ruleset.make_links_absolute(doc)
 
     assert_equals(tostring(doc), html % expected)
+
+
+def test_theme_cache():
+    from webob import Response
+    from deliverance.themecache import ThemeCache
+    parsed = []
+    def parse(resp, url):
+        parsed.append(url)
+        return document_fromstring(resp.body, base_url=url)
+    cache = ThemeCache(max_entries=2)
+    resp = Response('<html><body><div id="a">theme</div></body></html>')
+    theme = cache.get_theme('http://localhost/t1', resp, parse)
+    assert cache.get_theme('http://localhost/t1', resp, parse) is theme
+    assert_equals(parsed, ['http://localhost/t1'])
+    clone = theme.clone()
+    clone.body.clear()
+    assert_equals(theme.doc.get_element_by_id('a').text, 'theme')
+    # A changed body is parsed again
+    resp2 = Response('<html><body>new</body></html>')
+    assert cache.get_theme('http://localhost/t1', resp2, parse) is not theme
+    assert_equals(len(parsed), 2)
+    # Least recently used themes are evicted
+    cache.get_theme('http://localhost/t2', resp, parse)
+    cache.get_theme('http://localhost/t3', resp, parse)
+    assert_equals(len(cache.themes), 2)
+    cache.get_theme('http://localhost/t1', resp2, parse)
+    assert_equals(len(parsed), 5)
+    cache.invalidate('http://localhost/t3')
+    assert_equals([key[0] for key in cache.themes.keys()],
+                  ['http://localhost/t1'])
+
+
+class DummyLog(object):
+    def __init__(self):
+        self.messages = []
+    def debug(self, el, msg, *args):
+        self.messages.append(msg % args)
+    warn = debug
+
+
+def test_theme_revalidation():
+    from webob import Response
+    from deliverance.themecache import ThemeCache
+    requests = []
+    responses = []
+    def fetch(url, headers):
+        requests.append(headers)
+        return responses.pop(0)
+    cache = ThemeCache(stale_while_revalidate=0, stale_if_error=100)
+    now = [1000]
+    cache.clock = lambda: now[0]
+    log = DummyLog()
+    first = Response('theme', headers=[('ETag', '"v1"'),
+                                       ('Cache-Control', 'max-age=10')])
+    responses.append(first)
+    assert cache.get_response('http://localhost/t', fetch, log).body == 'theme'
+    # Fresh: no request at all
+    now[0] += 5
+    cached = cache.get_response('http://localhost/t', fetch, log)
+    assert_equals(cached.body, 'theme')
+    assert_equals(len(requests), 1)
+    # Each request gets a copy it can change
+    assert cached is not first
+    cached.headers['Content-Type'] = 'text/html; charset=latin1'
+    assert 'Content-Type' not in cache.get_response(
+        'http://localhost/t', fetch, log).headers
+    # Expired: a conditional GET, and a 304 keeps the old response
+    now[0] += 10
+    responses.append(Response(status=304, headers=[('Cache-Control', 'max-age=10')]))
+    assert cache.get_response('http://localhost/t', fetch, log).body == 'theme'
+    assert_equals(requests[-1], {'If-None-Match': '"v1"'})
+    # The 304 refreshed the lifetime
+    now[0] += 5
+    assert cache.get_response('http://localhost/t', fetch, log).body == 'theme'
+    assert_equals(len(requests), 2)
+    # A failing theme server means the stale copy is used
+    now[0] += 20
+    responses.append(Response(status=503))
+    assert cache.get_response('http://localhost/t', fetch, log).body == 'theme'
+    # ...but not forever
+    now[0] += 200
+    responses.append(Response(status=503))
+    assert_equals(cache.get_response('http://localhost/t', fetch, log).status_int, 503)
+
+
+def test_theme_stale_while_revalidate():
+    import threading
+    from webob import Response
+    from deliverance.themecache import ThemeCache
+    done = threading.Event()
+    second = Response('new theme', headers=[('Cache-Control', 'max-age=10')])
+    def fetch(url, headers):
+        return second
+    cache = ThemeCache()
+    now = [1000]
+    cache.clock = lambda: now[0]
+    log = DummyLog()
+    first = Response('theme', headers=[
+        ('Cache-Control', 'max-age=10, stale-while-revalidate=30')])
+    assert cache.get_response('http://localhost/t', lambda url, h: first, log) is first
+    now[0] += 15
+    orig_revalidate = cache.revalidate
+    def revalidate(*args):
+        try:
+            return orig_revalidate(*args)
+        finally:
+            done.set()
+    cache.revalidate = revalidate
+    def request_fetch(url, headers):
+        assert 0, 'the fetcher of a finished request was used'
+    # The stale copy is served while the refresh happens elsewhere,
+    # with a fetcher of its own
+    assert cache.get_response('http://localhost/t', request_fetch, log,
+                              lambda: (fetch, DummyLog())).body == 'theme'
+    done.wait(5)
+    assert_equals(cache.get_response('http://localhost/t', fetch, log).body,
+                  'new theme')
+    # Without one the theme is revalidated before responding
+    now[0] += 15
+    third = Response('newer theme', headers=[('Cache-Control', 'max-age=10')])
+    assert cache.get_response('http://localhost/t', lambda url, h: third, log) is third
+
+
+def test_theme_cache_personalized():
+    from webob import Response
+    from deliverance.themecache import ThemeCache
+    cache = ThemeCache()
+    log = DummyLog()
+    for headers in [[('Cache-Control', 'private, max-age=10')],
+                    [('Cache-Control', 'no-store')],
+                    [('Set-Cookie', 'session=1')],
+                    [('Vary', 'Cookie')]]:
+        resp = Response('theme', headers=headers)
+        assert cache.get_response('http://localhost/t', lambda url, h: resp, log) is resp
+        assert cache.responses.get('http://localhost/t') is None, headers
+    resp = Response('theme', headers=[('Cache-Control', 'public, max-age=10')])
+    cache.get_response('http://localhost/t', lambda url, h: resp, log)
+    assert_equals(cache.responses.get('http://localhost/t').response.body, 'theme')
+    # Responses to requests with credentials are only kept if public
+    from webob import Request
+    log.request = Request.blank('/', headers={'Authorization': 'Basic Ym9iOg=='})
+    cache.clear()
+    resp = Response('theme', headers=[('Cache-Control', 'max-age=10')])
+    cache.get_response('http://localhost/t', lambda url, h: resp, log)
+    assert cache.responses.get('http://localhost/t') is None
+    resp = Response('theme', headers=[('Cache-Control', 'public, max-age=10')])
+    cache.get_response('http://localhost/t', lambda url, h: resp, log)
+    assert cache.responses.get('http://localhost/t') is not None
+
+
+def test_theme_slots():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body>'
+             '<div id="nav"><p>nav</p></div><div id="main">theme</div>'
+             '<div id="footer">foot</div></body></html>')
+    rules = XML('''\
+<ruleset><theme href="/theme.html" /><rule>
+  <drop theme="#nav" />
+  <replace content="children:#content" theme="children:#main" />
+  <prepend content="#extra" theme="children:body" />
+  <append content="#footer" theme="#footer || #main" />
+  <append content="p" theme="p:first-child" nocontent="ignore" />
+</rule></ruleset>''')
+    content = ('<html><body><div id="content">content</div>'
+               '<div id="extra">x</div><div id="footer">c</div></body></html>')
+    ruleset = RuleSet.parse_xml(rules, 'test')
+    uncached = RuleSet.parse_xml(rules, 'test')
+    uncached.get_theme_slots = lambda cached_theme: None
+    def apply(ruleset):
+        req = Request.blank('http://localhost/')
+        return ruleset.apply_rules(
+            req, Response(content),
+            lambda *args, **kw: Response(theme),
+            SavingLogger(req, None)).body
+    body = apply(ruleset)
+    assert_equals(body, apply(uncached))
+    assert_equals(body, apply(ruleset))
+    # The index of the cached theme itself (not of the copy with
+    # <drop theme="#nav"> applied in advance)
+    slots = ruleset.get_theme_slots(ruleset._prepared_themes.keys()[0])
+    outcomes = dict([(str(slot.selector), slot.outcome)
+                     for slot in slots.slots.values()])
+    assert_equals(outcomes['elements:#nav'], 'one')
+    assert_equals(outcomes['elements:#footer || elements:#main'], 'one')
+    # Depends on the siblings, so it is not precomputed
+    assert 'elements:p:first-child' not in outcomes
+
+
+def test_compiled_selectors_shared():
+    from lxml.etree import XML
+    from deliverance.selector import compiled_selectors
+    rules = XML('''\
+<ruleset><rule>
+  <replace content="children:#shared-content" theme="children:/html/body" />
+</rule></ruleset>''')
+    first = RuleSet.parse_xml(rules, 'test')
+    hits = compiled_selectors.hits
+    misses = compiled_selectors.misses
+    second = RuleSet.parse_xml(rules, 'test')
+    assert_equals(compiled_selectors.misses, misses)
+    assert compiled_selectors.hits > hits
+    first_action = first.rules_by_class['default'][0]._actions[0]
+    second_action = second.rules_by_class['default'][0]._actions[0]
+    assert first_action.content is not second_action.content
+    assert (first_action.content.selectors[0][1]
+            is second_action.content.selectors[0][1])
+
+
+def test_element_index():
+    from deliverance.selector import Selector, ElementIndex
+    doc = document_fromstring(
+        '<html><head><title>T</title></head><body>'
+        '<div id="a" class="x  y"><p class="y">1</p></div>'
+        '<div id="b" class="x\ty"><p id="a">2</p></div>'
+        '<p class="xy">3</p></body></html>')
+    index = ElementIndex(doc)
+    selectors = ['#a', '#b', '#c', '.x', '.y', '.xy', 'p', 'div',
+                 '/html/head/title', '/html/body/div/p', '//p', '/body',
+                 '#a p', 'p:first-child', '#a || .y']
+    def check():
+        for expr in selectors:
+            selector = Selector.parse(expr)
+            assert_equals(selector(doc, index), selector(doc))
+    check()
+    # Removed elements and attributes are no longer found
+    doc.body.remove(doc.body[0])
+    del doc.body[0].attrib['class']
+    check()
+    # Only the root of a document is indexed
+    selector = Selector.parse('p')
+    assert_equals(selector(doc.body[0], index), selector(doc.body[0]))
+
+
+def test_selector_batch():
+    from deliverance.selector import Selector, SelectorBatch
+    from deliverance.applystate import ApplyState
+    doc = document_fromstring(
+        '<html><head><title>T</title></head><body>'
+        '<div id="a" class="x  y"><p class="y">1</p></div>'
+        '<div id="b" class="x\ty"><p id="a">2</p></div>'
+        '<p class="xy">3</p></body></html>')
+    selectors = [Selector.parse(expr) for expr in [
+            '#a', '#b', '#c', '.x', '.y', '.xy', 'p', '#a p', '#a || .y',
+            'p:first-child', '/html/body/div']]
+    batch = SelectorBatch(doc, selectors)
+    # Only the id, class and other stable selectors (once each) are
+    # evaluated
+    assert_equals(len(batch.results), 7)
+    def check():
+        for selector in selectors:
+            assert_equals(selector(doc, None, batch), selector(doc))
+    check()
+    doc.body.remove(doc.body[0])
+    check()
+    state = ApplyState(content_batch=batch)
+    assert state.batch_for(doc) is batch
+    state.content_modified(doc, 'children')
+    assert state.batch_for(doc) is batch
+    state.content_modified(doc, 'attributes')
+    assert state.batch_for(doc) is None
+
+
+def test_selection_memo():
+    from deliverance.applystate import ApplyState
+    from deliverance.selector import Selector
+    from deliverance.rules import Drop
+    doc = document_fromstring(
+        '<html><body><div id="a"><p>1</p></div><p>2</p></body></html>')
+    state = ApplyState()
+    action = Drop(None, Selector.parse('p'), None)
+    first = action.select_elements(Selector.parse('p'), doc, False, state)
+    assert_equals(len(first[1]), 2)
+    first[1].pop()
+    # The same selector, parsed again, isn't evaluated again
+    state.indexes.clear()
+    doc.body.remove(doc.body[-1])
+    assert_equals(
+        len(action.select_elements(Selector.parse('p'), doc, False, state)[1]),
+        2)
+    state.content_modified(doc, 'elements')
+    assert_equals(
+        len(action.select_elements(Selector.parse('p'), doc, False, state)[1]),
+        1)
+
+
+def test_rules_share_state():
+    from lxml.etree import XML
+    from deliverance.applystate import ApplyState
+    from deliverance.log import SavingLogger
+    from deliverance.rules import Rule
+    def rule(xml):
+        return Rule.parse_xml(XML(xml), 'test')
+    append = rule('<rule><append content="#c" theme="children:body" /></rule>')
+    drop = rule('<rule><drop theme="p" /></rule>')
+    theme = document_fromstring(
+        '<html><body><p>theme</p></body></html>')
+    content = document_fromstring(
+        '<html><body><div id="c"><p>content</p></div></body></html>')
+    log = SavingLogger(None, None)
+    state = ApplyState(theme)
+    append.apply(content, theme, None, log, state)
+    drop.apply(content, theme, None, log, state)
+    # Only the paragraph of the theme is dropped, not the one moved
+    # in from the content
+    assert_equals([p.text for p in theme.body.iter('p')], ['content'])
+
+
+def test_execution_plan():
+    from lxml.etree import XML
+    from deliverance.ruleset import standard_rule
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <theme href="/default.html" />
+  <rule class="a"><drop theme="#a" /></rule>
+  <rule class="b" suppress-standard="1">
+    <theme href="/b.html" /><drop theme="#b" />
+  </rule>
+  <rule class="a c" path="/c"><drop content="#c" /></rule>
+</ruleset>'''), 'test')
+    plan = ruleset.plan_for_classes(['a', 'x', 'a'])
+    assert ruleset.plan_for_classes(['a']) is plan
+    assert_equals(len(plan.rules), 2)
+    assert_equals(plan.theme.href, '/default.html')
+    assert plan.applied_rules is None
+    assert_equals(len(plan.selectors), len(standard_rule.content_selectors()) + 1)
+    plan = ruleset.plan_for_classes(['b'])
+    assert_equals(plan.theme.href, '/b.html')
+    assert_equals(plan.applied_rules, plan.rules)
+    plan = ruleset.plan_for_classes(['c', 'a'])
+    assert plan is not ruleset.plan_for_classes(['a', 'c'])
+    assert_equals(plan.rules, tuple(reversed(
+        ruleset.plan_for_classes(['a', 'c']).rules)))
+    assert_equals(ruleset.plan_for_classes([]).rules, ())
+    assert_equals(ruleset.plan_for_classes([], '/t.html').theme.href,
+                  '/default.html')
+
+
+def test_content_provenance():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body>'
+             '<div id="main"><p class="x">theme</p></div></body></html>')
+    content = ('<html><body><div id="c"><p class="x">content</p>'
+               '<div><p class="x">nested</p></div></div></body></html>')
+    rules = XML('''\
+<ruleset><theme href="/theme.html" /><rule>
+  <append content="#c" theme="children:#main" />
+  <drop theme=".x" />
+  <drop theme="p" />
+</rule></ruleset>''')
+    ruleset = RuleSet.parse_xml(rules, 'test')
+    req = Request.blank('http://localhost/')
+    body = ruleset.apply_rules(
+        req, Response(content), lambda *args, **kw: Response(theme),
+        SavingLogger(req, None)).body
+    # Only the theme's own paragraphs are dropped, not the content
+    # moved into it (however deep):
+    assert 'theme</p>' not in body
+    assert body.count('<p class="x">') == 2
+    assert 'x-a-marker' not in body
+
+
+def test_preapplied_actions():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body>'
+             '<div id="nav"><p>nav</p></div><div id="main">theme</div>'
+             '<div id="footer">foot <span>x</span></div><div id="ad">ad</div>'
+             '</body></html>')
+    rules = XML('''\
+<ruleset><theme href="/theme.html" /><rule>
+  <replace content="children:#content" theme="children:#main" />
+  <drop theme="#nav" />
+  <append content="#extra" theme="#footer" />
+  <drop theme="span" />
+  <drop theme="#ad" />
+  <drop theme="#nav" if-content="#content" />
+</rule></ruleset>''')
+    content = ('<html><body><div id="content">content</div>'
+               '<div id="extra">x</div></body></html>')
+    ruleset = RuleSet.parse_xml(rules, 'test')
+    unprepared = RuleSet.parse_xml(rules, 'test')
+    unprepared.get_prepared_theme = lambda cached_theme, rules, log: (
+        cached_theme, ())
+    def apply(ruleset):
+        req = Request.blank('http://localhost/')
+        return ruleset.apply_rules(
+            req, Response(content),
+            lambda *args, **kw: Response(theme),
+            SavingLogger(req, None)).body
+    body = apply(ruleset)
+    assert_equals(body, apply(unprepared))
+    assert_equals(body, apply(ruleset))
+    prepared = ruleset._prepared_themes.values()[0].values()[0]
+    # The span is inside, and #ad next to, the #footer the content
+    # was appended to; the last drop has if-content
+    assert_equals(sorted([str(action.theme) for action in prepared[1]]),
+                  ['elements:#nav'])
+    assert 'nav' not in tostring(prepared[0].doc)
+
+
+def test_template_engine():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+             '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
+             '<html><head><title>T</title></head><body>'
+             '<div id="nav">nav</div><div id="main">theme <b>x</b></div>'
+             '<div id="footer">foot</div></body></html>')
+    content = ('<html><head><title>C &amp; c</title>'
+               '<link rel="stylesheet" href="/c.css"></head><body>'
+               '<div id="content">content<br>more</div>'
+               '<div id="extra">x</div><div id="ad">ad</div></body></html>')
+    def apply(rules, engine):
+        ruleset = RuleSet.parse_xml(XML(
+            '<ruleset engine="%s"><theme href="/theme.html" />'
+            '<rule>%s</rule></ruleset>' % (engine, rules)), 'test')
+        req = Request.blank('http://localhost/')
+        body = ruleset.apply_rules(
+            req, Response(content),
+            lambda *args, **kw: Response(theme),
+            SavingLogger(req, None)).body
+        return ruleset, body
+    for rules, uses_template in [
+        ('<drop content="#ad" />'
+         '<replace content="children:#content" theme="children:#main" />'
+         '<prepend content="#ad || #extra" theme="children:#footer" />'
+         '<append content="children:#extra" theme="children:body" move="0" />',
+         True),
+        ('<drop theme="#nav" />'
+         '<replace content="children:#content" theme="children:body" />'
+         '<append content="#extra" theme="children:#main" />',
+         True),
+        ('<replace content="attributes:#content" theme="attributes:#main" />',
+         False)]:
+        template_ruleset, template_body = apply(rules, 'template')
+        tree_ruleset, tree_body = apply(rules, 'tree')
+        assert_equals(template_body, tree_body)
+        templates = template_ruleset._templates.values()[0].values()
+        assert_equals(not isinstance(templates[0], Exception), uses_template)
+
+def test_xslt_engine():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body>'
+             '<div id="nav">nav</div><div id="main">theme <b>x</b></div>'
+             '<div id="footer">foot</div></body></html>')
+    content = ('<html><head><title>C &amp; c</title>'
+               '<link rel="stylesheet" href="/c.css"></head><body>'
+               '<div id="content">content<br>more</div>tail'
+               '<div id="extra">x<p>y</p>z</div><div id="ad">ad</div>'
+               '</body></html>')
+    def apply(rules, engine):
+        ruleset = RuleSet.parse_xml(XML(
+            '<ruleset engine="%s"><theme href="/theme.html" />'
+            '<rule>%s</rule></ruleset>' % (engine, rules)), 'test')
+        req = Request.blank('http://localhost/')
+        log = SavingLogger(req, None)
+        body = ruleset.apply_rules(
+            req, Response(content),
+            lambda *args, **kw: Response(theme), log).body
+        return ruleset, body, ' '.join([msg[2] for msg in log.messages])
+    for rules, uses_stylesheet, themed in [
+        ('<drop content="#ad" />'
+         '<replace content="children:#content" theme="children:#main" />'
+         '<prepend content="#ad || #extra" theme="children:#footer" />'
+         '<append content="children:#extra" theme="children:body" move="0" />',
+         True, True),
+        ('<drop theme="#nav" />'
+         '<drop content="children:#extra p" />'
+         '<replace content="#content" theme="children:body" />'
+         '<append content="children:#extra" theme="children:#main" />',
+         True, True),
+        # Decided on each request: the stylesheet gives up
+        ('<replace content="#nothing" theme="children:#main" '
+         'nocontent="abort" />',
+         True, False),
+        ('<replace content="attributes:#content" theme="attributes:#main" />',
+         False, False)]:
+        xslt_ruleset, xslt_body, messages = apply(rules, 'xslt')
+        tree_ruleset, tree_body, tree_messages = apply(rules, 'tree')
+        assert_equals(xslt_body, tree_body)
+        stylesheets = xslt_ruleset._stylesheets.values()[0].values()
+        assert_equals(not isinstance(stylesheets[0], Exception),
+                      uses_stylesheet)
+        assert_equals('Themed the page with the XSLT stylesheet' in messages,
+                      themed)
+
+def test_compiled_engine():
+    from lxml.etree import XML
+    from deliverance.exceptions import AbortTheme
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body>'
+             '<div id="nav">nav</div><div id="main">theme <b>x</b></div>'
+             '<div id="footer" class="f">foot</div></body></html>')
+    content = ('<html><head><title>C</title>'
+               '<link rel="stylesheet" href="/c.css"></head><body>'
+               '<div id="content" class="c">content<br>more</div>tail'
+               '<div id="extra">x<p>y</p>z</div><div id="ad">ad</div>'
+               '</body></html>')
+    def apply(rules, engine):
+        ruleset = RuleSet.parse_xml(XML(
+            '<ruleset engine="%s"><theme href="/theme.html" />'
+            '<rule>%s</rule></ruleset>' % (engine, rules)), 'test')
+        req = Request.blank('http://localhost/')
+        log = SavingLogger(req, None)
+        try:
+            body = ruleset.apply_rules(
+                req, Response(content),
+                lambda *args, **kw: Response(theme), log).body
+        except AbortTheme:
+            body = None
+        messages = [(level, msg) for level, context, msg in log.messages
+                    if 'compiled transform' not in msg]
+        return ruleset, body, messages
+    for rules in [
+        '<drop theme="#nav" />'
+        '<drop content="children:#extra" />'
+        '<replace content="children:#content" theme="children:#main" />'
+        '<prepend content="#ad || #extra" theme="children:#footer" />'
+        '<append content="children:#extra" theme="children:body" move="0" />',
+        '<replace content="#content" theme="#main" move="0" />'
+        '<append content="children:#extra" theme="div" manytheme="last" />'
+        '<prepend content="#nothing" theme="#footer" nocontent="ignore" />',
+        '<replace content="attributes:#content" theme="attributes:#main" />'
+        '<append content="#ad" theme="children:body" if-content="not:#ad" />'
+        '<replace content="tag:#content" theme="tag:#footer" />'
+        '<drop content="#extra" theme="attributes(class):div" />',
+        '<replace content="children:#content || elements:#extra" theme="#main" />'
+        '<append content="#ad" theme="children:#nothing" notheme="abort" />']:
+        compiled_ruleset, compiled_body, messages = apply(rules, 'compiled')
+        tree_ruleset, tree_body, tree_messages = apply(rules, 'tree')
+        assert_equals(compiled_body, tree_body)
+        assert_equals(messages, tree_messages)
+    transform = compiled_ruleset.compiled_transforms()[0]
+    assert_equals(transform.name, 'transform-1')
+    assert_equals(transform.actions, 6)
+    # The selector mixing types is applied by the action itself
+    assert_equals(transform.interpreted, 1)
+    assert 'def action_1(' in transform.source
+    assert 'raise AbortTheme' in transform.source
+
+def test_copied_content():
+    from lxml.etree import XML
+    from webob import Request, Response
+    from deliverance.log import SavingLogger
+    theme = ('<html><head><title>T</title></head><body><div id="a">A</div>'
+             '<div id="b">B</div><div id="c">C</div></body></html>')
+    content = ('<html><head><title>C</title></head><body>'
+               '<div id="nav"><a>1</a>t1<a>2</a>t2</div>navtail</body></html>')
+    # The same content copied twice, then moved; the copies count as
+    # content, so the last drop doesn't touch them
+    rules = ('<append content="#nav" theme="children:#a" move="0" />'
+             '<append content="children:#nav" theme="children:#b" move="0" />'
+             '<replace content="#nav" theme="children:#c" />'
+             '<drop theme="#nav" />')
+    for engine in ('tree', 'compiled', 'template'):
+        ruleset = RuleSet.parse_xml(XML(
+            '<ruleset engine="%s"><theme href="/theme.html" />'
+            '<rule>%s</rule></ruleset>' % (engine, rules)), 'test')
+        req = Request.blank('http://localhost/')
+        body = ruleset.apply_rules(
+            req, Response(content), lambda *args, **kw: Response(theme),
+            SavingLogger(req, None)).body
+        assert_equals(
+            body.split('<body>')[1],
+            '<div id="a">A<div id="nav"><a>1</a>t1<a>2</a>t2</div></div>'
+            '<div id="b">B<a>1</a>t1<a>2</a>t2</div>'
+            '<div id="c"><div id="nav"><a>1</a>t1<a>2</a>t2</div>navtail</div>'
+            '</body></html>')
+
+def test_theme_is_static():
+    from deliverance.themeref import Theme
+    for href, pyref, expected in [
+        ('/theme.html', None, True),
+        ('http://example.com/theme.html', None, True),
+        ('theme.html', None, False),
+        ('/themes/{host}.html', None, False),
+        (None, 'mymodule:get_theme', False)]:
+        assert_equals(Theme(href=href, pyref=pyref).is_static(), expected)
+
+def test_streamed_output():
+    import copy
+    from deliverance.util.serialize import serialize_document, iter_serialize_document
+    xhtml = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+             '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">')
+    page = ('<html><head><title>T</title></head><body><div id="page">%s'
+            '</div></body></html>' % ''.join(
+                ['<p>Item <b>%i</b><br></p>\n' % i for i in range(50)]))
+    for doctype in (xhtml, ''):
+        doc = document_fromstring(doctype + page)
+        docinfo = doc.getroottree().docinfo
+        expected = serialize_document(copy.deepcopy(doc), docinfo)
+        pieces = list(iter_serialize_document(doc, docinfo, batch_size=20))
+        # The head, three batches of paragraphs, and the end:
+        assert_equals(len(pieces), 5)
+        assert_equals(''.join(pieces), expected)
+
+def test_formatted_tags():
+    from lxml.etree import XML
+    from deliverance.rules import Drop
+    action = Drop.from_xml(XML('<drop theme="#a" />'), 'test')
+    el = document_fromstring('<html><body><div>x</div></body></html>').body[0]
+    formatted = action.format_tags([el])
+    # The tag is the one the element had when the message was logged:
+    el.tag = 'span'
+    assert_equals(str(formatted), 'element <div>')
+    assert_equals(str(action.format_tags([])), 'no elements')
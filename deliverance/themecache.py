@@ -0,0 +1,377 @@
+"""
+Keeps theme responses and parsed theme documents around between
+requests.
+"""
+
+import copy
+import re
+import threading
+import time
+from deliverance.util.lru import LRUCache
+
+__all__ = ['ThemeCache', 'CachedTheme', 'CachedResponse',
+           'parse_cache_control']
+
+class CachedTheme(object):
+    """
+    A normalized, parsed theme document (with links already made
+    absolute), along with the source it was parsed from.
+
+    Requests must never modify `doc`; use `clone()` to get a copy to
+    work on.
+    """
+
+    def __init__(self, url, charset, body, doc):
+        self.url = url
+        self.charset = charset
+        self.body = body
+        self.doc = doc
+        # lxml does not carry the doctype over to copies, so we keep it
+        docinfo = doc.getroottree().docinfo
+        self.doctype = docinfo.doctype
+        self.public_id = docinfo.public_id
+        self.system_url = docinfo.system_url
+        self.declares_doctype = body.strip().startswith('<!DOCTYPE')
+
+    def __repr__(self):
+        return '<%s %s charset=%s>' % (
+            self.__class__.__name__, self.url, self.charset)
+
+    def clone(self):
+        """
+        Returns a private copy of the theme document.
+        """
+        return copy.deepcopy(self.doc)
+
+    def derive(self, doc):
+        """
+        Returns a `CachedTheme` for the same source, with `doc` (a
+        modified copy of this document) as its document.
+        """
+        theme = copy.copy(self)
+        theme.doc = doc
+        return theme
+
+
+_cache_control_re = re.compile(
+    r'([a-zA-Z0-9_-]+)\s*(?:=\s*(?:"([^"]*)"|([^\s,]*)))?')
+
+def parse_cache_control(value):
+    """
+    Parses a ``Cache-Control`` header value into a dictionary of
+    lower-cased directive names to their values (``None`` for
+    directives without a value).
+    """
+    directives = {}
+    if not value:
+        return directives
+    for match in _cache_control_re.finditer(value):
+        name = match.group(1).lower()
+        arg = match.group(2)
+        if arg is None:
+            arg = match.group(3)
+        directives[name] = arg
+    return directives
+
+def _seconds(directives, name):
+    value = directives.get(name)
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        return None
+
+
+class CachedResponse(object):
+    """
+    A theme response along with what is needed to decide when to
+    revalidate it.
+
+    Requests must never modify `response`; use `copy()` to get a
+    response to work on.
+    """
+
+    def __init__(self, url, response, fetched, default_stale_while_revalidate=0,
+                 default_stale_if_error=0):
+        self.url = url
+        self.response = response
+        self.default_stale_while_revalidate = default_stale_while_revalidate
+        self.default_stale_if_error = default_stale_if_error
+        self.update(response.headers, fetched)
+
+    def __repr__(self):
+        return '<%s %s max_age=%s>' % (
+            self.__class__.__name__, self.url, self.max_age)
+
+    def update(self, headers, fetched):
+        """
+        Updates the validators and freshness information from the
+        headers of a new response (a 200 or a 304).
+        """
+        self.fetched = fetched
+        etag = headers.get('ETag')
+        if etag:
+            self.etag = etag
+        elif not hasattr(self, 'etag'):
+            self.etag = None
+        last_modified = headers.get('Last-Modified')
+        if last_modified:
+            self.last_modified = last_modified
+        elif not hasattr(self, 'last_modified'):
+            self.last_modified = None
+        directives = parse_cache_control(headers.get('Cache-Control'))
+        if 'no-cache' in directives:
+            self.max_age = 0
+        else:
+            self.max_age = _seconds(directives, 'max-age')
+        # The stale-* windows are only offered for responses that
+        # declare a lifetime; a theme without one is always revalidated
+        self.stale_while_revalidate = _seconds(
+            directives, 'stale-while-revalidate')
+        if self.stale_while_revalidate is None and self.max_age:
+            self.stale_while_revalidate = self.default_stale_while_revalidate
+        if 'must-revalidate' in directives:
+            self.stale_while_revalidate = 0
+        self.stale_if_error = _seconds(directives, 'stale-if-error')
+        if self.stale_if_error is None:
+            self.stale_if_error = self.default_stale_if_error
+
+    def copy(self):
+        """
+        Returns a private copy of the response (sharing the body,
+        which can't be changed in place).
+        """
+        return self.response.copy()
+
+    def age(self, now):
+        """Seconds since the response was last fetched or revalidated"""
+        return max(now - self.fetched, 0)
+
+    def is_fresh(self, now):
+        """True if the response can be used without revalidating it"""
+        return bool(self.max_age) and self.age(now) < self.max_age
+
+    def can_revalidate_later(self, now):
+        """
+        True if the (stale) response can be used while it is
+        revalidated in the background.
+        """
+        if not self.max_age:
+            return False
+        return self.age(now) < self.max_age + (self.stale_while_revalidate or 0)
+
+    def can_use_on_error(self, now):
+        """
+        True if the response can be used when revalidating it failed.
+        """
+        return self.age(now) < (self.max_age or 0) + (self.stale_if_error or 0)
+
+    def conditional_headers(self):
+        """The headers for a conditional GET of this response"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ThemeCache(object):
+    """
+    A bounded cache of theme responses and of `CachedTheme` objects.
+
+    Responses are kept by URL along with their ``ETag`` and
+    ``Last-Modified`` validators, and are used without refetching
+    for as long as their ``Cache-Control: max-age`` allows.  After that
+    they are revalidated with a conditional GET: in the background,
+    while still serving the stale copy, during the
+    ``stale-while-revalidate`` window, or before responding after it.
+    A stale copy is also used when revalidating fails, during the
+    ``stale-if-error`` window.  Both windows can be given by the theme
+    server in ``Cache-Control``; otherwise the defaults given here are
+    used.
+
+    The cache is shared by all requests, so responses that may be
+    personalized (with ``Cache-Control: private`` or ``no-store``, a
+    ``Set-Cookie`` or a ``Vary`` header, or fetched for a request with
+    an ``Authorization`` header and not ``Cache-Control: public``) are
+    never kept.  Each request gets its own copy of a cached response.
+
+    Parsed themes are keyed on the resolved theme URL and charset
+    (plus how the source was normalized).  A cached theme is only
+    reused if the response body is identical to the one it was parsed
+    from.
+
+    At most ``max_entries`` themes (and responses), totalling at most
+    ``max_size`` bytes of source, are kept; the least recently used
+    ones are discarded first.
+    """
+
+    # Replaceable for testing:
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_entries=20, max_size=10*1024*1024,
+                 stale_while_revalidate=60, stale_if_error=3600):
+        self.themes = LRUCache(max_entries=max_entries, max_size=max_size)
+        self.responses = LRUCache(max_entries=max_entries, max_size=max_size)
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.themes)
+
+    def log_description(self, log=None):
+        """Description for use in log messages"""
+        return 'theme cache'
+
+    def get_response(self, url, fetch, log, detached=None):
+        """
+        Returns the response for the theme at ``url``, using the
+        cached response when it is usable.
+
+        ``fetch(url, headers)`` should fetch the URL with the extra
+        request ``headers`` and return a `webob.Response`.
+        ``detached()``, if given, should return a ``(fetch, log)``
+        pair that can still be used once the current request is done;
+        only then is a stale response served while it is revalidated
+        in the background.
+        """
+        now = self.clock()
+        cached = self.responses.get(url)
+        if cached is not None:
+            if cached.is_fresh(now):
+                log.debug(self, 'Using cached theme %s (age %is)',
+                          url, cached.age(now))
+                return cached.copy()
+            if detached is not None and cached.can_revalidate_later(now):
+                log.debug(self, 'Using stale theme %s (age %is) while it is revalidated',
+                          url, cached.age(now))
+                self.revalidate_in_background(url, cached, detached)
+                return cached.copy()
+        try:
+            resp = self.revalidate(url, cached, fetch, log)
+        except Exception, e:
+            if cached is not None and cached.can_use_on_error(self.clock()):
+                log.warn(self, 'Error fetching theme %s (%s); using stale copy', url, e)
+                return cached.copy()
+            raise
+        if (resp.status_int >= 500 and cached is not None
+            and cached.can_use_on_error(self.clock())):
+            log.warn(self, 'Theme %s returned %s; using stale copy', url, resp.status)
+            return cached.copy()
+        return resp
+
+    def revalidate(self, url, cached, fetch, log):
+        """
+        Fetches the theme, with a conditional GET if there is a cached
+        response, and stores the result.  Returns the response to use.
+        """
+        if cached is None:
+            headers = {}
+        else:
+            headers = cached.conditional_headers()
+        resp = fetch(url, headers)
+        now = self.clock()
+        if resp.status_int == 304 and cached is not None:
+            log.debug(self, 'Theme %s not modified', url)
+            cached.update(resp.headers, now)
+            return cached.copy()
+        if resp.status_int == 200:
+            if not self.is_storable(resp, getattr(log, 'request', None)):
+                log.debug(self, 'Not caching theme %s, which may be personalized', url)
+                self.responses.pop(url)
+            else:
+                self.responses.set(
+                    url, CachedResponse(
+                        url, resp.copy(), now,
+                        default_stale_while_revalidate=self.stale_while_revalidate,
+                        default_stale_if_error=self.stale_if_error),
+                    size=len(resp.body))
+        return resp
+
+    def is_storable(self, resp, req=None):
+        """
+        True if the (200) response can be shared by all requests.
+        `req` is the request it was fetched for; responses to a request
+        with an ``Authorization`` header are only shared if they are
+        ``Cache-Control: public``.
+        """
+        directives = parse_cache_control(resp.headers.get('Cache-Control'))
+        if 'no-store' in directives or 'private' in directives:
+            return False
+        if (req is not None and 'Authorization' in req.headers
+            and 'public' not in directives):
+            return False
+        return 'Set-Cookie' not in resp.headers and 'Vary' not in resp.headers
+
+    def revalidate_in_background(self, url, cached, detached):
+        """
+        Starts a thread to revalidate the cached response, unless one
+        is already running for this URL.  ``detached()`` returns the
+        ``(fetch, log)`` to use (see `get_response`).
+        """
+        self._lock.acquire()
+        try:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+        finally:
+            self._lock.release()
+        thread = threading.Thread(
+            target=self._background_revalidate, args=(url, cached, detached),
+            name='Deliverance theme refresh %s' % url)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _background_revalidate(self, url, cached, detached):
+        try:
+            fetch, log = detached()
+            try:
+                self.revalidate(url, cached, fetch, log)
+            except Exception, e:
+                log.warn(self, 'Error revalidating theme %s in the background: %s',
+                         url, e)
+        finally:
+            self._lock.acquire()
+            try:
+                self._refreshing.discard(url)
+            finally:
+                self._lock.release()
+
+    def get_theme(self, url, resp, parse, variant=()):
+        """
+        Returns the `CachedTheme` for the response ``resp`` (fetched
+        from ``url``), calling ``parse(resp, url)`` to create the
+        document when there is no usable cached copy.
+
+        ``variant`` distinguishes different normalizations of the
+        same source.
+        """
+        key = (url, resp.charset) + tuple(variant)
+        body = resp.body
+        theme = self.themes.get(key)
+        if theme is None or (theme.body is not body and theme.body != body):
+            theme = CachedTheme(url, resp.charset, body, parse(resp, url))
+            self.themes.set(key, theme, size=len(body))
+        return theme
+
+    def invalidate(self, url=None):
+        """
+        Discards the cached copies of the theme at ``url``, or of all
+        themes if no URL is given.
+        """
+        if url is None:
+            self.themes.clear()
+            self.responses.clear()
+            return
+        self.responses.pop(url)
+        for key in self.themes.keys():
+            if key[0] == url:
+                self.themes.pop(key)
+
+    def clear(self):
+        """Discards all cached themes"""
+        self.invalidate()
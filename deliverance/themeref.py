@@ -35,6 +35,16 @@ class Theme(object):
         return cls(href=href, pyref=pyref,
                    source_location=source_location)
 
+    def is_static(self):
+        """
+        True if the theme URL is the same for every request: it isn't
+        given by a pyref, has no URI template substitutions, and isn't
+        relative to the page.
+        """
+        if self.pyref or not self.href or '{' in self.href:
+            return False
+        return bool(urlparse.urlsplit(self.href)[0]) or self.href.startswith('/')
+
     def resolve_href(self, req, resp, log):
         """Figure out the theme URL given a request and response.
 
@@ -0,0 +1,229 @@
+"""
+Precomputed theme selections.
+"""
+
+__all__ = ['ThemeSlotIndex', 'ThemeSlot', 'find_preappliable_actions',
+           'touches_head']
+
+def is_attached(el, root):
+    """
+    Tests if `el` is (still) inside the tree of `root`.
+    """
+    while el is not None:
+        if el is root:
+            return True
+        el = el.getparent()
+    return False
+
+
+class ThemeSlot(object):
+    """
+    The matches of one theme `deliverance.selector.Selector` in an
+    unmodified theme document, stored as positions in document order
+    (so they apply to any copy of the document).
+
+    ``outcome`` is ``'notheme'``, ``'one'`` or ``'many'``, describing
+    the selection in the unmodified theme.
+    """
+
+    def __init__(self, selector, positions):
+        self.selector = selector
+        # A list of lists of positions, one per || alternative:
+        self.positions = positions
+        for alternative in positions:
+            if alternative:
+                if len(alternative) > 1:
+                    self.outcome = 'many'
+                else:
+                    self.outcome = 'one'
+                break
+        else:
+            self.outcome = 'notheme'
+
+    def __repr__(self):
+        return '<%s %s: %s>' % (
+            self.__class__.__name__, self.selector, self.outcome)
+
+    @classmethod
+    def from_doc(cls, selector, doc, positions):
+        """
+        Evaluates the selector against the unmodified theme `doc`.
+        `positions` maps the elements of `doc` to their position in
+        ``doc.iter()``.  Returns None if the selector can't be
+        precomputed.
+        """
+        if not selector.is_stable():
+            return None
+        result = []
+        for sel_type, sel, sel_expr, sel_attributes in selector.selectors:
+            alternative = []
+            for el in sel(doc):
+                if not isinstance(getattr(el, 'tag', None), basestring):
+                    # Strings, comments, etc.
+                    return None
+                alternative.append(positions[el])
+            result.append(alternative)
+        return cls(selector, result)
+
+    def select(self, doc, elements):
+        """
+        Returns ``(type, elements, attributes)`` like calling the
+        selector on the theme `doc` (a copy of the document this was
+        computed from, possibly with elements removed and content
+        inserted), with the content elements left out.  `elements` is
+        ``list(doc.iter())``, taken before `doc` was modified.  Returns None
+        if that cannot be determined without evaluating the selector.
+        """
+        selector = self.selector
+        if self.outcome == 'notheme':
+            # Nothing matched the theme, so only content can match now
+            return (selector.major_type, [], selector.attributes)
+        first = [elements[pos] for pos in self.positions[0]
+                 if is_attached(elements[pos], doc)]
+        if first or len(self.positions) == 1:
+            sel_type, dummy, dummy, sel_attributes = selector.selectors[0]
+            return (sel_type or selector.major_type, first,
+                    sel_attributes or selector.attributes)
+        # A later alternative would be used, unless content matches
+        # the first alternative
+        return None
+
+
+class ThemeSlotIndex(object):
+    """
+    The `ThemeSlot` for each theme selector of a set of rules, for
+    one theme document.
+    """
+
+    def __init__(self, doc, selectors):
+        self.slots = {}
+        positions = {}
+        for pos, el in enumerate(doc.iter()):
+            positions[el] = pos
+        for selector in selectors:
+            if selector in self.slots:
+                continue
+            slot = ThemeSlot.from_doc(selector, doc, positions)
+            if slot is not None:
+                self.slots[selector] = slot
+
+    def __repr__(self):
+        return '<%s %i slots>' % (self.__class__.__name__, len(self.slots))
+
+    def select(self, selector, doc, elements):
+        """
+        Returns the selection for `selector` in the theme `doc`, or
+        None if it has to be evaluated normally (see `ThemeSlot.select`).
+        """
+        slot = self.slots.get(selector)
+        if slot is None:
+            return None
+        return slot.select(doc, elements)
+
+    def candidates(self, selector, elements):
+        """
+        All the elements any alternative of `selector` matched in the
+        unmodified theme (``elements`` being its ``list(doc.iter())``),
+        or None if that is not known.
+        """
+        slot = self.slots.get(selector)
+        if slot is None:
+            return None
+        result = []
+        for alternative in slot.positions:
+            result.extend([elements[pos] for pos in alternative])
+        return result
+
+
+def _related(els, others, siblings=False):
+    """
+    True if any element of `els` is the same as, or an ancestor or
+    descendant of, any element of `others` (or a sibling, if
+    `siblings` is true).
+    """
+    if not els or not others:
+        return False
+    others = set(others)
+    near = set(others)
+    for el in others:
+        near.update(el.iterancestors())
+        if siblings:
+            parent = el.getparent()
+            if parent is not None:
+                near.update(parent)
+    for el in els:
+        if el in near:
+            return True
+        for ancestor in el.iterancestors():
+            if ancestor in others:
+                return True
+    return False
+
+def find_preappliable_actions(rules, slots, doc):
+    """
+    Returns the actions of `rules` (in the order they are applied)
+    that can be applied to the unmodified theme `doc` ahead of time,
+    with the same result as applying them in order on each request.
+
+    These are content-independent actions (see
+    `deliverance.rules.AbstractAction.is_content_independent`) of
+    rules without a match, whose theme selector is precomputed in the
+    `ThemeSlotIndex` `slots`, matches something, and does not touch
+    anything the actions before it touch (or sit next to anything
+    they replace or insert elements next to).  Nothing
+    after an action that reshapes the theme, or whose theme elements
+    aren't known, is applied in advance.
+    """
+    elements = list(doc.iter())
+    # Elements whose contents the actions change:
+    touched = []
+    # Elements the actions replace or put things next to:
+    touched_around = []
+    result = []
+    for rule in rules:
+        for action in rule._actions:
+            theme = getattr(action, 'theme', None)
+            if theme is None:
+                continue
+            els = slots.candidates(theme, elements)
+            if els is None:
+                return result
+            if (rule.match is None and action.is_content_independent()
+                and els and not _related(els, touched)
+                and not _related(els, touched_around, siblings=True)):
+                result.append(action)
+                continue
+            if action.reshapes_theme():
+                return result
+            if 'elements' in theme.selector_types():
+                touched_around.extend(els)
+            else:
+                touched.extend(els)
+    return result
+
+def touches_head(rules, slots, doc, preapplied=()):
+    """
+    True if any action of `rules` (other than the `preapplied` ones)
+    could change the theme `doc` up to the end of its ``<head>``: the
+    ``<html>`` element, the head or anything in it.  This is also
+    true if the theme elements of an action aren't known in advance
+    (see `ThemeSlotIndex.candidates`), or an action reshapes the theme.
+    """
+    head = doc.find('head')
+    if head is None:
+        return True
+    elements = list(doc.iter())
+    for rule in rules:
+        for action in rule._actions:
+            theme = getattr(action, 'theme', None)
+            if theme is None or action in preapplied:
+                continue
+            if action.reshapes_theme():
+                return True
+            els = slots.candidates(theme, elements)
+            if els is None:
+                return True
+            for el in els:
+                if el is doc or el is head or head in el.iterancestors():
+                    return True
+    return False
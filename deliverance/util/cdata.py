@@ -35,8 +35,11 @@ class Unescaper(Escaper):
             string = string.replace(char[1], char[0])
         return string
 
+_cdata_re = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+_escaped_cdata_re = re.compile(r'__START_CDATA__(.*?)__END_CDATA__', re.DOTALL)
+
 def escape_cdata(s):
-    cdata_re = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+    cdata_re = _cdata_re
     inners = cdata_re.findall(s)
     if not inners:
         return s
@@ -44,7 +47,9 @@ def escape_cdata(s):
     return cdata_re.sub(repl, s)
 
 def unescape_cdata(s):
-    cdata_re = re.compile(r'__START_CDATA__(.*?)__END_CDATA__', re.DOTALL)
+    if '__START_CDATA__' not in s:
+        return s
+    cdata_re = _escaped_cdata_re
     inners = cdata_re.findall(s)
     if not inners:
         return s
@@ -1,5 +1,6 @@
 # see ticket #12
 
+import codecs
 import re
 
 META_CHARSET_TAG = re.compile(
@@ -40,3 +41,32 @@ def force_charset(resp, default="utf8"):
     charset = match.group('charset')
     resp.charset = charset
     return resp
+
+def is_utf8(charset):
+    """
+    True if `charset` is a name of UTF-8 (or of ASCII, a subset of it).
+    """
+    try:
+        name = codecs.lookup(charset).name
+    except LookupError:
+        return False
+    return name in ('utf-8', 'ascii')
+
+def iter_recode(pieces, charset, to_charset='utf8'):
+    """
+    Yields the byte strings in `pieces` (in `charset`) re-encoded in
+    `to_charset`.  Pieces that are plain ASCII are passed on as they
+    are; so is everything if `charset` is unknown.  Each piece has to
+    end on a character boundary.
+    """
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = None
+    for piece in pieces:
+        if charset is not None:
+            try:
+                piece.decode('ascii')
+            except UnicodeDecodeError:
+                piece = piece.decode(charset, 'replace').encode(to_charset)
+        yield piece
@@ -0,0 +1,158 @@
+"""
+A small thread-safe least-recently-used cache.
+"""
+
+import threading
+
+__all__ = ['LRUCache']
+
+# Positions in the linked-list links:
+_PREV, _NEXT, _KEY, _VALUE, _SIZE = range(5)
+
+class LRUCache(object):
+    """
+    A mapping that holds at most ``max_entries`` items, and (when
+    ``max_size`` is given) at most that much total ``size``,
+    discarding the least recently used items first.
+
+    Each item is stored with a size (1 by default); the caller decides
+    what the size means (e.g., bytes of source text).  An item that is
+    by itself larger than ``max_size`` is not stored at all.
+
+    ``hits`` and ``misses`` count the results of `get`.
+    """
+
+    def __init__(self, max_entries=100, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._links = {}
+        # The root of a circular doubly linked list; root[_NEXT] is
+        # the least recently used link, root[_PREV] the most recent
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __repr__(self):
+        return '<%s %i/%s items size %s/%s>' % (
+            self.__class__.__name__, len(self._links), self.max_entries,
+            self.size, self.max_size)
+
+    def get(self, key, default=None, usable=None):
+        """
+        Returns the value for ``key`` (marking it as recently used),
+        or ``default``.
+
+        If ``usable(value)`` is given and returns false, the item is
+        treated as missing (and counted as a miss), though it is kept.
+        """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None or (usable is not None and not usable(link[_VALUE])):
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def peek(self, key, default=None):
+        """
+        Like `get`, but does not mark the item as used or count a hit
+        or miss.
+        """
+        link = self._links.get(key)
+        if link is None:
+            return default
+        return link[_VALUE]
+
+    def set(self, key, value, size=1):
+        """
+        Stores ``value`` under ``key``, evicting old items as necessary.
+        """
+        self._lock.acquire()
+        try:
+            old = self._links.pop(key, None)
+            if old is not None:
+                self._unlink(old)
+                self.size -= old[_SIZE]
+            if self.max_size is not None and size > self.max_size:
+                return
+            link = [None, None, key, value, size]
+            self._links[key] = link
+            self._append(link)
+            self.size += size
+            root = self._root
+            while (len(self._links) > self.max_entries
+                   or (self.max_size is not None and self.size > self.max_size)):
+                oldest = root[_NEXT]
+                self._unlink(oldest)
+                del self._links[oldest[_KEY]]
+                self.size -= oldest[_SIZE]
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """
+        Removes ``key``, returning its value (or ``default``).
+        """
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            self.size -= link[_SIZE]
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        """
+        The keys, from least to most recently used.
+        """
+        self._lock.acquire()
+        try:
+            result = []
+            root = self._root
+            link = root[_NEXT]
+            while link is not root:
+                result.append(link[_KEY])
+                link = link[_NEXT]
+            return result
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes all items (the hit/miss counters are kept)"""
+        self._lock.acquire()
+        try:
+            self._links.clear()
+            root = self._root
+            root[:] = [root, root, None, None, 0]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _unlink(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[_PREV]
+        link[_PREV] = last
+        link[_NEXT] = root
+        last[_NEXT] = root[_PREV] = link
@@ -0,0 +1,227 @@
+"""
+Normalizes documents before they are parsed, in one pass.
+
+This does what `deliverance.util.cdata.escape_cdata` and
+`deliverance.util.charset.fix_meta_charset_position` do, and at the
+same time collects the ``<meta http-equiv>`` headers (like
+`deliverance.ruleset.parse_meta_headers`) and the title.
+
+Documents are kept as bytes wherever the charset allows it, and
+parsed by lxml with an explicit encoding (`parse_html`), so they
+don't have to be decoded into unicode first.
+"""
+
+import codecs
+import re
+from lxml.html import document_fromstring, HTMLParser
+from deliverance.util.cdata import SPECIAL_CHARACTERS
+from deliverance.util.charset import META_CHARSET_TAG
+
+__all__ = ['NormalizedDocument', 'normalize_document', 'normalize_response',
+           'is_ascii_compatible', 'parse_html']
+
+# Everything the normalization looks at, in one expression (that only
+# has to be tried at each ``<``):
+_token_re = re.compile(
+    r'<(?:!\[CDATA\[(?P<cdata>.*?)\]\]>'
+    r'|(?P<meta>meta[^>]*>)'
+    r'|title>(?P<title>.*?)</title>'
+    r'|(?P<head>head>))',
+    re.I | re.S)
+
+_meta_attrs_re = re.compile(r'<meta\s+(.*?)>', re.I | re.S)
+_http_equiv_re = re.compile(r'http-equiv=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
+_content_re = re.compile(r'content=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
+
+def _escape_cdata(inner):
+    for char, replacement in SPECIAL_CHARACTERS:
+        inner = inner.replace(char, replacement)
+    return '__START_CDATA__%s__END_CDATA__' % inner
+
+def _meta_header(tag):
+    """
+    The ``(name, value)`` header of a ``<meta http-equiv>`` tag, or
+    None.
+    """
+    match = _meta_attrs_re.match(tag)
+    if match is None:
+        return None
+    attrs = match.group(1)
+    http_equiv_match = _http_equiv_re.search(attrs)
+    content_match = _content_re.search(attrs)
+    if not http_equiv_match or not content_match:
+        return None
+    http_equiv = (http_equiv_match.group(1) or http_equiv_match.group(2) or '')
+    http_equiv = http_equiv.strip()
+    content = content_match.group(1) or content_match.group(2) or ''
+    if not http_equiv or not content:
+        return None
+    return (http_equiv, content)
+
+_ascii_compatible = {}
+
+def _is_single_byte(name):
+    """
+    True if no byte of the charset `name` starts a multibyte
+    sequence (the incremental decoder never waits for more bytes).
+    """
+    for byte in range(0x80, 0x100):
+        decoder = codecs.getincrementaldecoder(name)()
+        try:
+            if not decoder.decode(chr(byte)):
+                return False
+        except UnicodeDecodeError:
+            # A byte the charset doesn't use
+            pass
+    return True
+
+def is_ascii_compatible(charset):
+    """
+    True if documents in `charset` can be normalized as bytes: ASCII
+    characters are encoded as themselves, and the bytes of other
+    characters can't be mistaken for them.  That is the case for
+    UTF-8 and single-byte charsets; the trail bytes of other
+    multibyte charsets (like Shift_JIS, Big5 or GBK) can be ASCII.
+    """
+    try:
+        return _ascii_compatible[charset]
+    except KeyError:
+        pass
+    try:
+        name = codecs.lookup(charset).name
+    except LookupError:
+        result = False
+    else:
+        if name == 'utf-8':
+            result = True
+        elif name.startswith(('utf-7', 'iso2022', 'hz')):
+            # Stateful encodings reuse ASCII bytes for other characters
+            result = False
+        else:
+            result = (u'<meta charset="">'.encode(name) == '<meta charset="">'
+                      and _is_single_byte(name))
+    _ascii_compatible[charset] = result
+    return result
+
+
+class NormalizedDocument(object):
+    """
+    The result of `normalize_document`: the normalized ``text``, the
+    ``charset`` it was decoded with (if known), the ``headers`` given
+    in ``<meta http-equiv>`` tags, as ``[(name, value)]``, and the
+    ``title`` (the source of the first ``<title>``, or None).
+    """
+
+    def __init__(self, text, charset, headers, title):
+        self.text = text
+        self.charset = charset
+        self.headers = headers
+        self.title = title
+
+    def __repr__(self):
+        return '<%s charset=%s %i headers title=%r>' % (
+            self.__class__.__name__, self.charset, len(self.headers),
+            self.title)
+
+    def parse(self, base_url=None):
+        """Parses the text; see `parse_html`"""
+        return parse_html(self.text, base_url, self.charset)
+
+
+def normalize_document(text, charset=None, escape_cdata=True,
+                       fix_meta_charset_position=True):
+    """
+    Normalizes the document source `text` in one pass over it:
+
+    * If `escape_cdata` is true, CDATA sections are escaped (so the
+      HTML parser leaves them alone; see ticket #36).
+
+    * If `fix_meta_charset_position` is true, the first
+      ``<meta ... charset=...>`` tag is moved to the start of
+      ``<head>``, and the others are removed (see ticket #12).
+
+    `text` can be unicode, or bytes in `charset` (or in an unknown
+    ASCII-compatible charset).  Bytes are only decoded if the charset
+    is not ASCII-compatible.
+
+    Returns a `NormalizedDocument`.  Meta tags and titles inside CDATA
+    sections are ignored.
+    """
+    if (isinstance(text, str) and charset is not None
+        and not is_ascii_compatible(charset)):
+        text = text.decode(charset)
+    headers = []
+    title = None
+    charset_tag = None
+    # The output pieces, and where each <head> ends in them:
+    pieces = []
+    heads = []
+    pos = 0
+    for match in _token_re.finditer(text):
+        kind = match.lastgroup
+        if kind == 'cdata':
+            if escape_cdata:
+                pieces.append(text[pos:match.start()])
+                pieces.append(_escape_cdata(match.group('cdata')))
+                pos = match.end()
+        elif kind == 'meta':
+            tag = match.group(0)
+            header = _meta_header(tag)
+            if header is not None:
+                headers.append(header)
+            if fix_meta_charset_position and META_CHARSET_TAG.match(tag):
+                if charset_tag is None:
+                    charset_tag = tag
+                pieces.append(text[pos:match.start()])
+                pos = match.end()
+        elif kind == 'title':
+            if title is None:
+                title = match.group('title')
+        elif kind == 'head' and fix_meta_charset_position:
+            pieces.append(text[pos:match.end()])
+            pos = match.end()
+            heads.append(len(pieces))
+    if not pieces:
+        # Nothing changed:
+        return NormalizedDocument(text, charset, headers, title)
+    pieces.append(text[pos:])
+    if charset_tag is not None:
+        for index in reversed(heads):
+            pieces.insert(index, charset_tag)
+    return NormalizedDocument(''.join(pieces), charset, headers, title)
+
+def normalize_response(resp, default_charset='utf8', escape_cdata=True,
+                       fix_meta_charset_position=True):
+    """
+    Like `normalize_document`, for the body of the `webob.Response`
+    `resp`, in its charset.  If it has none the charset given in the
+    body is used, or `default_charset` (like
+    `deliverance.util.charset.force_charset`, except that the response
+    is left alone).
+    """
+    charset = resp.charset
+    if not charset:
+        match = META_CHARSET_TAG.search(resp.body)
+        if match is None:
+            charset = default_charset
+        else:
+            charset = match.group('charset')
+    return normalize_document(
+        resp.body, charset, escape_cdata=escape_cdata,
+        fix_meta_charset_position=fix_meta_charset_position)
+
+def parse_html(text, base_url=None, charset=None):
+    """
+    Parses the HTML document `text`.  If it is a byte string and
+    `charset` is given, lxml decodes it as it parses (ignoring any
+    charset declared in the document), unless lxml does not know
+    the charset.
+    """
+    if isinstance(text, str) and charset:
+        try:
+            parser = HTMLParser(encoding=charset)
+        except LookupError:
+            text = text.decode(charset)
+        else:
+            return document_fromstring(text, parser=parser, base_url=base_url)
+    return document_fromstring(text, base_url=base_url)
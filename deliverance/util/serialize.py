@@ -0,0 +1,99 @@
+"""
+Serializes themed documents for the response.
+"""
+
+import os
+from lxml.etree import Comment, Element, SubElement
+from lxml.html import tostring
+from deliverance.util.cdata import unescape_cdata
+
+__all__ = ['output_method', 'serialize_document', 'iter_serialize_document',
+           'serialize_head']
+
+def output_method(doctype):
+    """
+    The lxml serialization method (``'xml'`` or ``'html'``) for a
+    document with the given doctype.
+    """
+    if "XHTML" in doctype:
+        return "xml"
+    else:
+        return "html"
+
+def serialize_document(doc, docinfo):
+    """
+    Serializes the document `doc` with the doctype described by
+    `docinfo` (an object with ``doctype``, ``public_id`` and
+    ``system_url`` attributes, like ``tree.docinfo``), restoring any
+    escaped CDATA sections.
+
+    For XHTML doctypes the doctype is put on the document itself, so
+    that libxml2 serializes it as XHTML (adding the ``xmlns`` and
+    ``<meta http-equiv="Content-Type">`` declarations).  `doc` should
+    not have a doctype of its own.
+    """
+    doctype = docinfo.doctype
+    if output_method(doctype) == "xml":
+        tree = doc.getroottree()
+        tree.docinfo.public_id = docinfo.public_id
+        tree.docinfo.system_url = docinfo.system_url
+        result = tostring(tree, method="xml", include_meta_content_type=True)
+    else:
+        result = tostring(doc, method="html", include_meta_content_type=True,
+                          doctype=doctype or None)
+    return unescape_cdata(result)
+
+def iter_serialize_document(doc, docinfo, batch_size=20):
+    """
+    Like `serialize_document`, but yields the output in pieces: first
+    everything up to the body content, then the content
+    `batch_size` elements at a time, then the rest.  `doc` is
+    consumed (the content is moved out of it as it is serialized), so
+    it should be a private copy.
+
+    The content is taken from ``<body>``, or from the innermost
+    element that wraps all of it (like ``<body><div id="page">...``).
+    Each batch is serialized in a scratch document with the same
+    doctype, so the pieces join to exactly what `serialize_document`
+    would return.
+    """
+    container = doc.find('body')
+    if container is None:
+        yield serialize_document(doc, docinfo)
+        return
+    while len(container) == 1 and isinstance(container[0].tag, basestring):
+        container = container[0]
+    if len(container) <= batch_size:
+        yield serialize_document(doc, docinfo)
+        return
+    marker = '<!--deliverance-%s-->' % os.urandom(8).encode('hex')
+    children = container[:]
+    for child in children:
+        container.remove(child)
+    container.append(Comment(marker[4:-3]))
+    start, end = serialize_document(doc, docinfo).split(marker)
+    yield start
+    del start
+    while children:
+        scratch = Element('html')
+        body = SubElement(scratch, 'body')
+        body.append(Comment(marker[4:-3]))
+        body.extend(children[:batch_size])
+        body.append(Comment(marker[4:-3]))
+        # Let the serialized elements go as soon as possible:
+        del children[:batch_size]
+        result = serialize_document(scratch, docinfo)
+        del scratch, body
+        yield result[result.index(marker)+len(marker):result.rindex(marker)]
+    yield end
+
+def serialize_head(doc, docinfo):
+    """
+    Returns the start of what `serialize_document` returns for `doc`:
+    everything up to the end of its ``<head>`` (including whatever is
+    between the head and the body).  `doc` is modified.
+    """
+    marker = '<!--deliverance-%s-->' % os.urandom(8).encode('hex')
+    head = doc.find('head')
+    head.addnext(Comment(marker[4:-3]))
+    return serialize_document(doc, docinfo).split(marker)[0]